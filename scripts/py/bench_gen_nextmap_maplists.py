@@ -0,0 +1,111 @@
+# Measures gen_nextmap_maplists on a synthetic map catalog, e.g.:
+#   python scripts/py/bench_gen_nextmap_maplists.py --maps 10000
+
+import argparse
+import io
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import gen_nextmap_maplists
+
+game_types = ['team', 'ffa', '1v1', 'pve']
+specials = ['Metal', 'No Metal', 'Lava', 'Asymmetrical']
+custom_lists = ['WaterMapPool', 'Tournament', 'Casual', 'Seasonal', 'Legacy']
+
+
+def synthetic_map(rng, i, lists=custom_lists):
+    player_count = rng.randint(1, 32)
+    m = {
+        'springName': f'{rng.choice(["Tropical", "Glacier", "Dust", "Lava", "Sky"])} Map {i}',
+        'mapLists': rng.sample(lists, rng.randint(0, 2)),
+        'inPool': rng.random() < 0.9,
+        'gameType': rng.sample(game_types, rng.randint(0, 3)),
+        'playerCount': player_count,
+        'certified': rng.random() < 0.5,
+        'startboxesSet': {},
+    }
+    m['startPosActive'] = rng.random() < 0.15
+    if rng.random() < 0.1:
+        m['special'] = rng.choice(specials)
+    if rng.random() < 0.8:
+        m['minPlayerCount'] = rng.randint(2, max(2, player_count))
+    for j in range(rng.randint(0, 3)):
+        startboxes_info = {'startboxes': [{}] * rng.randint(1, 8)}
+        if rng.random() < 0.8:
+            startboxes_info['maxPlayersPerStartbox'] = rng.randint(1, 8)
+        m['startboxesSet'][f'set{j}'] = startboxes_info
+    return m
+
+
+def synthetic_catalog(count, seed=0, lists=custom_lists):
+    rng = random.Random(seed)
+    return {f'map{i}': synthetic_map(rng, i, lists) for i in range(count)}
+
+
+def measure(repeat, func):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+def bench_process(args, out_dir):
+    input_file = out_dir / 'map_list.validated.json'
+    input_file.write_text(json.dumps(synthetic_catalog(args.maps, args.seed)))
+    data = gen_nextmap_maplists.get_data(input_file)
+
+    results = {
+        'get_data': measure(args.repeat, lambda: gen_nextmap_maplists.get_data(input_file)),
+        'get_output_string': measure(args.repeat, lambda: gen_nextmap_maplists.get_output_string(*data)),
+        'process': measure(args.repeat, lambda: gen_nextmap_maplists.process(
+            input_file, out_dir / 'mapLists.conf', out_dir / 'custom_map_lists.json')),
+    }
+
+    print(f'maps: {args.maps}')
+    for name, duration in results.items():
+        print(f'{name:<20} {duration * 1000:10.1f} ms')
+
+
+def bench_scaling(args):
+    """Prints time of writing mapLists.conf per line of output, which should stay
+    flat as the number of maps and custom lists grows."""
+    print(f'{"maps":>8} {"lists":>6} {"lines":>8} {"write_output":>14} {"per line":>10}')
+    maps = max(args.maps // 16, 100)
+    while maps <= args.maps:
+        lists = [f'List{i}' for i in range(max(maps // 100, 1))]
+        catalog = synthetic_catalog(maps, args.seed, lists)
+        data = gen_nextmap_maplists.build_sections(catalog)
+        lines = gen_nextmap_maplists.get_output_string(*data).count('\n')
+        duration = measure(args.repeat, lambda: gen_nextmap_maplists.write_output(io.StringIO(), *data))
+        print(f'{maps:>8} {len(lists):>6} {lines:>8} {duration * 1000:>11.1f} ms {duration / lines * 1e9:>7.0f} ns')
+        maps *= 2
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_gen_nextmap_maplists',
+                                     description='Benchmark gen_nextmap_maplists on a synthetic map catalog')
+    parser.add_argument('--maps', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', metavar='DIR', help='Write the catalog and outputs to this directory')
+    parser.add_argument('--scaling', action='store_true',
+                        help='Measure writing of the output for growing number of maps and lists, up to --maps')
+    args = parser.parse_args()
+
+    if args.scaling:
+        bench_scaling(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(args.keep or tmp)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        bench_process(args, out_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Compares the speed of yaml loaders and of yaml_to_json conversion to the output
+# formats on the real map_list.yaml, e.g.: python scripts/py/bench_yaml_to_json.py map_list.yaml
+
+import argparse
+import tempfile
+import time
+import yaml
+from pathlib import Path
+
+import yaml_to_json
+
+
+def measure(repeat, func):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_yaml_to_json', description='Benchmark yaml loaders and yaml_to_json')
+    parser.add_argument('input_file', nargs='?', default='map_list.yaml')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = Path(args.input_file).read_bytes()
+    loaders = {'Loader': yaml.Loader, 'SafeLoader': yaml.SafeLoader}
+    if yaml.__with_libyaml__:
+        loaders['CSafeLoader'] = yaml.CSafeLoader
+    else:
+        print('libyaml is not available, CSafeLoader skipped')
+
+    results = {}
+    for name, loader in loaders.items():
+        results[f'yaml.load {name}'] = measure(args.repeat, lambda: yaml.load(data, loader))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_file = Path(tmp) / 'out.json'
+        for compact, stable in [(False, False), (True, True), (True, False)]:
+            output_format = yaml_to_json.get_output_format(compact, stable)
+            results[f'convert {output_format}'] = measure(args.repeat, lambda: yaml_to_json.convert(
+                args.input_file, output_file, use_cache=False, compact=compact, stable=stable))
+            results[f'size {output_format}'] = output_file.stat().st_size
+            output_file.unlink()
+        yaml_to_json.get_cache_dir = lambda: Path(tmp) / 'cache'
+        yaml_to_json.convert(args.input_file, output_file)
+        results['convert (cached)'] = measure(args.repeat, lambda: yaml_to_json.convert(args.input_file, output_file))
+
+    for name, value in results.items():
+        if name.startswith('size'):
+            print(f'{name:<24} {value:10} bytes')
+        else:
+            print(f'{name:<24} {value * 1000:10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,78 @@
 # Generates maplists for https://github.com/beyond-all-reason/spads_config_bar/blob/main/etc/mapLists.conf . This controls the !nextmap command in spads.
 
+import filecmp
+import io
 import json
 import math
 from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
 
 teamsizes = ['2v2','3v3','4v4','5v5','6v6','7v7','8v8','ffa3','ffa4','ffa5','ffa6','ffa7','ffa8','ffa9','ffa10','ffa11','ffa12','ffa13','ffa14','ffa15','ffa16','2v2v2','2v2v2v2','2v2v2v2v2','2v2v2v2v2v2','2v2v2v2v2v2v2','2v2v2v2v2v2v2v2','3v3v3','3v3v3v3','3v3v3v3v3','4v4v4','4v4v4v4','5v5v5']
 
+def parse_teamsize(teamsize):
+    """Returns kind of the teamsize and players per team, e.g. (3, 2) for 2v2v2.
+
+    Kind is the team count for team games, and 'ffa' for free for all games, in
+    which case the players are the total number of players.
+    """
+    if teamsize.startswith('ffa'):
+        return 'ffa', int(teamsize[3:])
+    team_sizes = teamsize.split('v')
+    return len(team_sizes), int(team_sizes[0])
+
+def get_eligibility(map, player_count):
+    """Returns (kind, min players, max players) ranges of teamsizes the map fits."""
+    ranges = []
+    has_min_player_count = "minPlayerCount" in map
+    min_player_count = map.get("minPlayerCount")
+
+    if "team" in map["gameType"]:
+        for startboxes_info in map.get("startboxesSet", {}).values():
+            team_count = len(startboxes_info["startboxes"])
+            if "maxPlayersPerStartbox" in startboxes_info:
+                max_players_per_startbox = startboxes_info["maxPlayersPerStartbox"]
+                # Let's ignore the case when there is only 1 team. Maybe it should be
+                # just illegal in the rowy, but for now, there are some maps like that.
+                if team_count < 2 or team_count*max_players_per_startbox > 16:
+                    continue
+                if has_min_player_count:
+                    min_players = math.ceil(min_player_count/team_count)
+                else:
+                    min_players = math.ceil(max_players_per_startbox*0.6)
+                ranges.append((team_count, max(2, min_players), max_players_per_startbox))
+
+            # if a map didn't have "maxPlayersPerStartbox" set for its startboxes, but it's a teamgame map with startboxes for 2 teams, we'll use playerCount instead:
+            elif team_count == 2 and player_count >= 4:
+                if has_min_player_count:
+                    min_players = min_player_count
+                else:
+                    min_players = math.ceil(player_count/4)
+                ranges.append((2, max(2, min_players), math.floor(player_count/2)))
+
+    if "ffa" in map["gameType"]:
+        if has_min_player_count:
+            min_players = min_player_count
+        else:
+            min_players = math.floor(player_count/2)
+        ranges.append(('ffa', max(3, min_players), player_count))
+
+    return ranges
+
 def get_data(input_file):
     with open(input_file) as f:
         contents = json.load(f)
-    
-    teamsize_dict = {}
+    return build_sections(contents)
+
+def build_sections(contents):
+    """Returns the lists of maps built from the map catalog."""
+    # teamsize kind -> (mapname, min players, max players) the map is eligible for
+    eligibility = defaultdict(list)
     certified_maps = []
     uncertified_maps = []
     maps_1v1 = []
     map_lists = defaultdict(set)
 
-    for i in teamsizes:
-        teamsize_dict[i] = []
-
     for map in contents.values():
         for l in map["mapLists"]:
             map_lists[l].add(map["springName"])
@@ -27,62 +81,13 @@ def get_data(input_file):
 
         if not map["inPool"] or "special" in map and map["special"] in ['Metal', 'No Metal']:
             continue
-        is_team = False
-        mapname = ''
-        player_count = 0
-
 
         mapname = map["springName"]
-        is_team = "team" in map["gameType"]
-
-        if "playerCount" in map:
-            player_count = map["playerCount"]
         #32 player ffa or other such sillyness not supported in !nextmap
-        if player_count > 16:
-            player_count = 16
-        if player_count < 2:
-            player_count = 2
-        if "minPlayerCount" in map:
-            min_player_count = map["minPlayerCount"]
-
-        if "startboxesSet" in map:
-            for startboxes_info in map["startboxesSet"].values():
-                if "maxPlayersPerStartbox" in startboxes_info:
-                    team_count = len(startboxes_info["startboxes"])
-                    if team_count == 1:
-                        # Let's ignore the case when there is only 1 team. Maybe it should be
-                        # just illegal in the rowy, but for now, there are some maps like that.
-                        continue
-                    max_players_per_startbox = startboxes_info["maxPlayersPerStartbox"]
-
-                    # add teamgame maps to teamsize_dict
-                    if team_count*max_players_per_startbox <= 16 and is_team:
-                        for x in range(2,max_players_per_startbox+1): 
-                            if "minPlayerCount" in map and team_count:
-                                if x >= min_player_count/team_count:
-                                    teamsize_dict['v'.join([str(x)] * team_count)].append(mapname)
-                            elif x >= math.ceil(max_players_per_startbox*0.6):
-                                teamsize_dict['v'.join([str(x)] * team_count)].append(mapname)
-
-                # if a map didn't have "maxPlayersPerStartbox" set for its startboxes, but it's a teamgame map with startboxes for 2 teams, we'll use playerCount instead:
-                if not "maxPlayersPerStartbox" in startboxes_info and player_count and is_team:
-                    team_count = len(startboxes_info["startboxes"])
-                    if team_count == 2 and player_count >=4:
-                        for x in range(2,math.floor(player_count/2)+1): 
-                            if "minPlayerCount" in map:
-                                if x >= min_player_count:
-                                    teamsize_dict['v'.join([str(x)] * team_count)].append(mapname)
-                            elif x >= math.ceil(player_count/4):
-                                teamsize_dict['v'.join([str(x)] * team_count)].append(mapname)
-
-        # add ffa maps to teamsize_dict
-        if "ffa" in map["gameType"]:
-            for x in range(3,17):
-                if "minPlayerCount" in map:
-                    if x <= player_count and x >= min_player_count:
-                        teamsize_dict['ffa' + str(x)].append(mapname)
-                elif x <= player_count and x >= math.floor(player_count/2):
-                    teamsize_dict['ffa' + str(x)].append(mapname)
+        player_count = min(max(map.get("playerCount", 0), 2), 16)
+
+        for kind, min_players, max_players in get_eligibility(map, player_count):
+            eligibility[kind].append((mapname, min_players, max_players))
 
         # add maps to certified and uncertified lists
         if map["certified"]:
@@ -94,76 +99,85 @@ def get_data(input_file):
         if "1v1" in map["gameType"]:
             maps_1v1.append(mapname)
 
-    # make the lists more human-readable
-    for maplist in teamsize_dict.values():
-        maplist.sort()
+    # make the lists more human-readable, sorting once makes all lists below sorted
+    for ranges in eligibility.values():
+        ranges.sort()
     
     certified_maps.sort()
     uncertified_maps.sort()
     maps_1v1.sort()
 
-    # if combined_dict has empty lists then add ".*" (meaning all maps) to that list
-    for i in teamsize_dict:
-        if len(teamsize_dict[i]) == 0:
-            teamsize_dict[i].append('.*')
+    teamsize_dict = {}
+    for teamsize in teamsizes:
+        kind, players = parse_teamsize(teamsize)
+        maps = [mapname for mapname, min_players, max_players in eligibility[kind]
+                if min_players <= players <= max_players]
+        # if the list is empty then add ".*" (meaning all maps) to that list
+        teamsize_dict[teamsize] = maps or ['.*']
     
     return teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists
 
-def get_output_string(teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists):
-    nl = '\n'
-    output_string = f"""# This file was automatically generated by https://github.com/beyond-all-reason/maps-metadata/tree/main/scripts/py/gen_nextmap_maplists.py using data from rowy.
+header = """# This file was automatically generated by https://github.com/beyond-all-reason/maps-metadata/tree/main/scripts/py/gen_nextmap_maplists.py using data from rowy.
 # Next update from rowy will overwrite this file so do not manually edit this file.
 # If you want to make updates to this see https://github.com/beyond-all-reason/maps-metadata/wiki/Adding-a-created-map-to-the-game.
 # A map needs properly configured playercount, startboxes and maxPlayersPerStartbox in https://rowy.beyondallreason.dev/table/maps to appear here.
 # For example a 2v2v2v2 map needs a startbox configuration with 4 startboxes and maxPlayersPerStartbox >= 2.
-[all]
-.*
-
-[certified]
-{nl.join(certified_maps)}
-
-[uncertified]
-{nl.join(uncertified_maps)}
-
-[small]
-.*
-
-[medium]
-.*
-
-[large]
-.*
-
-[extraLarge]
-.*
-
-[misc]
-.*
-
-[1v1]
-{nl.join(maps_1v1)}
-
 """
-    
-    for i in teamsize_dict:
-        output_string = output_string + '[' + i + ']\n'
-        output_string += '\n'.join(teamsize_dict[i])
-        output_string = output_string + '\n\n'
 
-    output_string += '\n# Custom maplists\n\n'
+def write_section(f, name, maps):
+    f.write(f'[{name}]\n')
+    f.write('\n'.join(maps))
+    f.write('\n\n')
+
+def write_output(f, teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists):
+    """Writes mapLists.conf contents to the file object section by section."""
+    f.write(header)
+    write_section(f, 'all', ['.*'])
+    write_section(f, 'certified', certified_maps)
+    write_section(f, 'uncertified', uncertified_maps)
+    for name in ['small', 'medium', 'large', 'extraLarge', 'misc']:
+        write_section(f, name, ['.*'])
+    write_section(f, '1v1', maps_1v1)
+
+    for teamsize, maps in teamsize_dict.items():
+        write_section(f, teamsize, maps)
+
+    f.write('\n# Custom maplists\n\n')
     for l in sorted(map_lists.keys()):
-        output_string += f"[{l}]\n"
-        output_string += '\n'.join(sorted(map_lists[l]))
-        output_string += '\n\n'
+        write_section(f, l, sorted(map_lists[l]))
 
-    return output_string
+def get_output_string(teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists):
+    f = io.StringIO()
+    write_output(f, teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists)
+    return f.getvalue()
+
+@contextmanager
+def open_if_changed(path):
+    """Opens a temporary file for writing, which replaces the file at path when
+    closed without an error.
+
+    The file at path is kept untouched, including its mtime, when the written
+    contents are the same, so that make doesn't rebuild targets depending on it.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        with open(tmp, 'w') as f:
+            yield f
+        if path.exists() and filecmp.cmp(tmp, path, shallow=False):
+            tmp.unlink()
+        else:
+            tmp.replace(path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
 def process(input_file,mapLists_conf,custom_map_lists_json):
     teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists = get_data(input_file)
-    output = get_output_string(teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists)
-    with open(mapLists_conf, "w") as f:
-        f.write(output)
-    with open(custom_map_lists_json, "w") as f:
+    with open_if_changed(mapLists_conf) as f:
+        write_output(f, teamsize_dict, certified_maps, uncertified_maps, maps_1v1, map_lists)
+    with open_if_changed(custom_map_lists_json) as f:
         f.write(json.dumps(sorted(map_lists.keys()), indent=4))
 
 if __name__ == '__main__':
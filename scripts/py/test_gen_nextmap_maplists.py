@@ -0,0 +1,45 @@
+# Compares outputs of gen_nextmap_maplists on a small checked-in catalog with the
+# expected ones, e.g.: python -m unittest discover -s scripts/py
+#
+# After an intended change of the outputs, regenerate the expected files with:
+#   cd scripts/py && python -c "import gen_nextmap_maplists as g; d = 'testdata/gen_nextmap_maplists/'; \
+#     g.process(d + 'map_list.validated.json', d + 'mapLists.conf', d + 'custom_map_lists.json')"
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import gen_nextmap_maplists
+
+testdata = Path(__file__).parent / 'testdata' / 'gen_nextmap_maplists'
+
+
+class GenNextmapMaplistsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.out_dir = Path(tmp.name)
+
+    def process(self):
+        gen_nextmap_maplists.process(
+            testdata / 'map_list.validated.json', self.out_dir / 'mapLists.conf',
+            self.out_dir / 'custom_map_lists.json')
+
+    def test_outputs_match_expected(self):
+        self.process()
+        for name in ['mapLists.conf', 'custom_map_lists.json']:
+            with self.subTest(name):
+                self.assertEqual((self.out_dir / name).read_bytes(), (testdata / name).read_bytes())
+
+    def test_unchanged_outputs_are_not_rewritten(self):
+        self.process()
+        output = self.out_dir / 'mapLists.conf'
+        os.utime(output, ns=(0, 0))
+        self.process()
+        self.assertEqual(output.stat().st_mtime_ns, 0)
+        self.assertEqual(sorted(p.name for p in self.out_dir.iterdir()), ['custom_map_lists.json', 'mapLists.conf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
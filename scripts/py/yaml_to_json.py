@@ -2,22 +2,109 @@
 # it also serves as a minimal small example of running python build steps.
 
 import argparse
+import hashlib
 import json
+import os
 import yaml
 from pathlib import Path
 
-def convert(input_file, output_file):
-    with open(input_file) as f:
-        contents = yaml.load(f, yaml.Loader)
+try:
+    # libyaml based loader is several times faster than the pure python one.
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+try:
+    # Optional, only used for the compact output.
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bump when the output for the same input changes, to not use stale cache.
+CACHE_VERSION = b'2'
+
+
+def get_cache_dir():
+    return Path(os.environ.get('MAPS_CACHE_DIR', '.maps-cache')) / 'yaml-to-json'
+
+
+def get_output_format(compact, stable):
+    if not compact:
+        return 'indent'
+    # orjson output differs from json module one e.g. in escaping of non-ascii
+    # characters, so stable output can't depend on whether it's installed.
+    if orjson is not None and not stable:
+        return 'orjson'
+    return 'compact'
+
+
+def get_cache_file(input_file, data, output_format):
+    key = hashlib.sha256(b'\0'.join([CACHE_VERSION, output_format.encode(), data])).hexdigest()
+    return get_cache_dir() / f'{Path(input_file).stem}-{output_format}-{key}.json'
+
+
+def store_cache(cache_file, output):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # Only the output of the latest version of the input is worth keeping.
+    stem = cache_file.name.rsplit('-', 1)[0]
+    for old in cache_file.parent.glob(f'{stem}-*.json'):
+        old.unlink()
+    tmp = cache_file.with_suffix('.tmp')
+    tmp.write_bytes(output)
+    tmp.replace(cache_file)
+
+
+def to_json(data, output_format='indent'):
+    contents = yaml.load(data, Loader)
+    if output_format == 'orjson':
+        return orjson.dumps(contents, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    if output_format == 'compact':
+        # Without indent, json uses its much faster C encoder.
+        return json.dumps(contents, sort_keys=True, separators=(',', ':')).encode()
+    return json.dumps(contents, sort_keys=True, indent=4).encode()
+
+
+def write_if_changed(output_file, output):
+    """Writes output to the file unless it already has the same contents.
+
+    Keeping the file untouched preserves its mtime, so that make doesn't rebuild
+    targets depending on it after a no-op regeneration. Returns whether the file
+    was written.
+    """
     of = Path(output_file)
+    try:
+        if of.stat().st_size == len(output) and of.read_bytes() == output:
+            return False
+    except FileNotFoundError:
+        pass
     of.parent.mkdir(parents=True, exist_ok=True)
-    with of.open("w") as f:
-        json.dump(contents, f, sort_keys=True, indent=4)
+    tmp = of.with_name(of.name + '.tmp')
+    tmp.write_bytes(output)
+    tmp.replace(of)
+    return True
+
+
+def convert(input_file, output_file, use_cache=True, compact=False, stable=False):
+    data = Path(input_file).read_bytes()
+    output_format = get_output_format(compact, stable)
+    cache_file = get_cache_file(input_file, data, output_format) if use_cache else None
+    if cache_file is not None and cache_file.exists():
+        # Unchanged input, skip parsing and serialization altogether.
+        output = cache_file.read_bytes()
+    else:
+        output = to_json(data, output_format)
+        if cache_file is not None:
+            store_cache(cache_file, output)
+    return write_if_changed(output_file, output)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='yaml_to_json', description='Convert from yaml to json')
     parser.add_argument('input_file')
     parser.add_argument('output_file')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the input, without using the cache')
+    parser.add_argument('--compact', action='store_true', help='Write without indentation, using orjson when installed')
+    parser.add_argument('--stable', action='store_true',
+                        help='With --compact, produce the same bytes whether or not orjson is installed')
     args = parser.parse_args()
-    convert(args.input_file, args.output_file)
+    convert(args.input_file, args.output_file, use_cache=not args.no_cache, compact=args.compact, stable=args.stable)
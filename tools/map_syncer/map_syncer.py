@@ -10,52 +10,137 @@ deletes maps that are not seen on the live list for long enough.
 """
 
 import argparse
+import base64
+import codecs
+import errno
+import gzip
 import hashlib
+import http.client
+import io
 import json
 import logging
 import os
 import queue
+import random
+import re
+import select
 import shutil
 import signal
 import socket
+import struct
 import sys
 import threading
 import time
-import urllib.request
+import urllib.error
+import urllib.parse
 from contextlib import contextmanager, nullcontext
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from http.client import HTTPResponse
 from pathlib import Path
 from types import FrameType
 from typing import (
     TYPE_CHECKING,
+    BinaryIO,
+    Callable,
     ContextManager,
     Dict,
+    Iterable,
     Iterator,
     List,
+    Literal,
     Optional,
+    Protocol,
+    Set,
     Tuple,
+    TypeVar,
+    Union,
     cast,
 )
 
-import paho.mqtt.client as mqtt
+if TYPE_CHECKING:
+    # Imported only where used, like paho-mqtt, because it takes a good part
+    # of the startup time.
+    import asyncio
+
+T = TypeVar("T")
 
 USER_AGENT = "maps-metadata-sync-maps/1.0"
 DEFAULT_LIVE_MAPS_URL = (
     "https://maps-metadata.beyondallreason.dev/latest/live_maps.validated.json"
 )
 DEFAULT_MQTT_TOPIC = "dev.beyondallreason.maps-metadata/live_maps/updated:v1"
+# Response header with the maps-metadata commit the live maps list is from.
+COMMIT_HEADER = "x-maps-metadata-commit"
 DEFAULT_DELETE_AFTER = 4 * 60 * 60  # 4 hours
 DEFAULT_POLL_INTERVAL = 10 * 60  # 10 minutes
+DEFAULT_WATCH_POLL_INTERVAL = 10  # Used when inotify is not available
+# inotify(7) constants.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT = struct.Struct("iIII")
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_FULL_SYNC_EVERY = 6
+DEFAULT_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Downloads from a host fail fast for a while after this many failures in a row.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET = 5 * 60  # 5 minutes
+# Errors of writing files to the local disk, which say nothing about the host.
+LOCAL_FILE_ERRNOS = frozenset(
+    {
+        errno.EACCES,
+        errno.EPERM,
+        errno.EROFS,
+        errno.ENOENT,
+        errno.ENOTDIR,
+        errno.EISDIR,
+        errno.ENOSPC,
+        errno.EDQUOT,
+        errno.EIO,
+    }
+)
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+LIVE_MAPS_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+MAX_REDIRECTS = 5
+DOWNLOAD_ORDERS = ("list", "smallest")
+# Sizes of maps for the "smallest" download order are probed concurrently, and
+# only when there are few maps to download, as probing delays all downloads.
+SIZE_PROBE_CONCURRENCY = 8
+MAX_SIZE_PROBES = 100
+DEFAULT_DOWNLOAD_ORDER = "list"
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"
+MANIFEST_FILE = "manifest.json"
+SYNCED_MAPS_FILE = "synced_maps.json"
+TOMBSTONES_FILE = "tombstones.json"
+MAP_SUFFIXES = {".sd7", ".sdz"}
+# Unreferenced blobs are kept in the store for a while so that a blob just
+# downloaded by another syncer process isn't removed before it's linked.
+STORE_GC_GRACE = 60 * 60  # 1 hour
+# Temporary files not modified for this long are not downloads in progress,
+# possibly of another process writing to the same directory.
+STALE_TMP_AGE = 60 * 60  # 1 hour
 
 # In some rare instances, sockets can get stuck. Let's make sure that
 # we timeout them after some time for all socket oprations.
-socket.setdefaulttimeout(60)
+DEFAULT_SOCKET_TIMEOUT = 60
 
 
 @dataclass
 class LiveMapEntry:
+    # The daemon keeps tens of thousands of entries around between syncs.
+    __slots__ = ("spring_name", "file_name", "download_url", "md5")
+
     spring_name: str
     file_name: str
     download_url: str
@@ -72,109 +157,2105 @@ class MQTTConfig:
     password: Optional[str]
 
 
-def fetch_live_maps(url: str) -> List[LiveMapEntry]:
-    """Fetches live maps list from given URL and parses it."""
+@dataclass
+class SyncOptions:
+    download_concurrency: int = DEFAULT_DOWNLOAD_CONCURRENCY
+    verify: bool = False
+    full_sync_every: int = DEFAULT_FULL_SYNC_EVERY
+    max_download_rate: Optional[int] = None
+    download_order: str = DEFAULT_DOWNLOAD_ORDER
+    # Directory with maps stored by MD5 that are hardlinked to maps directories.
+    store: Optional[Path] = None
+    # Retries of failed downloads and live maps list fetches.
+    retries: int = DEFAULT_RETRIES
+    min_free_space: Optional[int] = None
+    max_disk_usage: Optional[int] = None
+    # Seconds to wait after a trigger for more triggers to coalesce with.
+    debounce: float = 0
+    # Minimum seconds between starts of consecutive syncs.
+    min_sync_interval: float = 0
+    # Maximum random delay of sync start, spreading load across many syncers.
+    start_jitter: float = 0
+
+
+class SyncError(RuntimeError):
+    pass
+
+
+class SyncCancelledError(Exception):
+    pass
+
+
+class InsufficientSpaceError(RuntimeError):
+    pass
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class HTTPConnectionPool:
+    """Minimal HTTP client reusing persistent connections.
+
+    Idle connections are kept per scheme, host and port, and the pool can be
+    shared by many threads. A connection is returned to the pool when the body
+    of its response was read to the end.
+
+    Proxies are configured like in urllib, by the http_proxy, https_proxy and
+    no_proxy environment variables. HTTPS requests are tunneled through the
+    proxy with CONNECT.
+    """
+
+    def __init__(self, max_idle_per_host: int = 8) -> None:
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._max_idle_per_host = max_idle_per_host
+        self._proxies: Optional[Dict[str, str]] = None
+
+    @contextmanager
+    def get(
+        self, url: str, headers: Dict[str, str], timeout: Optional[float] = None
+    ) -> Iterator[HTTPResponse]:
+        """Sends GET request following redirects and yields the final response."""
+
+        if timeout is None:
+            timeout = socket.getdefaulttimeout() or DEFAULT_SOCKET_TIMEOUT
+        for _ in range(MAX_REDIRECTS + 1):
+            key, path = self._parse_url(url)
+            conn, res = self._request(key, path, headers, timeout)
+            location = res.getheader("Location")
+            if res.status not in REDIRECT_STATUSES or location is None:
+                break
+            res.read()
+            self._release(key, conn, res)
+            url = urllib.parse.urljoin(url, location)
+        else:
+            msg = f"Too many redirects for {url}"
+            raise urllib.error.URLError(msg)
+
+        try:
+            yield res
+        finally:
+            self._release(key, conn, res)
+
+    def _parse_url(self, url: str) -> Tuple[Tuple[str, str, int], str]:
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in {"http", "https"} or not u.hostname:
+            msg = f"unsupported url: {url}"
+            raise urllib.error.URLError(msg)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        path = u.path or "/"
+        if u.query:
+            path += "?" + u.query
+        return (u.scheme, u.hostname, port), path
+
+    def _proxy(
+        self, scheme: str, host: str
+    ) -> Optional[Tuple[str, int, Dict[str, str]]]:
+        """Returns host, port and request headers of the proxy to use, if any."""
+
+        # Imported only here as it's slow to import.
+        import urllib.request
+
+        if self._proxies is None:
+            self._proxies = urllib.request.getproxies()
+        proxy = self._proxies.get(scheme)
+        if proxy is None or cast(bool, urllib.request.proxy_bypass(host)):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        u = urllib.parse.urlsplit(proxy)
+        if u.scheme != "http" or not u.hostname:
+            msg = f"unsupported {scheme} proxy: {proxy}"
+            raise urllib.error.URLError(msg)
+        headers = {}
+        if u.username is not None:
+            credentials = f"{urllib.parse.unquote(u.username)}:"
+            credentials += urllib.parse.unquote(u.password or "")
+            token = base64.b64encode(credentials.encode()).decode()
+            headers["Proxy-Authorization"] = f"Basic {token}"
+        return u.hostname, u.port or 80, headers
+
+    def _connect(
+        self, key: Tuple[str, str, int], timeout: Optional[float]
+    ) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        proxy = self._proxy(scheme, host)
+        if proxy is not None and scheme == "https":
+            proxy_host, proxy_port, proxy_headers = proxy
+            conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=timeout)
+            conn.set_tunnel(host, port, proxy_headers)
+            return conn
+        if proxy is not None:
+            return http.client.HTTPConnection(proxy[0], proxy[1], timeout=timeout)
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(
+        self,
+        key: Tuple[str, str, int],
+        path: str,
+        headers: Dict[str, str],
+        timeout: Optional[float],
+    ) -> Tuple[http.client.HTTPConnection, HTTPResponse]:
+        scheme, host, port = key
+        proxy = self._proxy(scheme, host) if scheme == "http" else None
+        if proxy is not None:
+            # Plain HTTP proxies take the absolute URL in the request line.
+            netloc = host if port == 80 else f"{host}:{port}"
+            path = f"http://{netloc}{path}"
+            headers = {**headers, **proxy[2]}
+        conn: Optional[http.client.HTTPConnection] = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+        if conn is not None:
+            conn.timeout = timeout
+            sock = cast(Optional[socket.socket], conn.sock)
+            if sock is not None:
+                sock.settimeout(timeout)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                # Server closed the idle connection, retry on a new one.
+                conn.close()
+            except BaseException:
+                conn.close()
+                raise
+
+        conn = self._connect(key, timeout)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def _release(
+        self,
+        key: Tuple[str, str, int],
+        conn: http.client.HTTPConnection,
+        res: HTTPResponse,
+    ) -> None:
+        if not res.isclosed() and res.length == 0:
+            res.read()
+        if res.isclosed() and not res.will_close:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self._max_idle_per_host:
+                    idle.append(conn)
+                    return
+        res.close()
+        conn.close()
+
+
+# Shared by all the HTTP requests made by the syncer.
+HTTP_POOL = HTTPConnectionPool()
+
+
+def raise_for_status(url: str, res: HTTPResponse) -> None:
+    if res.status >= 400:
+        raise urllib.error.HTTPError(
+            url, res.status, res.reason, res.headers, io.BytesIO()
+        )
+
+
+class TokenBucket:
+    """Limits the rate of transferred bytes shared by many threads.
+
+    Transfers take tokens for the bytes already transferred and sleep when the
+    bucket goes into debt, so together they keep the average rate with bursts
+    up to capacity bytes.
+    """
+
+    def __init__(self, rate: int, capacity: Optional[int] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        # Small reads keep the transfer smooth instead of bursting whole buffers.
+        self.chunk_size = max(1, min(rate // 10, DOWNLOAD_BUFFER_SIZE))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int, cancel: Optional[threading.Event] = None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= n
+            delay = -self._tokens / self.rate
+        if delay <= 0:
+            return
+        if cancel is not None:
+            cancel.wait(delay)
+        else:
+            time.sleep(delay)
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Returns whether the error is transient, and the request worth retrying."""
 
-    req = urllib.request.Request(
-        url,
-        headers={
-            "User-Agent": USER_AGENT,
-            "Cache-Control": "no-cache",
-        },
+    # Failures to write the file to the local disk won't go away by retrying.
+    if is_local_file_error(e):
+        return False
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code >= 500 or e.code in {408, 429}
+    return isinstance(
+        e, (urllib.error.URLError, http.client.HTTPException, OSError, DownloadError)
     )
-    res: HTTPResponse
-    with urllib.request.urlopen(req) as res:
-        # We assume that read url is well typed according to json schema
-        data: List[Dict[str, str]] = json.loads(res.read().decode())
-        return [
-            LiveMapEntry(d["springName"], d["fileName"], d["downloadURL"], d["md5"])
-            for d in data
+
+
+def is_local_file_error(e: BaseException) -> bool:
+    """Returns whether the error comes from local file operations.
+
+    Those are raised with the file name, e.g. when opening or renaming the
+    file, or with one of LOCAL_FILE_ERRNOS, e.g. when writing to it.
+    """
+
+    if not isinstance(e, OSError) or isinstance(e, urllib.error.URLError):
+        return False
+    filename = cast(Optional[str], e.filename)
+    return filename is not None or e.errno in LOCAL_FILE_ERRNOS
+
+
+def is_host_failure(e: BaseException) -> bool:
+    """Returns whether the error means the host is not serving requests."""
+
+    # MD5 mismatch is a problem of the file rather than the host, and local
+    # file errors are not retryable.
+    return is_retryable(e) and not isinstance(e, DownloadError)
+
+
+def retry_delay(attempt: int) -> float:
+    """Returns exponential backoff delay with full jitter before the retry."""
+
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (1 << attempt)))
+
+
+def with_retries(
+    func: Callable[[], T],
+    retries: int,
+    what: str,
+    cancel: Optional[threading.Event] = None,
+) -> T:
+    """Calls func retrying it up to retries times when it fails transiently."""
+
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = retry_delay(attempt)
+            logging.warning("%s failed: %s, retrying in %.1fs", what, e, delay)
+        attempt += 1
+        if cancel is None:
+            time.sleep(delay)
+        elif cancel.wait(delay):
+            raise SyncCancelledError()
+
+
+class CircuitBreaker:
+    """Fails fast requests to hosts that failed repeatedly.
+
+    After threshold consecutive failures, requests to the host fail with
+    CircuitOpenError for reset_after seconds. Then a single request is let
+    through, and its success closes the circuit again.
+    """
+
+    def __init__(
+        self,
+        threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+        reset_after: float = CIRCUIT_BREAKER_RESET,
+    ) -> None:
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def check(self, host: str) -> None:
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return
+            now = time.monotonic()
+            if now - opened_at < self.reset_after:
+                msg = f"Too many failures of {host}, not trying it for a while"
+                raise CircuitOpenError(msg)
+            # Let through a trial request, holding off the others until it's done.
+            self._opened_at[host] = now
+
+    def is_open(self, host: str) -> bool:
+        """Returns whether requests to host fail fast, without letting any through."""
+
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            return (
+                opened_at is not None
+                and time.monotonic() - opened_at < self.reset_after
+            )
+
+    def call(self, host: str, func: Callable[[], T]) -> T:
+        """Calls func making a request to host through the circuit breaker."""
+
+        self.check(host)
+        try:
+            result = func()
+        except Exception as e:
+            self.record(host, not is_host_failure(e))
+            raise
+        self.record(host, True)
+        return result
+
+    def record(self, host: str, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._failures.pop(host, None)
+                self._opened_at.pop(host, None)
+                return
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.threshold:
+                if host not in self._opened_at:
+                    logging.warning("Opening circuit for %s", host)
+                self._opened_at[host] = time.monotonic()
+
+
+MetricLabels = Tuple[Tuple[str, str], ...]
+
+
+class Metric:
+    """Metric exposed in the Prometheus text exposition format.
+
+    Samples are keyed by labels. Updates are guarded by a reentrant lock
+    because signal handlers can update metrics on the main thread while it's
+    in the middle of another update.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.RLock()
+        self._values: Dict[MetricLabels, float] = {}
+        METRICS.append(self)
+
+    def get(self, **labels: str) -> Optional[float]:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())))
+
+    def _add(self, value: float, labels: Dict[str, str]) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def samples(self) -> List[Tuple[str, MetricLabels, float]]:
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
         ]
+        for name, labels, value in self.samples():
+            label_str = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels)
+            sample = f"{name}{{{label_str}}}" if label_str else name
+            lines.append(f"{sample} {format_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        self._add(value, labels)
+
+
+class Gauge(Metric):
+    """Gauge set directly, or computed by function on every scrape."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Optional[Callable[[], Optional[float]]] = None,
+    ) -> None:
+        super().__init__(name, documentation)
+        self._function = function
+
+    def set(self, value: float, **labels: str) -> None:  # noqa: A003
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def samples(self) -> List[Tuple[str, MetricLabels, float]]:
+        if self._function is None:
+            return super().samples()
+        value = self._function()
+        return [] if value is None else [(self.name, (), value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, buckets: Tuple[float, ...]
+    ) -> None:
+        super().__init__(name, documentation)
+        self.buckets = (*sorted(buckets), float("inf"))
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+            self._sum += value
+
+    def samples(self) -> List[Tuple[str, MetricLabels, float]]:
+        with self._lock:
+            result: List[Tuple[str, MetricLabels, float]] = [
+                (f"{self.name}_bucket", (("le", format_metric_value(b)),), c)
+                for b, c in zip(self.buckets, self._counts)
+            ]
+            result.append((f"{self.name}_sum", (), self._sum))
+            result.append((f"{self.name}_count", (), self._counts[-1]))
+        return result
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metric_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def render_metrics() -> str:
+    """Renders all metrics in the Prometheus text exposition format."""
+
+    return "".join(metric.render() for metric in METRICS)
+
+
+def seconds_since_last_success() -> Optional[float]:
+    last_success = LAST_SUCCESS.get()
+    return None if last_success is None else time.time() - last_success
+
+
+METRICS: List[Metric] = []
+SYNC_DURATION = Histogram(
+    "map_syncer_sync_duration_seconds",
+    "Duration of syncs.",
+    (1, 5, 15, 60, 300, 900, 3600),
+)
+SYNCS = Counter("map_syncer_syncs_total", "Finished syncs by result.")
+LAST_SUCCESS = Gauge(
+    "map_syncer_last_success_timestamp_seconds",
+    "Unix time of the last successful sync.",
+)
+SINCE_LAST_SUCCESS = Gauge(
+    "map_syncer_seconds_since_last_success",
+    "Seconds since the last successful sync.",
+    seconds_since_last_success,
+)
+TRIGGERS = Counter("map_syncer_triggers_total", "Received sync triggers by source.")
+DOWNLOADED_BYTES = Counter(
+    "map_syncer_downloaded_bytes_total", "Bytes of maps downloaded."
+)
+DOWNLOAD_DURATION = Histogram(
+    "map_syncer_download_duration_seconds",
+    "Duration of successful map downloads.",
+    (1, 5, 15, 60, 300, 900),
+)
+MD5_FAILURES = Counter(
+    "map_syncer_md5_failures_total",
+    "Downloads with MD5 not matching the live maps list.",
+)
+DELETED_FILES = Counter(
+    "map_syncer_deleted_files_total", "Files deleted after their tombstone expired."
+)
+TOMBSTONES = Gauge("map_syncer_tombstones", "Files waiting for deletion.")
+
+
+@contextmanager
+def metrics_server(address: str, port: int) -> Iterator[Tuple[str, int]]:
+    """Serves metrics on /metrics in a background thread.
+
+    Yields the address and port the server listens on.
+    """
+
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+            logging.debug("Metrics request: %s", format % args)
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host, bound_port = cast(Tuple[str, int], server.server_address[:2])
+        yield host, bound_port
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class LiveMapsAnnouncements:
+    """Commits of the live maps list announced since the last sync.
+
+    MQTT trigger adds them from its thread, and the sync checks them. None
+    stands for a message that didn't carry a commit.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._commits: List[Optional[str]] = []
+
+    def announce(self, commit: Optional[str]) -> None:
+        with self._lock:
+            self._commits.append(commit)
+
+    def take(self) -> List[Optional[str]]:
+        with self._lock:
+            commits, self._commits = self._commits, []
+            return commits
+
+
+@dataclass
+class LiveMapsCache:
+    """Last fetched live maps list with validators for conditional requests."""
+
+    live_maps: List[LiveMapEntry] = field(default_factory=list)
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Commit of the maps-metadata repo the list is from.
+    commit: Optional[str] = None
+    announcements: Optional[LiveMapsAnnouncements] = None
+    # Set for the duration of a sync when the announcements proved the list to
+    # be current, so that it doesn't need to be fetched.
+    current: bool = False
+
+
+class DirtyFiles:
+    """Files changed outside of the syncer, collected per directory.
+
+    Filesystem watch adds them from its thread, and the sync checks them.
+    Deleted maps that are not on the live list are not collected: the syncer
+    deletes only such maps itself, and they don't need a sync anyway.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._files: Dict[Path, Set[str]] = {}
+        self._live: Dict[Path, Set[str]] = {}
+
+    def set_live(self, directory: Path, names: Set[str]) -> None:
+        """Sets names of the maps on the live list synced to the directory."""
+
+        with self._lock:
+            self._live[directory] = names
+
+    def add(self, directory: Path, name: str) -> bool:
+        """Adds the changed file, returns whether it needs a sync."""
+
+        deleted = not directory.joinpath(name).exists()
+        with self._lock:
+            live = self._live.get(directory)
+            if deleted and live is not None and name not in live:
+                return False
+            self._files.setdefault(directory, set()).add(name)
+            return True
+
+    def get(self, directory: Path) -> Set[str]:
+        with self._lock:
+            return set(self._files.get(directory, ()))
+
+    def discard(self, directory: Path, names: Set[str]) -> None:
+        """Removes files that were checked, keeping the ones added since then."""
+
+        with self._lock:
+            self._files.get(directory, set()).difference_update(names)
+
+
+@dataclass
+class SyncState:
+    """State carried between consecutive syncs of the same directory."""
+
+    live_maps_cache: LiveMapsCache = field(default_factory=LiveMapsCache)
+    # Modification time of the directory after the last successful sync, to
+    # detect changes made to it outside of the syncer.
+    directory_mtime_ns: Optional[int] = None
+    # Time when the oldest tombstone expires and the file should be deleted.
+    next_deletion_at: Optional[float] = None
+    # Live maps as of the last successful sync keyed by file name.
+    synced_maps: Optional[Dict[str, LiveMapEntry]] = None
+    # Number of incremental syncs since the last full one.
+    incremental_syncs: int = 0
+    # Set to cancel the in-flight sync.
+    cancel: threading.Event = field(default_factory=threading.Event)
+    # Loaded from the directory on the first sync.
+    tombstones: "Optional[Tombstones]" = None
+    # Files changed outside of the syncer reported by the filesystem watch.
+    dirty_files: "Optional[DirtyFiles]" = None
+    circuit_breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+
+
+def live_map_from_json(d: Dict[str, str]) -> LiveMapEntry:
+    return LiveMapEntry(d["springName"], d["fileName"], d["downloadURL"], d["md5"])
+
+
+def is_map_file_name(name: str) -> bool:
+    """Returns whether name is a plain map file name, safe to use as a path."""
+
+    return (
+        "/" not in name
+        and "\\" not in name
+        and "\0" not in name
+        and Path(name).suffix in MAP_SUFFIXES
+    )
+
+
+def live_maps_from_json(items: Iterable[object]) -> Iterator[LiveMapEntry]:
+    """Yields live maps entries, skipping the ones with invalid file name."""
+
+    for item in items:
+        # We assume that read url is well typed according to json schema
+        map_info = live_map_from_json(cast(Dict[str, str], item))
+        if not is_map_file_name(map_info.file_name):
+            logging.error(
+                "Ignoring live map with invalid file name %r", map_info.file_name
+            )
+            continue
+        yield map_info
+
+
+def parse_live_maps(data: List[Dict[str, str]]) -> List[LiveMapEntry]:
+    return list(live_maps_from_json(data))
+
+
+def parse_json_array_items(
+    decoder: json.JSONDecoder, buf: str, pos: int, expected: str, final: bool
+) -> Tuple[List[object], int, str]:
+    """Parses complete items of JSON array from buf starting at pos.
+
+    expected is the next token: "[" before the array, "" before an item, ","
+    after an item and "]" when the array already ended. Parsing stops at the
+    first incomplete item, unless final is set and the error is raised.
+    Returns the parsed items, the position after them and the next expected
+    token. Items which might continue past the end of buf are left unparsed,
+    unless final is set.
+    """
+
+    items: List[object] = []
+    while expected != "]":
+        # The pattern matches also an empty string.
+        pos = cast("re.Match[str]", JSON_WHITESPACE.match(buf, pos)).end()
+        if pos == len(buf):
+            break
+        if buf[pos] == expected:
+            pos, expected = pos + 1, ""
+        elif buf[pos] == "]" and expected != "[":
+            pos, expected = pos + 1, "]"
+        elif expected == "":
+            try:
+                item, end = cast(Tuple[object, int], decoder.raw_decode(buf, pos))
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            # Item reaching the end of buf might continue in the next chunk,
+            # e.g. a number cut in the middle of its digits or exponent.
+            if not final and JSON_NUMBER_TAIL.fullmatch(buf, end):
+                break
+            items.append(item)
+            pos = end
+            expected = ","
+        else:
+            msg = f"Expecting '{expected}'"
+            raise json.JSONDecodeError(msg, buf, pos)
+    return items, pos, expected
+
+
+def iter_json_array(
+    stream: io.BufferedIOBase, chunk_size: int = LIVE_MAPS_CHUNK_SIZE
+) -> Iterator[object]:
+    """Yields items of JSON array incrementally read from the stream.
+
+    Only the unparsed tail of the input is buffered, so, unlike json.load,
+    memory use doesn't grow with the size of the whole array. The stream is
+    read until its end.
+    """
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, expected = "", 0, "["
+    while True:
+        chunk = stream.read(chunk_size)
+        buf = buf[pos:] + utf8.decode(chunk, final=not chunk)
+        items, pos, expected = parse_json_array_items(
+            decoder, buf, 0, expected, not chunk
+        )
+        yield from items
+        if not chunk:
+            break
+    if expected != "]":
+        msg = "Unterminated array"
+        raise json.JSONDecodeError(msg, buf, pos)
+
+
+def iter_live_maps(
+    stream: io.BufferedIOBase, chunk_size: int = LIVE_MAPS_CHUNK_SIZE
+) -> Iterator[LiveMapEntry]:
+    """Yields entries of live maps list incrementally parsed from the stream."""
+
+    yield from live_maps_from_json(iter_json_array(stream, chunk_size))
+
+
+def live_map_to_json(map_info: LiveMapEntry) -> Dict[str, str]:
+    return {
+        "springName": map_info.spring_name,
+        "fileName": map_info.file_name,
+        "downloadURL": map_info.download_url,
+        "md5": map_info.md5,
+    }
+
+
+def fetch_live_maps(
+    url: str, cache: Optional[LiveMapsCache] = None
+) -> Optional[List[LiveMapEntry]]:
+    """Fetches live maps list from given URL and parses it.
+
+    When cache is passed, the request is conditional on the validators of the
+    previously fetched list, and None is returned when the list wasn't
+    modified since then. Otherwise the cache is updated with the new list.
+    """
+
+    headers = {
+        "User-Agent": USER_AGENT,
+        # Bypasses the serving worker's cache, conditional headers below still
+        # allow it to skip sending the body.
+        "Cache-Control": "no-cache",
+        "Accept-Encoding": "gzip",
+    }
+    if cache is not None:
+        if cache.etag is not None:
+            headers["If-None-Match"] = cache.etag
+        if cache.last_modified is not None:
+            headers["If-Modified-Since"] = cache.last_modified
+    with HTTP_POOL.get(url, headers) as res:
+        if res.status == 304 and cache is not None:
+            logging.debug("Live maps not modified")
+            return None
+        raise_for_status(url, res)
+        etag = res.getheader("ETag")
+        last_modified = res.getheader("Last-Modified")
+        commit = res.getheader(COMMIT_HEADER)
+        # Parsed while reading to not keep the whole body in memory.
+        stream: io.BufferedIOBase = res
+        if res.getheader("Content-Encoding") == "gzip":
+            stream = gzip.GzipFile(fileobj=res)
+        live_maps = list(iter_live_maps(stream))
+
+    if cache is not None:
+        cache.live_maps = live_maps
+        cache.etag = etag
+        cache.last_modified = last_modified
+        cache.commit = commit
+    return live_maps
+
+
+def parse_announced_commit(payload: bytes) -> Optional[str]:
+    """Returns the maps-metadata commit announced by MQTT message payload.
+
+    Anyone can publish to the topic, so the payload is only trusted to tell
+    that the cached list is current, and never used to change it. Returns None
+    when the payload isn't a commit.
+    """
+
+    text = payload.decode(errors="replace").strip()
+    return text if text.isalnum() else None
+
+
+def is_live_maps_cache_current(
+    cache: LiveMapsCache, commits: List[Optional[str]]
+) -> bool:
+    """Returns whether the announced commits prove the cached list current.
+
+    That's the case when all of them are the commit of the cached list, any
+    other commit means that the list has to be fetched.
+    """
+
+    if not commits or cache.commit is None:
+        return False
+    return all(commit == cache.commit for commit in commits)
 
 
 def send_healthcheck(url: str, timeout: float = 5000) -> None:
     """Sends a healthcheck to the given URL."""
-    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
     try:
-        res: HTTPResponse
-        with urllib.request.urlopen(req, timeout=timeout) as res:
+        with HTTP_POOL.get(url, {"User-Agent": USER_AGENT}, timeout) as res:
+            raise_for_status(url, res)
             res.read()
-    except (urllib.error.URLError, OSError) as e:
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
         logging.warning("Error while sending healthcheck: %s", e)
 
 
-def download_file(url: str, destination: Path, md5: str) -> None:
-    """Downloads a file from the URL to the destination path and checks the MD5."""
+def parse_content_range(header: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+    """Parses Content-Range header into the start offset and the total size."""
+
+    if header is None:
+        return None
+    unit, _, byte_range = header.strip().partition(" ")
+    first_last, _, total = byte_range.partition("/")
+    first, _, last = first_last.partition("-")
+    if unit != "bytes" or not first.isdigit() or not last.isdigit():
+        return None
+    if total == "*":
+        return int(first), None
+    if not total.isdigit():
+        return None
+    return int(first), int(total)
+
+
+def resumed_size(
+    res: HTTPResponse, offset: int, expected_size: Optional[int]
+) -> Tuple[bool, Optional[int]]:
+    """Checks that the range response continues the file at offset.
+
+    Returns whether it does, and the expected final size of the file.
+    """
+
+    content_range = parse_content_range(res.getheader("Content-Range"))
+    if content_range is None or content_range[0] != offset:
+        return False, None
+    if content_range[1] is not None:
+        return True, content_range[1]
+    if expected_size is not None:
+        return True, expected_size + offset
+    return True, None
+
+
+@contextmanager
+def open_download(
+    url: str, tmp_destination: Path
+) -> Iterator[Tuple[HTTPResponse, int, Optional[int]]]:
+    """Opens download of the URL resuming from the partial tmp file if possible.
+
+    Yields the response, offset in the tmp file the response body starts at,
+    and the expected final size of the file if known. When the partial file
+    can't be resumed, it's removed.
+    """
+
+    while True:
+        offset = tmp_destination.stat().st_size if tmp_destination.exists() else 0
+        headers = {"User-Agent": USER_AGENT}
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+        with HTTP_POOL.get(url, headers) as res:
+            if res.status == 416 and offset > 0:
+                # Partial file doesn't fit the remote one anymore, start over.
+                logging.info(
+                    "Can't resume %s, restarting download", tmp_destination.name
+                )
+                tmp_destination.unlink()
+                continue
+            raise_for_status(url, res)
+
+            content_length = res.getheader("Content-Length")
+            expected_size = int(content_length) if content_length else None
+            if offset == 0 or res.status != 206:
+                yield res, 0, expected_size
+                return
+
+            resumed, expected_size = resumed_size(res, offset, expected_size)
+            if not resumed:
+                logging.info(
+                    "Unexpected range response for %s, restarting download",
+                    tmp_destination.name,
+                )
+                tmp_destination.unlink()
+                continue
+
+            logging.info("Resuming %s at byte %d", tmp_destination.name, offset)
+            yield res, offset, expected_size
+            return
+
+
+def download_file(
+    url: str,
+    destination: Path,
+    md5: str,
+    cancel: Optional[threading.Event] = None,
+    throttle: Optional[TokenBucket] = None,
+    space: "Optional[DiskSpace]" = None,
+    tmp_destination: Optional[Path] = None,
+) -> None:
+    """Downloads a file from the URL to the destination path and checks the MD5.
+
+    Data left in the temporary file, by default the destination with .tmp
+    suffix, by an interrupted download is reused: the download resumes with a
+    Range request and falls back to fetching the whole file when the server
+    doesn't honor it. Setting cancel stops the download with
+    SyncCancelledError, and throttle limits its rate. With space, the download
+    starts only once its expected size was admitted.
+    """
+
+    if tmp_destination is None:
+        tmp_destination = Path(f"{destination}.tmp")
+    # The MD5 is computed while writing, so the only data read back from disk
+    # is the already downloaded part of the resumed file.
+    hasher = hashlib.md5()
+    buf = bytearray(DOWNLOAD_BUFFER_SIZE)
+    with open_download(url, tmp_destination) as (res, offset, expected_size):
+        reservation: ContextManager[None] = nullcontext()
+        if space is not None and expected_size is not None:
+            reservation = space.reserve(expected_size - offset, tmp_destination)
+        # The file is checked within the reservation, so that a failed download
+        # keeps reserved only what it left in the tmp file.
+        with reservation:
+            if offset > 0:
+                with tmp_destination.open("rb") as partial:
+                    hash_copy(partial, hasher, buf)
+            write_download(res, tmp_destination, offset, hasher, buf, cancel, throttle)
+            check_download(
+                tmp_destination, destination, md5, hasher, offset, expected_size
+            )
+    tmp_destination.replace(destination)
+
+
+def check_download(
+    tmp_destination: Path,
+    destination: Path,
+    md5: str,
+    hasher: "hashlib._Hash",
+    offset: int,
+    expected_size: Optional[int],
+) -> None:
+    """Checks the size and MD5 of the downloaded tmp file.
+
+    Connection cut mid-stream results in a short read, the partial file is
+    kept to resume from it next time. A file with wrong MD5 is removed.
+    """
+
+    size = tmp_destination.stat().st_size
+    DOWNLOADED_BYTES.inc(size - offset)
+    if expected_size is not None and size != expected_size:
+        msg = (
+            f"Incomplete download of {destination}: got {size} of {expected_size} bytes"
+        )
+        raise DownloadError(msg)
+    if hasher.hexdigest() != md5:
+        MD5_FAILURES.inc()
+        tmp_destination.unlink()
+        msg = f"MD5 mismatch when validating {destination}"
+        raise DownloadError(msg)
+
+
+def write_download(
+    res: HTTPResponse,
+    tmp_destination: Path,
+    offset: int,
+    hasher: "hashlib._Hash",
+    buf: bytearray,
+    cancel: Optional[threading.Event],
+    throttle: Optional[TokenBucket],
+) -> None:
+    """Appends the response body to the tmp file at offset.
+
+    When the disk gets full, the partial file is removed right away instead of
+    waiting for the next attempt.
+    """
+
+    mode: Literal["ab", "wb"] = "ab" if offset > 0 else "wb"
+    try:
+        with tmp_destination.open(mode) as f:
+            hash_copy(res, hasher, buf, f, cancel, throttle)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        tmp_destination.unlink(missing_ok=True)
+        msg = f"No space left on device for {tmp_destination.name}"
+        raise InsufficientSpaceError(msg) from e
+
+
+def hash_copy(
+    src: io.BufferedIOBase,
+    hasher: "hashlib._Hash",
+    buf: bytearray,
+    dst: Optional[BinaryIO] = None,
+    cancel: Optional[threading.Event] = None,
+    throttle: Optional[TokenBucket] = None,
+) -> None:
+    """Feeds all data from src to the hasher reading it into buf.
+
+    If dst is given, the data is also written to it. Data is processed as soon
+    as it's available, so the copy can be promptly stopped by setting cancel.
+    Reads are paced by the throttle when given.
+    """
+
+    view = memoryview(buf)
+    if throttle is not None:
+        view = view[: throttle.chunk_size]
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise SyncCancelledError()
+        n = src.readinto1(view)
+        if not n:
+            break
+        hasher.update(view[:n])
+        if dst is not None:
+            dst.write(view[:n])
+        if throttle is not None:
+            throttle.consume(n, cancel)
+
+
+def md5_file(file_path: Path, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """Computes the MD5 checksum of a file reading it in chunk_size blocks."""
+
+    hasher = hashlib.md5()
+    with file_path.open("rb") as f:
+        hash_copy(f, hasher, bytearray(chunk_size))
+    return hasher.hexdigest()
+
+
+def md5_match(
+    file_path: Path, expected_md5: str, chunk_size: int = HASH_CHUNK_SIZE
+) -> bool:
+    """Checks the MD5 checksum of a file reading it in chunk_size blocks."""
+
+    return md5_file(file_path, chunk_size) == expected_md5
+
+
+def write_json_atomic(path: Path, data: object) -> None:
+    """Writes data as JSON to path so that readers never see a partial file."""
+
+    tmp_path = Path(f"{path}.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.replace(path)
+
+
+@dataclass
+class ManifestEntry:
+    size: int
+    mtime_ns: int
+    md5: str
+
+
+class Manifest:
+    """Index of verified files in the maps directory persisted as JSON.
+
+    It allows to check integrity of the files without rehashing them as long
+    as their size and modification time didn't change.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries: Dict[str, ManifestEntry] = {}
+        self.changed = False
+        if not path.exists():
+            return
+        try:
+            with path.open() as f:
+                data: Dict[str, Dict[str, Union[int, str]]] = json.load(f)
+            for name, e in data.items():
+                self.entries[name] = ManifestEntry(
+                    int(e["size"]), int(e["mtime_ns"]), str(e["md5"])
+                )
+            logging.debug("Loaded manifest with %d entries", len(self.entries))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # It's only a cache, files will be just rehashed.
+            logging.warning("Ignoring corrupted manifest %s: %s", path, e)
+            self.entries = {}
+            self.changed = True
+
+    def record(self, file_path: Path, md5: str) -> None:
+        """Records that the file currently on disk has the given MD5."""
+
+        st = file_path.stat()
+        self.entries[file_path.name] = ManifestEntry(st.st_size, st.st_mtime_ns, md5)
+        self.changed = True
+
+    def verified_md5(self, file_path: Path) -> Optional[str]:
+        """Returns MD5 of the file, rehashing it only if it changed on disk.
+
+        Returns None if the file doesn't exist.
+        """
+
+        try:
+            st = file_path.stat()
+        except FileNotFoundError:
+            return None
+        entry = self.entries.get(file_path.name)
+        if entry is None or (entry.size, entry.mtime_ns) != (
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            logging.info("Hashing %s", file_path.name)
+            entry = ManifestEntry(st.st_size, st.st_mtime_ns, md5_file(file_path))
+            self.entries[file_path.name] = entry
+            self.changed = True
+        return entry.md5
+
+    def retain(self, file_names: Set[str]) -> None:
+        """Drops entries for files other than the given ones."""
+
+        for name in set(self.entries) - file_names:
+            del self.entries[name]
+            self.changed = True
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        write_json_atomic(
+            self.path,
+            {
+                name: {"size": e.size, "mtime_ns": e.mtime_ns, "md5": e.md5}
+                for name, e in self.entries.items()
+            },
+        )
+        self.changed = False
+
+
+class Tombstones:
+    """Times since when files are not seen on the live list persisted as JSON.
+
+    The state is kept in memory between syncs: the file is read only when the
+    tombstones are created, and written atomically only when they changed.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.not_seen_since: Dict[str, int] = {}
+        self.changed = False
+        if not path.exists():
+            return
+        try:
+            with path.open() as f:
+                data: Dict[str, int] = json.load(f)
+            self.not_seen_since = {str(k): int(v) for k, v in data.items()}
+            logging.debug("Loaded tombstones from file")
+        except (ValueError, TypeError, AttributeError) as e:
+            # Files will get new tombstones, so they are only deleted later.
+            logging.warning("Ignoring corrupted tombstones %s: %s", path, e)
+            self.not_seen_since = {}
+            self.changed = True
+
+    def __len__(self) -> int:
+        return len(self.not_seen_since)
+
+    def bury(self, name: str, now: float) -> None:
+        if name not in self.not_seen_since:
+            logging.debug("Tombstone %s", name)
+            self.not_seen_since[name] = int(now)
+            self.changed = True
+
+    def revive(self, name: str) -> None:
+        if self.not_seen_since.pop(name, None) is not None:
+            self.changed = True
+
+    def retain(self, names: Set[str]) -> None:
+        """Drops tombstones of files other than the given ones."""
+
+        for name in set(self.not_seen_since) - names:
+            self.revive(name)
+
+    def pop_expired(self, now: float, delete_after: int) -> List[str]:
+        """Removes and returns tombstones older than delete_after seconds."""
+
+        expired = [
+            name for name, t in self.not_seen_since.items() if now - t > delete_after
+        ]
+        for name in expired:
+            self.revive(name)
+        return expired
+
+    def next_deletion_time(self, delete_after: int) -> Optional[float]:
+        if not self.not_seen_since:
+            return None
+        return min(self.not_seen_since.values()) + delete_after
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        write_json_atomic(self.path, self.not_seen_since)
+        self.changed = False
+
+
+def delete_expired(
+    directory: Path, tombstones: Tombstones, now: float, delete_after: int
+) -> Optional[float]:
+    """Deletes files with expired tombstones and saves the tombstones.
+
+    Returns the time when the next of the remaining tombstones expires.
+    """
+
+    for name in tombstones.pop_expired(now, delete_after):
+        logging.info("Deleting %s", name)
+        directory.joinpath(name).unlink(missing_ok=True)
+        DELETED_FILES.inc()
+    TOMBSTONES.set(len(tombstones))
+    tombstones.save()
+    return tombstones.next_deletion_time(delete_after)
+
+
+def delete_stale_tmp(file_path: Path, live_map_files: Set[str], now: float) -> None:
+    """Deletes the temporary file unless it's a resumable download of a live map.
+
+    Files modified in the last STALE_TMP_AGE are kept, as they might be still
+    written to.
+    """
+
+    name = map_file_name(file_path.name)
+    if name in live_map_files and not file_path.with_name(name).exists():
+        return
+    try:
+        if now - file_path.stat().st_mtime < STALE_TMP_AGE:
+            return
+    except FileNotFoundError:
+        return
+    logging.info("Deleting stale %s", file_path.name)
+    file_path.unlink(missing_ok=True)
+
+
+def delete_stale_files(
+    directory: Path,
+    live_maps: List[LiveMapEntry],
+    delete_after: int,
+    tombstones: Optional[Tombstones] = None,
+) -> Optional[float]:
+    """Deletes files that are not seen on the live list for long enough.
+
+    Temporary files that can't be used to resume a download are deleted once
+    they are not modified for STALE_TMP_AGE, without tombstones. Returns the
+    time when the next of the remaining tombstoned files is due for deletion.
+    """
+
+    # Skip deletion if it's disabled
+    if delete_after < 0:
+        return None
+    live_map_files = {file_info.file_name for file_info in live_maps}
+    stale_files: Set[str] = set()
+    now = time.time()
+    for file_path in directory.iterdir():
+        if file_path.suffix == ".tmp":
+            delete_stale_tmp(file_path, live_map_files, now)
+        elif file_path.suffix in MAP_SUFFIXES and file_path.name not in live_map_files:
+            stale_files.add(file_path.name)
+
+    if tombstones is None:
+        tombstones = Tombstones(directory.joinpath(TOMBSTONES_FILE))
+    # Rebuild the tombstones from files that are actually in the directory.
+    tombstones.retain(stale_files)
+    for name in sorted(stale_files):
+        tombstones.bury(name, now)
+    return delete_expired(directory, tombstones, now, delete_after)
+
+
+def update_tombstones(
+    directory: Path,
+    delete_after: int,
+    buried: List[str],
+    revived: List[str],
+    tombstones: Optional[Tombstones] = None,
+) -> Optional[float]:
+    """Updates tombstones of maps that left or returned to the live list.
+
+    Unlike delete_stale_files, it doesn't scan the directory, and only deletes
+    the already tombstoned files that expired. Returns the time when the next
+    tombstone expires.
+    """
+
+    if delete_after < 0:
+        return None
+    if tombstones is None:
+        tombstones = Tombstones(directory.joinpath(TOMBSTONES_FILE))
+
+    now = time.time()
+    for name in revived:
+        tombstones.revive(name)
+    for name in buried:
+        if directory.joinpath(name).exists():
+            tombstones.bury(name, now)
+    return delete_expired(directory, tombstones, now, delete_after)
+
+
+def map_file_name(file_name: str) -> str:
+    """Returns name of the map the file belongs to, also for partial downloads."""
+
+    return file_name[: -len(".tmp")] if file_name.endswith(".tmp") else file_name
+
+
+def maps_disk_usage(directory: Path) -> int:
+    """Returns total size of maps, including the partially downloaded ones."""
+
+    usage = 0
+    for file_path in directory.iterdir():
+        if Path(map_file_name(file_path.name)).suffix in MAP_SUFFIXES:
+            # The file can be deleted meanwhile, e.g. by another syncer process.
+            try:
+                st = file_path.stat()
+            except FileNotFoundError:
+                continue
+            usage += st.st_size
+    return usage
+
+
+class DiskSpace:
+    """Admission of downloads against the disk space limits of a directory.
+
+    Downloads reserve their expected size before they start. When it doesn't
+    fit, tombstoned maps are evicted earliest-first, and when there are no
+    more to evict, the download fails with InsufficientSpaceError.
+
+    With store, the limits apply to the store, which holds the maps' data.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        tombstones: Optional[Tombstones],
+        min_free_space: Optional[int] = None,
+        max_disk_usage: Optional[int] = None,
+        store: Optional[Path] = None,
+    ) -> None:
+        self.directory = directory
+        self.tombstones = tombstones
+        self.min_free_space = min_free_space
+        self.max_disk_usage = max_disk_usage
+        self.store = store
+        # Maps are written to the store when it's used.
+        self.download_directory = store or directory
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._usage = 0
+        if max_disk_usage is not None:
+            self._usage = maps_disk_usage(self.download_directory)
+        self._blobs: Optional[Dict[Tuple[int, int], Path]] = None
+
+    def _shortage(self, size: int) -> int:
+        shortage = 0
+        if self.min_free_space is not None:
+            free = shutil.disk_usage(self.download_directory).free - self._in_flight
+            shortage = max(shortage, self.min_free_space + size - free)
+        if self.max_disk_usage is not None:
+            shortage = max(shortage, self._usage + size - self.max_disk_usage)
+        return shortage
+
+    def _evict(self, size: int) -> None:
+        candidates: List[str] = []
+        if self.tombstones is not None:
+            not_seen_since = self.tombstones.not_seen_since
+            candidates = sorted(not_seen_since, key=not_seen_since.__getitem__)
+        evicted = False
+        while self._shortage(size) > 0:
+            if not candidates:
+                msg = f"Not enough disk space for {size} bytes download"
+                raise InsufficientSpaceError(msg)
+            name = candidates.pop(0)
+            if not self._remove(name):
+                continue
+            logging.info("Evicting %s to free disk space", name)
+            DELETED_FILES.inc()
+            if self.tombstones is not None:
+                self.tombstones.revive(name)
+            evicted = True
+        if evicted and self.tombstones is not None:
+            TOMBSTONES.set(len(self.tombstones))
+            self.tombstones.save()
+
+    def _remove(self, name: str) -> bool:
+        """Removes the map, returns False when it's kept as that frees nothing.
+
+        With store, the map's blob is removed too, and the map is kept when the
+        blob is linked from other maps directories as well.
+        """
+
+        path = self.directory.joinpath(name)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return True
+        blob = None
+        if self.store is not None and st.st_nlink > 1:
+            blob = self._store_blob(st)
+            if blob is None or st.st_nlink > 2:
+                return False
+            blob.unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+        # Usage is of the store, copies of blobs in the directory aren't in it.
+        if self.store is None or blob is not None:
+            self._usage -= st.st_size
+        return True
+
+    def _store_blob(self, st: os.stat_result) -> Optional[Path]:
+        """Returns the store blob the file with given stat is a link of."""
+
+        if self._blobs is None:
+            self._blobs = {}
+            for blob in cast(Path, self.store).iterdir():
+                try:
+                    blob_st = blob.stat()
+                except FileNotFoundError:
+                    continue
+                self._blobs[blob_st.st_dev, blob_st.st_ino] = blob
+        return self._blobs.pop((st.st_dev, st.st_ino), None)
+
+    @contextmanager
+    def reserve(self, size: int, tmp_file: Path) -> Iterator[None]:
+        """Reserves size bytes for the duration of a download to tmp_file.
+
+        When the download fails, the reservation is released and only the
+        bytes it added to tmp_file stay counted, so retries don't accumulate.
+        """
+
+        start_size = tmp_file.stat().st_size if tmp_file.exists() else 0
+        with self._lock:
+            self._evict(size)
+            self._in_flight += size
+            self._usage += size
+        try:
+            yield
+        except BaseException:
+            end_size = tmp_file.stat().st_size if tmp_file.exists() else 0
+            with self._lock:
+                self._usage += end_size - start_size - size
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= size
+
+
+def store_blob_path(store: Path, map_info: LiveMapEntry) -> Path:
+    return store.joinpath(map_info.md5 + Path(map_info.file_name).suffix)
+
+
+def store_tmp_path(blob: Path) -> Path:
+    """Returns path of the temporary file the blob is downloaded to.
+
+    The store can be shared by several syncer processes, so each of them writes
+    to its own file. The map suffix is kept to count it in the disk usage.
+    """
+
+    return blob.with_name(f"{blob.stem}.{os.getpid()}{blob.suffix}.tmp")
+
+
+def link_from_store(blob: Path, destination: Path) -> None:
+    """Atomically replaces the destination with a hardlink to the blob.
+
+    Falls back to copying the blob when it can't be hardlinked, e.g. when the
+    store is on a different filesystem.
+    """
+
+    tmp_destination = Path(f"{destination}.tmp")
+    tmp_destination.unlink(missing_ok=True)
+    try:
+        os.link(blob, tmp_destination)
+    except OSError as e:
+        if e.errno not in {errno.EXDEV, errno.EPERM, errno.EMLINK}:
+            raise
+        logging.warning("Can't hardlink %s, copying it: %s", destination.name, e)
+        shutil.copyfile(blob, tmp_destination)
+    tmp_destination.replace(destination)
+
+
+def download_map(
+    directory: Path,
+    map_info: LiveMapEntry,
+    cancel: Optional[threading.Event] = None,
+    throttle: Optional[TokenBucket] = None,
+    store: Optional[Path] = None,
+    space: Optional[DiskSpace] = None,
+) -> None:
+    """Downloads the map to the directory.
+
+    With store, the map is downloaded to the store unless it's already there,
+    and hardlinked from it.
+    """
+
+    destination = directory.joinpath(map_info.file_name)
+    if store is None:
+        download_file(
+            map_info.download_url, destination, map_info.md5, cancel, throttle, space
+        )
+        return
+
+    blob = store_blob_path(store, map_info)
+    if blob.exists() and destination.exists() and blob.samefile(destination):
+        # The map is downloaded again only when it doesn't match the MD5, so
+        # the blob linked to it is corrupted too.
+        logging.info("Removing corrupted %s from store", blob.name)
+        blob.unlink()
+    if not blob.exists():
+        download_file(
+            map_info.download_url,
+            blob,
+            map_info.md5,
+            cancel,
+            throttle,
+            space,
+            store_tmp_path(blob),
+        )
+    link_from_store(blob, destination)
+
+
+def collect_store_garbage(store: Path, grace: float = STORE_GC_GRACE) -> None:
+    """Deletes blobs from the store that are not linked to any maps directory.
+
+    The store holds one of the links of every blob, so a blob with a single
+    link is unreferenced.
+    """
+
+    if not store.exists():
+        return
+    now = time.time()
+    for blob in store.iterdir():
+        # Other syncer processes sharing the store can delete files meanwhile.
+        try:
+            st = blob.stat()
+        except FileNotFoundError:
+            continue
+        if st.st_nlink == 1 and now - st.st_mtime > grace:
+            logging.info("Deleting %s from store", blob.name)
+            blob.unlink(missing_ok=True)
+            DELETED_FILES.inc()
+
+
+def download_maps(
+    directory: Path,
+    maps: List[LiveMapEntry],
+    concurrency: int,
+    cancel: Optional[threading.Event] = None,
+    throttle: Optional[TokenBucket] = None,
+    store: Optional[Path] = None,
+    space: Optional[DiskSpace] = None,
+    retries: int = 0,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> Dict[str, BaseException]:
+    """Downloads maps to the directory running up to concurrency downloads at once.
+
+    Downloads start in the order of maps and share the throttle. With store,
+    maps are downloaded there and hardlinked to the directory. Transient
+    failures are retried with backoff, and downloads from hosts that keep
+    failing are stopped by the circuit breaker. A failed download doesn't stop
+    the others, failures are logged and returned keyed by the map file name.
+    """
+
+    breaker = circuit_breaker or CircuitBreaker()
+
+    def download(map_info: LiveMapEntry) -> None:
+        if cancel is not None and cancel.is_set():
+            raise SyncCancelledError()
+        logging.info("Downloading %s", map_info.file_name)
+        start = time.monotonic()
+        host = urllib.parse.urlsplit(map_info.download_url).netloc
+        # The breaker records a single outcome of the map after all its retries,
+        # so that one broken map doesn't open the circuit of the whole host.
+        breaker.call(
+            host,
+            lambda: with_retries(
+                lambda: download_map(
+                    directory, map_info, cancel, throttle, store, space
+                ),
+                retries,
+                f"Download of {map_info.file_name}",
+                cancel,
+            ),
+        )
+        DOWNLOAD_DURATION.observe(time.monotonic() - start)
+
+    def add_failure(map_info: LiveMapEntry, e: BaseException) -> None:
+        if not isinstance(e, SyncCancelledError):
+            logging.error("Failed to download %s: %s", map_info.file_name, e)
+        failures[map_info.file_name] = e
+
+    failures: Dict[str, BaseException] = {}
+    if concurrency <= 1:
+        for map_info in maps:
+            try:
+                download(map_info)
+            except Exception as e:
+                add_failure(map_info, e)
+        return failures
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(download, m): m for m in maps}
+        for future in as_completed(futures):
+            exc = future.exception()
+            if exc is not None:
+                add_failure(futures[future], exc)
+    return failures
+
+
+def remote_size(url: str) -> Optional[int]:
+    """Returns size of the file at the URL without downloading all of it."""
+
+    with HTTP_POOL.get(url, {"User-Agent": USER_AGENT, "Range": "bytes=0-0"}) as res:
+        raise_for_status(url, res)
+        if res.status == 206:
+            content_range = parse_content_range(res.getheader("Content-Range"))
+            if content_range is not None:
+                return content_range[1]
+            return None
+        content_length = res.getheader("Content-Length")
+        return int(content_length) if content_length else None
+
+
+def probe_sizes(
+    maps: List[LiveMapEntry],
+    cancel: Optional[threading.Event] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> Dict[str, Optional[int]]:
+    """Returns sizes of the maps keyed by file name, None when unknown.
+
+    Sizes are probed concurrently. Hosts with open circuit aren't probed, and
+    failed probes aren't retried, leaving the size unknown. Raises
+    SyncCancelledError when cancel was set during the probes.
+    """
+
+    def probe(map_info: LiveMapEntry) -> Optional[int]:
+        if cancel is not None and cancel.is_set():
+            raise SyncCancelledError()
+        host = urllib.parse.urlsplit(map_info.download_url).netloc
+        if circuit_breaker is not None and circuit_breaker.is_open(host):
+            return None
+        try:
+            return remote_size(map_info.download_url)
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            logging.debug("Failed to get size of %s: %s", map_info.file_name, e)
+            return None
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=SIZE_PROBE_CONCURRENCY) as executor:
+        sizes = list(executor.map(probe, maps))
+    return {m.file_name: size for m, size in zip(maps, sizes)}
+
+
+def order_downloads(
+    maps: List[LiveMapEntry],
+    live_maps: List[LiveMapEntry],
+    order: str,
+    cancel: Optional[threading.Event] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> List[LiveMapEntry]:
+    """Sorts maps in the order they should be downloaded in.
+
+    The "list" order follows the live maps list, "smallest" downloads the
+    smallest maps first so that most maps become available early. Maps with
+    unknown size go last. When more than MAX_SIZE_PROBES maps are to be
+    downloaded, e.g. on a fresh node, sizes aren't probed and the list order
+    is used.
+    """
+
+    position = {m.file_name: i for i, m in enumerate(live_maps)}
+
+    def position_key(map_info: LiveMapEntry) -> int:
+        return position.get(map_info.file_name, len(position))
+
+    by_position = sorted(maps, key=position_key)
+    if order != "smallest" or len(maps) < 2:
+        return by_position
+    if len(maps) > MAX_SIZE_PROBES:
+        logging.info("Too many maps to download to probe sizes, using list order")
+        return by_position
+
+    sizes = probe_sizes(by_position, cancel, circuit_breaker)
+
+    def size_key(map_info: LiveMapEntry) -> Tuple[bool, int]:
+        size = sizes[map_info.file_name]
+        return size is None, size or 0
+
+    return sorted(by_position, key=size_key)
+
+
+def download_and_record(
+    directory: Path,
+    maps: List[LiveMapEntry],
+    live_maps: List[LiveMapEntry],
+    manifest: Manifest,
+    options: SyncOptions,
+    cancel: Optional[threading.Event],
+    tombstones: Optional[Tombstones] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> Dict[str, BaseException]:
+    """Downloads maps and records the successfully downloaded ones in manifest.
+
+    Tombstoned maps are evicted when needed to fit the downloads into the disk
+    space limits. Raises SyncCancelledError when cancel was set during the
+    downloads.
+    """
+
+    throttle: Optional[TokenBucket] = None
+    if options.max_download_rate is not None:
+        throttle = TokenBucket(options.max_download_rate)
+    if options.store is not None and maps:
+        options.store.mkdir(parents=True, exist_ok=True)
+    space: Optional[DiskSpace] = None
+    if maps and (
+        options.min_free_space is not None or options.max_disk_usage is not None
+    ):
+        space = DiskSpace(
+            directory,
+            tombstones,
+            options.min_free_space,
+            options.max_disk_usage,
+            options.store,
+        )
+    maps = order_downloads(
+        maps, live_maps, options.download_order, cancel, circuit_breaker
+    )
+    failures = download_maps(
+        directory,
+        maps,
+        options.download_concurrency,
+        cancel,
+        throttle,
+        options.store,
+        space,
+        options.retries,
+        circuit_breaker,
+    )
+    for map_info in maps:
+        if map_info.file_name not in failures:
+            manifest.record(directory.joinpath(map_info.file_name), map_info.md5)
+    if failures:
+        logging.warning(
+            "Downloaded %d of %d maps to %s",
+            len(maps) - len(failures),
+            len(maps),
+            directory,
+        )
+    if cancel is not None and cancel.is_set():
+        manifest.save()
+        raise SyncCancelledError()
+    return failures
+
+
+def find_missing_maps(
+    directory: Path,
+    live_maps: List[LiveMapEntry],
+    manifest: Manifest,
+    verify: bool,
+    dirty: Optional[Set[str]] = None,
+) -> List[LiveMapEntry]:
+    """Returns live maps that are not in the directory.
+
+    In verify mode, also the ones that don't match the MD5 from the live list.
+    Dirty files are verified also outside of the verify mode.
+    """
+
+    missing_maps: List[LiveMapEntry] = []
+    for map_info in live_maps:
+        file_path = directory.joinpath(map_info.file_name)
+        if not verify and (dirty is None or map_info.file_name not in dirty):
+            if not file_path.exists():
+                missing_maps.append(map_info)
+            continue
+        md5 = manifest.verified_md5(file_path)
+        if md5 != map_info.md5:
+            if md5 is not None:
+                logging.warning("%s doesn't match live MD5", map_info.file_name)
+            missing_maps.append(map_info)
+    return missing_maps
+
+
+@dataclass
+class LiveMapsDiff:
+    added: List[LiveMapEntry]
+    removed: List[str]
+    changed: List[LiveMapEntry]
+    # Files changed on disk since the last sync.
+    dirty: Set[str] = field(default_factory=set)
+
+
+def diff_live_maps(
+    old: Dict[str, LiveMapEntry], new: List[LiveMapEntry]
+) -> LiveMapsDiff:
+    """Computes changes between the previously synced and the new live list.
+
+    Maps are matched by file name, and are changed when their MD5 differs.
+    """
+
+    diff = LiveMapsDiff([], [], [])
+    for map_info in new:
+        old_info = old.get(map_info.file_name)
+        if old_info is None:
+            diff.added.append(map_info)
+        elif old_info.md5 != map_info.md5:
+            diff.changed.append(map_info)
+    new_files = {map_info.file_name for map_info in new}
+    diff.removed = [name for name in old if name not in new_files]
+    return diff
+
+
+def load_synced_maps(directory: Path) -> Optional[Dict[str, LiveMapEntry]]:
+    """Loads the live maps list stored by the last successful sync."""
+
+    path = directory.joinpath(SYNCED_MAPS_FILE)
+    if not path.exists():
+        return None
+    try:
+        with path.open() as f:
+            data: List[Dict[str, str]] = json.load(f)
+        return {m.file_name: m for m in parse_live_maps(data)}
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning("Ignoring corrupted %s: %s", path, e)
+        return None
+
+
+def full_sync_files(
+    directory: Path,
+    live_maps: List[LiveMapEntry],
+    diff: LiveMapsDiff,
+    delete_after: int,
+    options: SyncOptions,
+    cancel: Optional[threading.Event] = None,
+    tombstones: Optional[Tombstones] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> Tuple[Dict[str, BaseException], Optional[float]]:
+    """Reconciles the whole directory with the live maps list.
+
+    Returns failed downloads and the time when the next tombstone expires.
+    """
+
+    # Tombstones are updated first, so that the maps that left the live list
+    # can be evicted to make space for the downloads.
+    next_deletion_at = delete_stale_files(
+        directory, live_maps, delete_after, tombstones
+    )
+
+    manifest = Manifest(directory.joinpath(MANIFEST_FILE))
+    maps = find_missing_maps(directory, live_maps, manifest, options.verify, diff.dirty)
+    # Maps that changed on the live list have to be downloaded again even if
+    # the file is already there.
+    missing_files = {map_info.file_name for map_info in maps}
+    maps.extend(m for m in diff.changed if m.file_name not in missing_files)
+    failures = download_and_record(
+        directory,
+        maps,
+        live_maps,
+        manifest,
+        options,
+        cancel,
+        tombstones,
+        circuit_breaker,
+    )
+    manifest.retain({map_info.file_name for map_info in live_maps})
+    manifest.save()
+
+    if tombstones is not None and delete_after >= 0:
+        # Evictions could have removed the earliest tombstones.
+        next_deletion_at = tombstones.next_deletion_time(delete_after)
+    # Deleting maps only drops their links, blobs are reclaimed once no maps
+    # directory references them.
+    if options.store is not None and delete_after >= 0:
+        collect_store_garbage(options.store)
+    return failures, next_deletion_at
 
-    tmp_destination = Path(f"{destination}.tmp")
-    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-    res: HTTPResponse
-    with urllib.request.urlopen(req) as res, tmp_destination.open("wb") as f:
-        shutil.copyfileobj(res, f)
-        f.flush()
-        os.fsync(f.fileno())
-    if not md5_match(tmp_destination, md5):
-        msg = f"MD5 mismatch when validating {destination}"
-        raise RuntimeError(msg)
-    tmp_destination.replace(destination)
 
+def incremental_sync_files(
+    directory: Path,
+    live_maps: List[LiveMapEntry],
+    diff: LiveMapsDiff,
+    delete_after: int,
+    options: SyncOptions,
+    next_deletion_at: Optional[float],
+    cancel: Optional[threading.Event] = None,
+    tombstones: Optional[Tombstones] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+) -> Tuple[Dict[str, BaseException], Optional[float]]:
+    """Applies the live maps diff to the directory without scanning it.
 
-def md5_match(file_path: Path, expected_md5: str) -> bool:
-    """Checks the MD5 checksum of a file."""
+    Returns failed downloads and the time when the next tombstone expires.
+    """
 
-    hasher = hashlib.md5()
-    with file_path.open("rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest() == expected_md5
+    if (
+        diff.added
+        or diff.removed
+        or (next_deletion_at is not None and time.time() > next_deletion_at)
+    ):
+        next_deletion_at = update_tombstones(
+            directory,
+            delete_after,
+            buried=diff.removed,
+            revived=[map_info.file_name for map_info in diff.added],
+            tombstones=tombstones,
+        )
 
+    maps = [m for m in diff.added if not directory.joinpath(m.file_name).exists()]
+    maps.extend(diff.changed)
+    manifest: Optional[Manifest] = None
+    if diff.dirty:
+        manifest = Manifest(directory.joinpath(MANIFEST_FILE))
+        queued = {m.file_name for m in maps}
+        dirty_maps = [m for m in live_maps if m.file_name in diff.dirty - queued]
+        maps.extend(find_missing_maps(directory, dirty_maps, manifest, verify=True))
+    failures: Dict[str, BaseException] = {}
+    if maps or diff.removed:
+        if manifest is None:
+            manifest = Manifest(directory.joinpath(MANIFEST_FILE))
+        failures = download_and_record(
+            directory,
+            maps,
+            live_maps,
+            manifest,
+            options,
+            cancel,
+            tombstones,
+            circuit_breaker,
+        )
+        manifest.retain({map_info.file_name for map_info in live_maps})
+        if tombstones is not None and delete_after >= 0:
+            next_deletion_at = tombstones.next_deletion_time(delete_after)
+    if manifest is not None:
+        manifest.save()
+    return failures, next_deletion_at
 
-def sync_files(directory: Path, url: str, delete_after: int) -> None:
-    live_maps = fetch_live_maps(url)
 
-    # Download the maps that are not in the directory
-    for map_info in live_maps:
-        file_path = directory.joinpath(map_info.file_name)
-        if not file_path.exists():
-            logging.info("Downloading %s", map_info.file_name)
-            download_file(map_info.download_url, file_path, map_info.md5)
+def fetch_live_maps_diff(
+    directory: Path, url: str, state: SyncState, retries: int = 0
+) -> Tuple[List[LiveMapEntry], LiveMapsDiff]:
+    """Fetches the live maps list and diffs it with the last synced one.
 
-    # Skip deletion if it's disabled
-    if delete_after < 0:
-        return
+    The fetch is skipped when the cached list is known to be current.
+    """
 
-    # Load tombstones file if it exists.
-    tombstones_file = directory.joinpath("tombstones.json")
-    not_seen_since: Dict[str, int] = {}
-    if tombstones_file.exists():
-        with tombstones_file.open() as f:
-            not_seen_since = json.load(f)
-            logging.debug("Loaded tombstones from file")
+    cache = state.live_maps_cache
+    live_maps = None
+    if cache.current:
+        logging.debug("Live maps are current as of commit %s", cache.commit)
+    else:
+        live_maps = with_retries(
+            lambda: fetch_live_maps(url, cache),
+            retries,
+            "Fetch of live maps",
+            state.cancel,
+        )
+    if live_maps is None:
+        live_maps = cache.live_maps
+    diff = diff_live_maps(state.synced_maps or {}, live_maps)
+    if state.dirty_files is not None:
+        # Set before the sync deletes maps that left the list.
+        state.dirty_files.set_live(directory, {m.file_name for m in live_maps})
+        diff.dirty = state.dirty_files.get(directory)
+        if diff.dirty:
+            logging.info("Checking %d files changed on disk", len(diff.dirty))
+    logging.info(
+        "Live maps diff: %d added, %d removed, %d changed",
+        len(diff.added),
+        len(diff.removed),
+        len(diff.changed),
+    )
+    return live_maps, diff
 
-    live_map_files = {file_info.file_name for file_info in live_maps}
 
-    # Delete files that are not seen for long enough and rebuild the tombstones
-    new_not_seen_since: Dict[str, int] = {}
-    for file_path in directory.iterdir():
-        if file_path.name in live_map_files or file_path.suffix not in {
-            ".sd7",
-            ".sdz",
-            ".tmp",
-        }:
-            continue
+def sync_files(
+    directory: Path,
+    url: str,
+    delete_after: int,
+    options: Optional[SyncOptions] = None,
+    state: Optional[SyncState] = None,
+) -> None:
+    """Syncs the directory with the live maps list from the URL.
 
-        t = not_seen_since.get(file_path.name, int(time.time()))
-        if time.time() - t > delete_after:
-            logging.info("Deleting %s", file_path.name)
-            file_path.unlink()
-        else:
-            new_not_seen_since[file_path.name] = t
-            logging.debug("Tombstone %s", file_path.name)
+    With the state from the previous sync passed, only the maps that changed
+    on the live list since then are synced. The whole directory is reconciled
+    every options.full_sync_every syncs, and when it was modified outside of
+    the syncer.
+    """
+
+    if options is None:
+        options = SyncOptions()
+    if state is None:
+        state = SyncState()
+    if state.synced_maps is None:
+        state.synced_maps = load_synced_maps(directory)
+    if state.tombstones is None:
+        state.tombstones = Tombstones(directory.joinpath(TOMBSTONES_FILE))
+    live_maps, diff = fetch_live_maps_diff(directory, url, state, options.retries)
+
+    full_sync = (
+        options.verify
+        or state.synced_maps is None
+        or state.incremental_syncs >= options.full_sync_every - 1
+        or state.directory_mtime_ns != directory.stat().st_mtime_ns
+    )
+    state.directory_mtime_ns = None
+    if full_sync:
+        logging.info("Running full sync")
+        failures, state.next_deletion_at = full_sync_files(
+            directory,
+            live_maps,
+            diff,
+            delete_after,
+            options,
+            state.cancel,
+            state.tombstones,
+            state.circuit_breaker,
+        )
+        state.incremental_syncs = 0
+    else:
+        failures, state.next_deletion_at = incremental_sync_files(
+            directory,
+            live_maps,
+            diff,
+            delete_after,
+            options,
+            state.next_deletion_at,
+            state.cancel,
+            state.tombstones,
+            state.circuit_breaker,
+        )
+        state.incremental_syncs += 1
 
-    # Save tombstones file if it changed
-    if not_seen_since != new_not_seen_since:
-        with tombstones_file.open("w") as f:
-            json.dump(new_not_seen_since, f)
+    if failures:
+        msg = f"Failed to download {len(failures)} maps: {', '.join(sorted(failures))}"
+        raise SyncError(msg)
+    if state.dirty_files is not None:
+        state.dirty_files.discard(directory, diff.dirty)
+    if state.synced_maps is None or diff.added or diff.removed or diff.changed:
+        write_json_atomic(
+            directory.joinpath(SYNCED_MAPS_FILE),
+            [live_map_to_json(map_info) for map_info in live_maps],
+        )
+        state.synced_maps = {map_info.file_name: map_info for map_info in live_maps}
+    state.directory_mtime_ns = directory.stat().st_mtime_ns
 
 
 class SyncOp(Enum):
@@ -188,16 +2269,78 @@ else:
     SyncQueue = queue.Queue
 
 
+class SyncTriggerSink(Protocol):
+    """Destination of sync triggers, implemented by SyncQueue and AsyncSyncQueue.
+
+    Trigger sources push to it from their own threads or signal handlers.
+    """
+
+    def put(self, item: Tuple[SyncOp, str]) -> None:
+        ...
+
+
+class AsyncSyncQueue:
+    """Queue of sync triggers consumed by async_polling_sync."""
+
+    def __init__(self, loop: "asyncio.AbstractEventLoop") -> None:
+        import asyncio
+
+        self._loop = loop
+        self._queue: "asyncio.Queue[Tuple[SyncOp, str]]" = asyncio.Queue()
+
+    def put(self, item: Tuple[SyncOp, str]) -> None:
+        """Pushes the trigger, it's safe to call from any thread."""
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    async def get(self) -> Tuple[SyncOp, str]:
+        return await self._queue.get()
+
+    def drain(self, item: Tuple[SyncOp, str]) -> Tuple[SyncOp, str]:
+        """Drains queued triggers the same way as polling_sync does.
+
+        Returns STOP trigger if there was any, or the last received trigger.
+        """
+
+        import asyncio
+
+        while item[0] != SyncOp.STOP:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        return item
+
+
+class CountingSyncTriggerSink:
+    """Counts triggers by their source before passing them on to the sink."""
+
+    def __init__(self, sink: SyncTriggerSink) -> None:
+        self._sink = sink
+
+    def put(self, item: Tuple[SyncOp, str]) -> None:
+        TRIGGERS.inc(source=item[1])
+        self._sink.put(item)
+
+
 @contextmanager
 def mqtt_sync_trigger(
-    mqtt_config: MQTTConfig, sync_trigger: SyncQueue
+    mqtt_config: MQTTConfig,
+    sync_trigger: SyncTriggerSink,
+    announcements: Optional[LiveMapsAnnouncements] = None,
 ) -> Iterator[None]:
-    """Pushes SYNC trigger to the queue when a message is received on the MQTT topic."""
+    """Pushes SYNC trigger to the queue when a message is received on the MQTT topic.
+
+    Live maps updates carried by the messages are passed to announcements.
+    """
+
+    import paho.mqtt.client as mqtt
 
     def on_mqtt_message(
         client: mqtt.Client, userdata: None, msg: mqtt.MQTTMessage
     ) -> None:
         if msg.topic == mqtt_config.topic:
+            if announcements is not None:
+                announcements.announce(parse_announced_commit(msg.payload))
             sync_trigger.put((SyncOp.SYNC, "MQTT"))
 
     def on_mqtt_connect(
@@ -224,7 +2367,9 @@ def mqtt_sync_trigger(
 
 
 @contextmanager
-def timer_sync_trigger(interval: float, sync_trigger: SyncQueue) -> Iterator[None]:
+def timer_sync_trigger(
+    interval: float, sync_trigger: SyncTriggerSink
+) -> Iterator[None]:
     """Pushes SYNC trigger to the queue every interval seconds."""
 
     lock = threading.Lock()
@@ -256,8 +2401,170 @@ class TerminateException(BaseException):
     pass
 
 
+def inotify_watch(directories: List[Path]) -> Optional[Tuple[int, Dict[int, Path]]]:
+    """Starts inotify watch of maps modified or deleted in the directories.
+
+    Returns the inotify file descriptor and watched directories by watch
+    descriptor, or None when inotify isn't available.
+    """
+
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_init1 = cast(Callable[[int], int], libc.inotify_init1)
+        inotify_add_watch = cast(
+            Callable[[int, bytes, int], int], libc.inotify_add_watch
+        )
+    except (OSError, AttributeError) as e:
+        logging.warning("inotify is not available: %s", e)
+        return None
+    fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        logging.warning("inotify_init1 failed: %s", os.strerror(ctypes.get_errno()))
+        return None
+    watches: Dict[int, Path] = {}
+    for directory in directories:
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_DELETE
+        wd = inotify_add_watch(fd, os.fsencode(directory), mask)
+        if wd < 0:
+            logging.warning(
+                "Failed to watch %s: %s", directory, os.strerror(ctypes.get_errno())
+            )
+            os.close(fd)
+            return None
+        watches[wd] = directory
+    return fd, watches
+
+
+def parse_inotify_events(data: bytes) -> Iterator[Tuple[int, int, str]]:
+    """Yields watch descriptor, mask and file name of the read inotify events."""
+
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        wd, mask, _, length = cast(
+            Tuple[int, int, int, int], INOTIFY_EVENT.unpack_from(data, offset)
+        )
+        offset += INOTIFY_EVENT.size
+        name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+        offset += length
+        yield wd, mask, name
+
+
+def snapshot_maps(directories: List[Path]) -> Dict[Tuple[Path, str], Tuple[int, int]]:
+    """Returns size and modification time of maps in the directories."""
+
+    snapshot: Dict[Tuple[Path, str], Tuple[int, int]] = {}
+    for directory in directories:
+        try:
+            for file_path in directory.iterdir():
+                if file_path.suffix in MAP_SUFFIXES:
+                    st = file_path.stat()
+                    snapshot[directory, file_path.name] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return snapshot
+
+
+def inotify_changes(
+    fd: int, watches: Dict[int, Path], stop_fd: int
+) -> Iterator[Set[Tuple[Path, str]]]:
+    """Yields batches of files changed in the watched directories until stopped."""
+
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    poller.register(stop_fd, select.POLLIN)
+    while True:
+        ready = {event_fd for event_fd, _ in poller.poll()}
+        if stop_fd in ready:
+            return
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            continue
+        changed: Set[Tuple[Path, str]] = set()
+        for wd, mask, name in parse_inotify_events(data):
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, checking all maps")
+                changed.update(snapshot_maps(list(watches.values())))
+            elif wd in watches:
+                changed.add((watches[wd], name))
+        yield changed
+
+
+def polling_changes(
+    directories: List[Path], stop: threading.Event, poll_interval: float
+) -> Iterator[Set[Tuple[Path, str]]]:
+    """Yields batches of maps modified or deleted between polls until stop is set.
+
+    New files are not reported, they are most likely downloaded by the syncer
+    itself.
+    """
+
+    snapshot = snapshot_maps(directories)
+    while not stop.wait(poll_interval):
+        new_snapshot = snapshot_maps(directories)
+        yield {f for f, stat in snapshot.items() if new_snapshot.get(f) != stat}
+        snapshot = new_snapshot
+
+
+@contextmanager
+def fs_watch_sync_trigger(
+    directories: List[Path],
+    sync_trigger: SyncTriggerSink,
+    dirty_files: DirtyFiles,
+    poll_interval: float = DEFAULT_WATCH_POLL_INTERVAL,
+) -> Iterator[None]:
+    """Pushes SYNC trigger when maps are modified or deleted in the directories.
+
+    The affected files are added to dirty_files so that the sync checks just
+    them. Uses inotify, and falls back to comparing snapshots of the
+    directories every poll_interval seconds where it's not available.
+    """
+
+    stop = threading.Event()
+    stop_read, stop_write = os.pipe()
+    inotify = inotify_watch(directories)
+    changes: Iterator[Set[Tuple[Path, str]]]
+    if inotify is not None:
+        changes = inotify_changes(inotify[0], inotify[1], stop_read)
+    else:
+        logging.info("Watching maps directories by polling")
+        changes = polling_changes(directories, stop, poll_interval)
+
+    def watch() -> None:
+        for changed in changes:
+            maps = [
+                (d, name) for d, name in changed if Path(name).suffix in MAP_SUFFIXES
+            ]
+            dirty = False
+            for directory, name in maps:
+                if dirty_files.add(directory, name):
+                    logging.debug("%s changed on disk", directory / name)
+                    dirty = True
+            if dirty:
+                sync_trigger.put((SyncOp.SYNC, "filesystem"))
+
+    t = threading.Thread(target=watch)
+    t.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+        os.write(stop_write, b"\0")
+        t.join()
+        os.close(stop_read)
+        os.close(stop_write)
+        if inotify is not None:
+            os.close(inotify[0])
+
+
 @contextmanager
-def signal_sync_trigger(sync_trigger: SyncQueue) -> Iterator[None]:
+def signal_sync_trigger(sync_trigger: SyncTriggerSink) -> Iterator[None]:
     """Pushes STOP trigger to the queue when SIGINT or SIGTERM is received."""
     first_signal = True
 
@@ -281,15 +2588,194 @@ def signal_sync_trigger(sync_trigger: SyncQueue) -> Iterator[None]:
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 
+@contextmanager
+def sync_triggers(
+    sync_trigger: SyncTriggerSink,
+    polling_interval: float,
+    mqtt_config: Optional[MQTTConfig],
+    watch_directories: Optional[List[Path]] = None,
+    dirty_files: Optional[DirtyFiles] = None,
+    announcements: Optional[LiveMapsAnnouncements] = None,
+) -> Iterator[None]:
+    """Runs all the configured sync trigger sources.
+
+    Directories are watched for changes only when dirty_files is passed.
+    """
+
+    sync_trigger = CountingSyncTriggerSink(sync_trigger)
+    mqtt_ctx: ContextManager[None] = nullcontext()
+    if mqtt_config is not None:
+        mqtt_ctx = mqtt_sync_trigger(mqtt_config, sync_trigger, announcements)
+    watch_ctx: ContextManager[None] = nullcontext()
+    if watch_directories is not None and dirty_files is not None:
+        watch_ctx = fs_watch_sync_trigger(watch_directories, sync_trigger, dirty_files)
+    timer_ctx = timer_sync_trigger(polling_interval, sync_trigger)
+    with signal_sync_trigger(sync_trigger), mqtt_ctx, watch_ctx, timer_ctx:
+        yield
+
+
+def new_sync_states(
+    directories: List[Path],
+    dirty_files: Optional[DirtyFiles] = None,
+    announcements: Optional[LiveMapsAnnouncements] = None,
+) -> Dict[Path, SyncState]:
+    """Creates states of directories synced together.
+
+    The states share the live maps cache, so the list is downloaded only once
+    per sync, the cancel event, dirty files, and the circuit breaker.
+    """
+
+    cache = LiveMapsCache(announcements=announcements)
+    cancel = threading.Event()
+    breaker = CircuitBreaker()
+    return {
+        d: SyncState(
+            live_maps_cache=cache,
+            cancel=cancel,
+            dirty_files=dirty_files,
+            circuit_breaker=breaker,
+        )
+        for d in directories
+    }
+
+
+def sync_directories(
+    states: Dict[Path, SyncState],
+    url: str,
+    delete_after: int,
+    options: Optional[SyncOptions],
+) -> bool:
+    """Syncs all the directories, returns whether all of them succeeded.
+
+    Commits of the live maps list announced since the last sync are checked
+    against the shared live maps cache first, possibly sparing its fetch.
+    """
+
+    caches = {id(s.live_maps_cache): s.live_maps_cache for s in states.values()}
+    for cache in caches.values():
+        if cache.announcements is not None:
+            commits = cache.announcements.take()
+            cache.current = is_live_maps_cache_current(cache, commits)
+    failed = 0
+    try:
+        for directory, state in states.items():
+            try:
+                sync_files(directory, url, delete_after, options, state)
+            except SyncCancelledError:
+                raise
+            except Exception:
+                logging.exception("Error while syncing maps in %s", directory)
+                failed += 1
+    finally:
+        for cache in caches.values():
+            cache.current = False
+    if failed:
+        logging.error("Sync failed in %d of %d directories", failed, len(states))
+    return failed == 0
+
+
+def run_sync(
+    states: Dict[Path, SyncState],
+    url: str,
+    delete_after: int,
+    healthcheck_url: Optional[str],
+    options: Optional[SyncOptions],
+    msg: str,
+) -> bool:
+    """Runs a single sync of all directories triggered by msg logging all errors.
+
+    Failed sync is reported to the /fail variant of the healthcheck URL.
+    Returns whether the sync succeeded.
+    """
+
+    logging.info("Syncing maps (%s)", msg)
+    start = time.time()
+    try:
+        if not sync_directories(states, url, delete_after, options):
+            SYNCS.inc(result="failure")
+            if healthcheck_url is not None:
+                send_healthcheck(healthcheck_url.rstrip("/") + "/fail")
+            return False
+        logging.info("Synced maps in %f seconds", time.time() - start)
+        SYNCS.inc(result="success")
+        LAST_SUCCESS.set(time.time())
+        if healthcheck_url is not None:
+            send_healthcheck(healthcheck_url)
+        return True
+    except SyncCancelledError:
+        logging.info("Sync cancelled")
+        SYNCS.inc(result="cancelled")
+    except Exception:
+        logging.exception("Error while syncing maps")
+        SYNCS.inc(result="failure")
+        if healthcheck_url is not None:
+            send_healthcheck(healthcheck_url.rstrip("/") + "/fail")
+    finally:
+        SYNC_DURATION.observe(time.time() - start)
+    return False
+
+
+@dataclass
+class SyncSchedule:
+    """Coalesces sync triggers into a sync started after a delay.
+
+    The delay is given by options debounce, start_jitter and min_sync_interval.
+    Times are on a monotonic clock.
+    """
+
+    options: SyncOptions
+    pending: Optional[str] = None
+    start: float = 0
+    last_start: Optional[float] = None
+
+    def trigger(self, msg: str, now: float) -> None:
+        if self.pending is None:
+            self.start = now + self.options.debounce
+            self.start += random.uniform(0, self.options.start_jitter)
+            if self.last_start is not None:
+                self.start = max(
+                    self.start, self.last_start + self.options.min_sync_interval
+                )
+        self.pending = msg
+
+    def delay(self, now: float, running: bool = False) -> Optional[float]:
+        """Returns seconds until the sync start.
+
+        Returns None if there is no sync pending, or the previous sync is still
+        running.
+        """
+
+        if self.pending is None or running:
+            return None
+        return max(0, self.start - now)
+
+    def take(self, now: float) -> str:
+        """Starts the pending sync, returns message of its last trigger."""
+
+        assert self.pending is not None
+        msg, self.pending = self.pending, None
+        self.last_start = now
+        return msg
+
+
 def polling_sync(
-    directory: Path,
+    directories: List[Path],
     url: str,
     delete_after: int,
     sync_trigger: SyncQueue,
     healthcheck_url: Optional[str] = None,
+    options: Optional[SyncOptions] = None,
+    dirty_files: Optional[DirtyFiles] = None,
+    announcements: Optional[LiveMapsAnnouncements] = None,
 ) -> None:
-    """Syncs maps in a loop triggered by queue until STOP is received."""
+    """Syncs maps in a loop triggered by queue until STOP is received.
+
+    Triggers received until the sync start, delayed according to the
+    options, are coalesced into a single sync.
+    """
 
+    states = new_sync_states(directories, dirty_files, announcements)
+    schedule = SyncSchedule(options or SyncOptions())
     while True:
         op, msg = sync_trigger.get()
         # Drain the queue because it doesn't make sense to sync multiple
@@ -298,24 +2784,113 @@ def polling_sync(
             if op == SyncOp.STOP:
                 logging.info("Stopped sync (trigger: %s)", msg)
                 return
+            schedule.trigger(msg, time.monotonic())
             try:
-                op, msg = sync_trigger.get_nowait()
+                op, msg = sync_trigger.get(timeout=schedule.delay(time.monotonic()))
             except queue.Empty:
                 break
-        logging.info("Syncing maps (%s)", msg)
-        try:
-            start = time.time()
-            sync_files(directory, url, delete_after)
-            logging.info("Synced maps in %f seconds", time.time() - start)
-            if healthcheck_url is not None:
-                send_healthcheck(healthcheck_url)
-        except Exception:
-            logging.exception("Error while syncing maps")
+        msg = schedule.take(time.monotonic())
+        run_sync(states, url, delete_after, healthcheck_url, options, msg)
+
+
+async def async_polling_sync(
+    directories: List[Path],
+    url: str,
+    delete_after: int,
+    sync_trigger: AsyncSyncQueue,
+    healthcheck_url: Optional[str] = None,
+    options: Optional[SyncOptions] = None,
+    dirty_files: Optional[DirtyFiles] = None,
+    announcements: Optional[LiveMapsAnnouncements] = None,
+) -> None:
+    """Syncs maps in a loop triggered by queue until STOP is received.
+
+    Unlike polling_sync, triggers are handled also while sync is in progress.
+    STOP cancels the in-flight downloads, and SYNC triggers received during a
+    sync, or until the sync start delayed according to the options, are
+    coalesced into a single sync started after it finishes.
+    """
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    loop = asyncio.get_running_loop()
+    states = new_sync_states(directories, dirty_files, announcements)
+    cancel = next(iter(states.values())).cancel
+    # Sync is blocking, so it's running in a worker thread.
+    executor = ThreadPoolExecutor(max_workers=1)
+    sync: "Optional[asyncio.Future[bool]]" = None
+    get: "Optional[asyncio.Future[Tuple[SyncOp, str]]]" = None
+    schedule = SyncSchedule(options or SyncOptions())
+    try:
+        while True:
+            delay = schedule.delay(loop.time(), running=sync is not None)
+            if delay == 0:
+                delay = None
+                cancel.clear()
+                sync = loop.run_in_executor(
+                    executor,
+                    run_sync,
+                    states,
+                    url,
+                    delete_after,
+                    healthcheck_url,
+                    options,
+                    schedule.take(loop.time()),
+                )
+            if get is None:
+                get = asyncio.ensure_future(sync_trigger.get())
+            waiting = [cast("asyncio.Future[object]", get)]
+            if sync is not None:
+                waiting.append(cast("asyncio.Future[object]", sync))
+            await asyncio.wait(
+                waiting, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            if sync is not None and sync.done():
+                sync = None
+            if not get.done():
+                continue
+            op, msg = sync_trigger.drain(get.result())
+            get = None
+            if op == SyncOp.STOP:
+                if sync is not None:
+                    logging.info("Cancelling sync in progress")
+                    cancel.set()
+                    await sync
+                logging.info("Stopped sync (trigger: %s)", msg)
+                return
+            schedule.trigger(msg, loop.time())
+    finally:
+        cancel.set()
+        if get is not None:
+            get.cancel()
+        executor.shutdown(wait=False)
 
 
-def main(argv: List[str]) -> None:
+def parse_size(value: str) -> int:
+    """Parses size in bytes with optional K, M, G or T binary suffix."""
+
+    suffix = value[-1:].upper()
+    multiplier = SIZE_SUFFIXES.get(suffix, 1)
+    number = value[:-1] if suffix in SIZE_SUFFIXES else value
+    try:
+        size = int(float(number) * multiplier)
+    except ValueError:
+        msg = f"invalid size: {value!r}"
+        raise argparse.ArgumentTypeError(msg) from None
+    if size <= 0:
+        msg = f"size must be positive: {value!r}"
+        raise argparse.ArgumentTypeError(msg)
+    return size
+
+
+def main(argv: List[str]) -> int:
     parser = argparse.ArgumentParser(description="Sync live maps to directory.")
-    parser.add_argument("maps_directory", help="Directory where the maps are stored")
+    parser.add_argument(
+        "maps_directory",
+        nargs="+",
+        help="Directories where the maps are stored, all are synced by this process",
+    )
     parser.add_argument(
         "--log-level",
         metavar="LEVEL",
@@ -397,11 +2972,176 @@ def main(argv: List[str]) -> None:
         ),
         default=None,
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        help=(
+            "Verify MD5 of maps already in the directory and download again the "
+            "ones that don't match. Only files that changed since the last "
+            "verification are rehashed."
+        ),
+    )
+    parser.add_argument(
+        "--full-sync-every",
+        type=int,
+        metavar="N",
+        default=DEFAULT_FULL_SYNC_EVERY,
+        help=(
+            "Reconcile the whole directory every N syncs, other syncs only "
+            "apply changes of the live list. Set to 1 to always run full sync. "
+            f"Default: {DEFAULT_FULL_SYNC_EVERY}"
+        ),
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        default=False,
+        help=(
+            "Run sync loop on asyncio event loop, which allows to cancel "
+            "in-flight downloads when stopping"
+        ),
+    )
+    parser.add_argument(
+        "--download-concurrency",
+        type=int,
+        metavar="N",
+        default=DEFAULT_DOWNLOAD_CONCURRENCY,
+        help=(
+            "Maximum number of maps downloaded at the same time. "
+            f"Default: {DEFAULT_DOWNLOAD_CONCURRENCY}"
+        ),
+    )
+    parser.add_argument(
+        "--max-download-rate",
+        type=parse_size,
+        metavar="BYTES",
+        default=None,
+        help=(
+            "Maximum total download rate in bytes per second, accepts K, M and G "
+            "suffixes, e.g. 5M. Default: unlimited"
+        ),
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        metavar="N",
+        default=DEFAULT_RETRIES,
+        help=(
+            "Number of retries of failed downloads and live maps list fetches. "
+            f"Default: {DEFAULT_RETRIES}"
+        ),
+    )
+    parser.add_argument(
+        "--download-order",
+        choices=DOWNLOAD_ORDERS,
+        default=DEFAULT_DOWNLOAD_ORDER,
+        help=(
+            "Order of downloads: 'list' follows the live maps list, 'smallest' "
+            "downloads the smallest maps first. "
+            f"Default: {DEFAULT_DOWNLOAD_ORDER}"
+        ),
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        metavar="SECONDS",
+        default=0,
+        help="Wait after a sync trigger for more triggers to coalesce with",
+    )
+    parser.add_argument(
+        "--min-sync-interval",
+        type=float,
+        metavar="SECONDS",
+        default=0,
+        help="Minimum time between starts of consecutive syncs",
+    )
+    parser.add_argument(
+        "--start-jitter",
+        type=float,
+        metavar="SECONDS",
+        default=0,
+        help=(
+            "Delay sync start by a random time up to this, so that many "
+            "syncers triggered by the same MQTT message don't all hit the "
+            "server at once"
+        ),
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        default=None,
+        help="Serve Prometheus metrics on /metrics on this port. Default: disabled",
+    )
+    parser.add_argument(
+        "--metrics-address",
+        type=str,
+        metavar="ADDRESS",
+        default=DEFAULT_METRICS_ADDRESS,
+        help=f"Address to serve metrics on. Default: {DEFAULT_METRICS_ADDRESS}",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        metavar="DIR",
+        default=None,
+        help=(
+            "Download maps to this directory shared by all maps directories, "
+            "maps are stored by MD5 and hardlinked from it. It should be on the "
+            "same filesystem as the maps directories. Default: disabled"
+        ),
+    )
+    parser.add_argument(
+        "--min-free-space",
+        type=parse_size,
+        metavar="BYTES",
+        default=None,
+        help=(
+            "Keep at least this much free space on the disk, evicting maps "
+            "waiting for deletion when needed. Default: no limit"
+        ),
+    )
+    parser.add_argument(
+        "--max-disk-usage",
+        type=parse_size,
+        metavar="BYTES",
+        default=None,
+        help=(
+            "Maximum total size of maps in the directory, or in the store when "
+            "it's used, evicting maps waiting for deletion when needed. "
+            "Default: no limit"
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help=(
+            "Watch maps directories and sync right away maps modified or "
+            "deleted outside of the syncer"
+        ),
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        default=False,
+        help=(
+            "Sync once and exit with status 0 when the sync succeeded, and 1 "
+            "otherwise"
+        ),
+    )
     args = parser.parse_args(args=argv[1:])
+    if cast(int, args.download_concurrency) < 1:
+        parser.error("--download-concurrency must be at least 1")
+    if cast(int, args.full_sync_every) < 1:
+        parser.error("--full-sync-every must be at least 1")
+    if cast(int, args.retries) < 0:
+        parser.error("--retries must not be negative")
     logging.basicConfig(level=getattr(logging, args.log_level))  # type: ignore
+    socket.setdefaulttimeout(DEFAULT_SOCKET_TIMEOUT)
 
-    sync_trigger: SyncQueue = queue.Queue()
-    mqtt_ctx: ContextManager[None] = nullcontext()
+    mqtt_config: Optional[MQTTConfig] = None
     if cast(Optional[str], args.mqtt_host) is not None:
         mqtt_config = MQTTConfig(
             cast(str, args.mqtt_host),
@@ -411,19 +3151,88 @@ def main(argv: List[str]) -> None:
             cast(Optional[str], args.mqtt_username),
             cast(Optional[str], args.mqtt_password),
         )
-        mqtt_ctx = mqtt_sync_trigger(mqtt_config, sync_trigger)
+    polling_interval = cast(int, args.polling_interval)
+    directories = [Path(d) for d in cast(List[str], args.maps_directory)]
+    store = cast(Optional[str], args.store)
+    url = cast(str, args.live_maps_url)
+    delete_after = cast(int, args.delete_after)
+    healthcheck_url = cast(Optional[str], args.healthcheck_url)
+    options = SyncOptions(
+        download_concurrency=cast(int, args.download_concurrency),
+        verify=cast(bool, args.verify),
+        full_sync_every=cast(int, args.full_sync_every),
+        max_download_rate=cast(Optional[int], args.max_download_rate),
+        download_order=cast(str, args.download_order),
+        retries=cast(int, args.retries),
+        store=Path(store) if store is not None else None,
+        min_free_space=cast(Optional[int], args.min_free_space),
+        max_disk_usage=cast(Optional[int], args.max_disk_usage),
+        debounce=cast(float, args.debounce),
+        min_sync_interval=cast(float, args.min_sync_interval),
+        start_jitter=cast(float, args.start_jitter),
+    )
+
+    if cast(bool, args.once):
+        states = new_sync_states(directories)
+        ok = run_sync(states, url, delete_after, healthcheck_url, options, "once")
+        return 0 if ok else 1
 
-    timer_ctx = timer_sync_trigger(cast(int, args.polling_interval), sync_trigger)
+    dirty_files = DirtyFiles() if cast(bool, args.watch) else None
+    announcements = LiveMapsAnnouncements() if mqtt_config is not None else None
+    metrics_port = cast(Optional[int], args.metrics_port)
+    metrics_ctx: ContextManager[object] = nullcontext()
+    if metrics_port is not None:
+        metrics_ctx = metrics_server(cast(str, args.metrics_address), metrics_port)
 
-    with signal_sync_trigger(sync_trigger), mqtt_ctx, timer_ctx:
-        polling_sync(
-            Path(cast(str, args.maps_directory)),
-            cast(str, args.live_maps_url),
-            cast(int, args.delete_after),
+    with metrics_ctx:
+        if cast(bool, args.asyncio):
+            import asyncio
+
+            async def run() -> None:
+                sync_trigger = AsyncSyncQueue(asyncio.get_running_loop())
+                with sync_triggers(
+                    sync_trigger,
+                    polling_interval,
+                    mqtt_config,
+                    directories,
+                    dirty_files,
+                    announcements,
+                ):
+                    await async_polling_sync(
+                        directories,
+                        url,
+                        delete_after,
+                        sync_trigger,
+                        healthcheck_url,
+                        options,
+                        dirty_files,
+                        announcements,
+                    )
+
+            asyncio.run(run())
+            return 0
+
+        sync_trigger: SyncQueue = queue.Queue()
+        with sync_triggers(
             sync_trigger,
-            cast(Optional[str], args.healthcheck_url),
-        )
+            polling_interval,
+            mqtt_config,
+            directories,
+            dirty_files,
+            announcements,
+        ):
+            polling_sync(
+                directories,
+                url,
+                delete_after,
+                sync_trigger,
+                healthcheck_url,
+                options,
+                dirty_files,
+                announcements,
+            )
+    return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
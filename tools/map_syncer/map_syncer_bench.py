@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2026 maps-metadata contributors
+# SPDX-License-Identifier: Apache-2.0 OR MIT
+#
+"""Benchmarks of map_syncer throughput and sync latency.
+
+Maps with synthetic contents are served from a local HTTP server, and synced
+to temporary directories. Results are printed as JSON, one object per line,
+so that they can be collected and compared between revisions to catch
+regressions in sync_files, download_file, md5_match and parsing of the live
+maps list.
+"""
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Callable,
+    ClassVar,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    cast,
+)
+
+import map_syncer
+
+BENCHMARKS = (
+    "cold_sync",
+    "noop_sync",
+    "incremental_sync",
+    "download",
+    "md5",
+    "tombstones",
+    "startup",
+    "parse_live_maps",
+)
+
+
+Result = Dict[str, object]
+
+
+class FilesHandler(http.server.BaseHTTPRequestHandler):
+    """Serves files from memory over persistent connections."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid delayed ACK stalls.
+    disable_nagle_algorithm = True
+    files: ClassVar[Dict[str, bytes]] = {}
+
+    def do_GET(self) -> None:  # noqa: N802
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+
+@contextmanager
+def serve_files(files: Dict[str, bytes]) -> Iterator[str]:
+    """Serves the files by path, yields the server base URL."""
+
+    class Handler(FilesHandler):
+        pass
+
+    Handler.files = files
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        host, port = cast(Tuple[str, int], server.server_address[:2])
+        yield f"http://{host}:{port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def synthetic_map(index: int, size: int) -> bytes:
+    """Returns incompressible looking contents of the map."""
+
+    seed = hashlib.sha256(str(index).encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def serve_maps(count: int, size: int) -> Dict[str, bytes]:
+    """Returns files of the live maps list with count maps of the size."""
+
+    files: Dict[str, bytes] = {}
+    live_maps: List[Dict[str, str]] = []
+    for i in range(count):
+        contents = synthetic_map(i, size)
+        files[f"/map/map{i}.sd7"] = contents
+        live_maps.append(
+            {
+                "springName": f"Map {i}",
+                "fileName": f"map{i}.sd7",
+                "downloadURL": f"/map/map{i}.sd7",
+                "md5": hashlib.md5(contents).hexdigest(),
+            }
+        )
+    files["/live_maps.json"] = json.dumps(live_maps).encode()
+    return files
+
+
+@contextmanager
+def live_maps_server(count: int, size: int) -> Iterator[str]:
+    """Serves live maps list with synthetic maps, yields the list URL."""
+
+    files = serve_maps(count, size)
+    with serve_files(files) as base_url:
+        live_maps = cast(List[Dict[str, str]], json.loads(files["/live_maps.json"]))
+        for m in live_maps:
+            m["downloadURL"] = base_url + m["downloadURL"]
+        files["/live_maps.json"] = json.dumps(live_maps).encode()
+        yield f"{base_url}/live_maps.json"
+
+
+def measure(
+    repeat: int, setup: Callable[[], None], func: Callable[[], object]
+) -> List[float]:
+    """Returns durations of repeat runs of func, each after a call of setup."""
+
+    runs = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def result(
+    benchmark: str,
+    params: Dict[str, int],
+    runs: List[float],
+    amount: Optional[int] = None,
+    unit: Optional[str] = None,
+) -> Result:
+    """Returns result of the benchmark runs.
+
+    Throughput is the amount of processed bytes or files per second in the
+    median run.
+    """
+
+    median = statistics.median(runs)
+    res: Result = {
+        "benchmark": benchmark,
+        "params": params,
+        "runs": runs,
+        "min": min(runs),
+        "median": median,
+    }
+    if amount is not None and median > 0:
+        res["throughput"] = amount / median
+        res["throughput_unit"] = unit
+    return res
+
+
+def clear_directory(directory: Path) -> None:
+    for file_path in directory.iterdir():
+        file_path.unlink()
+
+
+def bench_cold_sync(work: Path, args: argparse.Namespace) -> Result:
+    """Sync of all the maps to an empty directory."""
+
+    count, size = cast(int, args.maps), cast(int, args.map_size)
+    concurrency = cast(int, args.download_concurrency)
+    options = map_syncer.SyncOptions(download_concurrency=concurrency)
+    with live_maps_server(count, size) as url:
+        runs = measure(
+            cast(int, args.repeat),
+            lambda: clear_directory(work),
+            lambda: map_syncer.sync_files(work, url, 0, options),
+        )
+    params = {"maps": count, "map_size": size, "download_concurrency": concurrency}
+    return result("cold_sync", params, runs, count * size, "bytes/s")
+
+
+def bench_noop_sync(work: Path, args: argparse.Namespace) -> Result:
+    """Sync of a directory that is already in sync with the live list.
+
+    The first sync after the start of the syncer is a full one, checking the
+    files against the manifest.
+    """
+
+    count = cast(int, args.warm_maps)
+    with live_maps_server(count, 1024) as url:
+        map_syncer.sync_files(work, url, 0)
+        runs = measure(
+            cast(int, args.repeat),
+            lambda: None,
+            lambda: map_syncer.sync_files(work, url, 0),
+        )
+    return result("noop_sync", {"maps": count}, runs, count, "files/s")
+
+
+def bench_incremental_sync(work: Path, args: argparse.Namespace) -> Result:
+    """Sync of a directory in sync with the live list, which didn't change."""
+
+    count = cast(int, args.warm_maps)
+    state = map_syncer.SyncState()
+    options = map_syncer.SyncOptions(full_sync_every=cast(int, args.repeat) + 1)
+    with live_maps_server(count, 1024) as url:
+        map_syncer.sync_files(work, url, 0, options, state)
+        runs = measure(
+            cast(int, args.repeat),
+            lambda: None,
+            lambda: map_syncer.sync_files(work, url, 0, options, state),
+        )
+    return result("incremental_sync", {"maps": count}, runs, count, "files/s")
+
+
+def bench_download(work: Path, args: argparse.Namespace) -> Result:
+    """Download of a single large file."""
+
+    size = cast(int, args.file_size)
+    contents = synthetic_map(0, size)
+    md5 = hashlib.md5(contents).hexdigest()
+    destination = work / "map.sd7"
+    with serve_files({"/map.sd7": contents}) as base_url:
+        runs = measure(
+            cast(int, args.repeat),
+            lambda: destination.unlink(missing_ok=True),
+            lambda: map_syncer.download_file(f"{base_url}/map.sd7", destination, md5),
+        )
+    return result("download", {"size": size}, runs, size, "bytes/s")
+
+
+def bench_md5(work: Path, args: argparse.Namespace) -> Result:
+    """Hashing of a file, mostly from the page cache."""
+
+    size = cast(int, args.file_size)
+    contents = synthetic_map(0, size)
+    md5 = hashlib.md5(contents).hexdigest()
+    file_path = work / "map.sd7"
+    file_path.write_bytes(contents)
+
+    def check() -> None:
+        if not map_syncer.md5_match(file_path, md5):
+            msg = "MD5 mismatch"
+            raise AssertionError(msg)
+
+    runs = measure(cast(int, args.repeat), lambda: None, check)
+    return result("md5", {"size": size}, runs, size, "bytes/s")
+
+
+def bench_tombstones(work: Path, args: argparse.Namespace) -> Result:
+    """Tombstoning of all the files in the directory, and their deletion."""
+
+    count = cast(int, args.warm_maps)
+
+    def setup() -> None:
+        clear_directory(work)
+        for i in range(count):
+            work.joinpath(f"map{i}.sd7").touch()
+
+    def run() -> None:
+        map_syncer.delete_stale_files(work, [], 0)
+        map_syncer.delete_stale_files(work, [], 0)
+
+    runs = measure(cast(int, args.repeat), setup, run)
+    return result("tombstones", {"maps": count}, runs, count, "files/s")
+
+
+def bench_startup(work: Path, args: argparse.Namespace) -> Result:
+    """Start of a fresh interpreter importing map_syncer, as in --once jobs."""
+
+    cwd = Path(__file__).parent
+
+    def run() -> None:
+        subprocess.run([sys.executable, "-c", "import map_syncer"], cwd=cwd, check=True)
+
+    runs = measure(cast(int, args.repeat), lambda: None, run)
+    return result("startup", {}, runs)
+
+
+def traced_memory(func: Callable[[], object]) -> Tuple[int, int]:
+    """Returns bytes allocated by func: retained by its result, and the peak."""
+
+    tracemalloc.start()
+    try:
+        res = func()
+        retained, peak = tracemalloc.get_traced_memory()
+        del res
+    finally:
+        tracemalloc.stop()
+    return retained, peak
+
+
+def bench_parse_live_maps(work: Path, args: argparse.Namespace) -> Result:
+    """Streaming parse of a large live maps list.
+
+    Memory use is compared with parsing of the whole body at once, which keeps
+    the body, its decoded text, and all the dicts in memory at the same time.
+    """
+
+    count = cast(int, args.list_entries)
+    live_maps = [
+        map_syncer.LiveMapEntry(
+            f"Map {i}",
+            f"map{i}.sd7",
+            f"https://example.com/maps/map{i}.sd7",
+            hashlib.md5(str(i).encode()).hexdigest(),
+        )
+        for i in range(count)
+    ]
+    data = [map_syncer.live_map_to_json(m) for m in live_maps]
+    body = json.dumps(data).encode()
+    del live_maps, data
+
+    def parse() -> List[map_syncer.LiveMapEntry]:
+        return list(map_syncer.iter_live_maps(io.BytesIO(body)))
+
+    def parse_whole() -> List[map_syncer.LiveMapEntry]:
+        data = cast(List[Dict[str, str]], json.loads(body.decode()))
+        return map_syncer.parse_live_maps(data)
+
+    runs = measure(cast(int, args.repeat), lambda: None, parse)
+    retained, peak = traced_memory(parse)
+    _, whole_peak = traced_memory(parse_whole)
+    res = result("parse_live_maps", {"entries": count}, runs, count, "entries/s")
+    res["retained_bytes"] = retained
+    res["peak_bytes"] = peak
+    res["whole_body_peak_bytes"] = whole_peak
+    return res
+
+
+BENCHMARK_FUNCTIONS: Dict[str, Callable[[Path, argparse.Namespace], Result]] = {
+    "cold_sync": bench_cold_sync,
+    "noop_sync": bench_noop_sync,
+    "incremental_sync": bench_incremental_sync,
+    "download": bench_download,
+    "md5": bench_md5,
+    "tombstones": bench_tombstones,
+    "startup": bench_startup,
+    "parse_live_maps": bench_parse_live_maps,
+}
+
+
+@contextmanager
+def open_output(path: Optional[str]) -> Iterator[TextIO]:
+    """Opens the file for appending results, or stdout when path is None."""
+
+    if path is None:
+        yield sys.stdout
+        return
+    with Path(path).open("a") as f:
+        yield f
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks map_syncer and prints results as JSON lines",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"Benchmarks to run: {', '.join(BENCHMARKS)}. Default: all",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument("--maps", type=int, default=50, help="Maps in cold sync")
+    parser.add_argument(
+        "--map-size",
+        type=map_syncer.parse_size,
+        default=1024**2,
+        help="Size of maps in cold sync, with optional K, M, G suffix",
+    )
+    parser.add_argument(
+        "--download-concurrency", type=int, default=4, help="Used in cold sync"
+    )
+    parser.add_argument(
+        "--warm-maps",
+        type=int,
+        default=5000,
+        help="Maps in directory for no-op sync and tombstones benchmarks",
+    )
+    parser.add_argument(
+        "--file-size",
+        type=map_syncer.parse_size,
+        default=256 * 1024**2,
+        help="Size of file for download and md5 benchmarks",
+    )
+    parser.add_argument(
+        "--list-entries",
+        type=int,
+        default=50000,
+        help="Entries of live maps list for parse benchmark",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Append results to this file instead of printing them",
+    )
+    args = parser.parse_args(args=argv[1:])
+    benchmarks = cast(List[str], args.benchmarks) or list(BENCHMARKS)
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+    logging.basicConfig(level=logging.WARNING)
+
+    with open_output(cast(Optional[str], args.output)) as output:
+        for name in benchmarks:
+            with tempfile.TemporaryDirectory(prefix="map_syncer_bench") as work:
+                res = BENCHMARK_FUNCTIONS[name](Path(work), args)
+            res["cpus"] = os.cpu_count()
+            output.write(json.dumps(res) + "\n")
+            output.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
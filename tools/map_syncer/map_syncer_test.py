@@ -1,17 +1,43 @@
+import asyncio
+import base64
+import errno
+import gzip
+import hashlib
+import http.server
+import io
 import json
 import logging
 import os
 import pathlib
 import queue
+import re
 import secrets
+import subprocess
+import sys
 import threading
 import time
-from contextlib import nullcontext
-from typing import Dict, List, Tuple, Union, cast
+import urllib.error
+import urllib.parse
+from contextlib import contextmanager, nullcontext
+from typing import (
+    Awaitable,
+    Callable,
+    ClassVar,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 from unittest.mock import ANY
 
 import pytest
 from pyfakefs.fake_filesystem import FakeFilesystem
+from pyfakefs.helpers import set_uid
 from pytest_httpserver import HTTPServer
 from pytest_mock import MockerFixture
 from pytest_mqtt.capmqtt import MqttCaptureFixture  # type: ignore
@@ -19,8 +45,19 @@ from werkzeug.wrappers.request import Request as HTTPRequest
 from werkzeug.wrappers.response import Response as HTTPResponse
 
 import map_syncer
+import map_syncer_bench
 
 ANY_SYNC_QUEUE = cast(map_syncer.SyncQueue, ANY)
+ANY_ASYNC_SYNC_QUEUE = cast(map_syncer.AsyncSyncQueue, ANY)
+ANY_DIRTY_FILES = cast(map_syncer.DirtyFiles, ANY)
+ANY_ANNOUNCEMENTS = cast(map_syncer.LiveMapsAnnouncements, ANY)
+ANY_SYNC_STATE = cast(map_syncer.SyncState, ANY)
+MAP_DIRS = [pathlib.Path("map_dir")]
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(mocker: MockerFixture) -> None:
+    mocker.patch("map_syncer.RETRY_BASE_DELAY", 0)
 
 
 def test_main_default_args(mocker: MockerFixture) -> None:
@@ -34,11 +71,14 @@ def test_main_default_args(mocker: MockerFixture) -> None:
     log_basic_config = mocker.patch("logging.basicConfig")
     map_syncer.main(["map_syncer.py", "map_dir"])
     polling_sync.assert_called_once_with(
-        pathlib.Path("map_dir"),
+        MAP_DIRS,
         map_syncer.DEFAULT_LIVE_MAPS_URL,
         map_syncer.DEFAULT_DELETE_AFTER,
         ANY_SYNC_QUEUE,
         None,
+        map_syncer.SyncOptions(),
+        None,
+        None,
     )
     timer_trigger.assert_called_once_with(
         map_syncer.DEFAULT_POLL_INTERVAL, ANY_SYNC_QUEUE
@@ -53,6 +93,8 @@ def test_main_all_args(mocker: MockerFixture) -> None:
     mqtt_trigger.return_value = nullcontext()
     timer_trigger = mocker.patch("map_syncer.timer_sync_trigger")
     timer_trigger.return_value = nullcontext()
+    watch_trigger = mocker.patch("map_syncer.fs_watch_sync_trigger")
+    watch_trigger.return_value = nullcontext()
     log_basic_config = mocker.patch("logging.basicConfig")
     mocker.patch.dict(os.environ, {"MQTT_PASSWORD": "password1"})
     map_syncer.main(
@@ -69,16 +111,36 @@ def test_main_all_args(mocker: MockerFixture) -> None:
             "--mqtt-topic=topic",
             "--mqtt-username=user",
             "--healthcheck-url=http://example.com/health",
+            "--download-concurrency=4",
+            "--verify",
+            "--max-download-rate=1.5M",
+            "--download-order=smallest",
+            "--watch",
+            "--debounce=5",
+            "--min-sync-interval=30",
+            "--start-jitter=10",
         ]
     )
     polling_sync.assert_called_once_with(
-        pathlib.Path("map_dir"),
+        MAP_DIRS,
         "http://example.com/live_maps.json",
         123,
         ANY_SYNC_QUEUE,
         "http://example.com/health",
+        map_syncer.SyncOptions(
+            download_concurrency=4,
+            verify=True,
+            max_download_rate=1572864,
+            download_order="smallest",
+            debounce=5,
+            min_sync_interval=30,
+            start_jitter=10,
+        ),
+        ANY_DIRTY_FILES,
+        ANY_ANNOUNCEMENTS,
     )
     timer_trigger.assert_called_once_with(456, ANY_SYNC_QUEUE)
+    watch_trigger.assert_called_once_with(MAP_DIRS, ANY_SYNC_QUEUE, ANY_DIRTY_FILES)
     mqtt_trigger.assert_called_once_with(
         map_syncer.MQTTConfig(
             "mqtt.example.com",
@@ -89,10 +151,74 @@ def test_main_all_args(mocker: MockerFixture) -> None:
             "password1",
         ),
         ANY_SYNC_QUEUE,
+        ANY_ANNOUNCEMENTS,
     )
     log_basic_config.assert_called_once_with(level=logging.DEBUG)
 
 
+def test_main_asyncio(mocker: MockerFixture) -> None:
+    polling_sync = mocker.patch("map_syncer.polling_sync")
+    async_polling_sync = mocker.patch("map_syncer.async_polling_sync")
+    timer_trigger = mocker.patch("map_syncer.timer_sync_trigger")
+    timer_trigger.return_value = nullcontext()
+    mocker.patch("logging.basicConfig")
+    map_syncer.main(["map_syncer.py", "map_dir", "--asyncio"])
+    polling_sync.assert_not_called()
+    async_polling_sync.assert_awaited_once_with(
+        MAP_DIRS,
+        map_syncer.DEFAULT_LIVE_MAPS_URL,
+        map_syncer.DEFAULT_DELETE_AFTER,
+        ANY_ASYNC_SYNC_QUEUE,
+        None,
+        map_syncer.SyncOptions(),
+        None,
+        None,
+    )
+    timer_trigger.assert_called_once_with(
+        map_syncer.DEFAULT_POLL_INTERVAL, ANY_ASYNC_SYNC_QUEUE
+    )
+
+
+@pytest.mark.parametrize("succeeded", [True, False])
+def test_main_once(mocker: MockerFixture, succeeded: bool) -> None:
+    run_sync = mocker.patch("map_syncer.run_sync", return_value=succeeded)
+    polling_sync = mocker.patch("map_syncer.polling_sync")
+    mocker.patch("logging.basicConfig")
+    status = map_syncer.main(["map_syncer.py", "map_dir", "--once"])
+    assert status == (0 if succeeded else 1)
+    states: Dict[pathlib.Path, map_syncer.SyncState] = {MAP_DIRS[0]: ANY_SYNC_STATE}
+    run_sync.assert_called_once_with(
+        states,
+        map_syncer.DEFAULT_LIVE_MAPS_URL,
+        map_syncer.DEFAULT_DELETE_AFTER,
+        None,
+        map_syncer.SyncOptions(),
+        "once",
+    )
+    polling_sync.assert_not_called()
+
+
+def test_import_is_lazy() -> None:
+    heavy = ["asyncio", "ctypes", "http.server", "paho.mqtt.client"]
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import map_syncer\n"
+        "duration = time.perf_counter() - start\n"
+        f"print(json.dumps([duration, [m for m in {heavy!r} if m in sys.modules]]))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=pathlib.Path(__file__).parent,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    duration, loaded = cast(Tuple[float, List[str]], json.loads(out))
+    logging.info("map_syncer imported in %f seconds", duration)
+    assert loaded == []
+
+
 def test_fetch_live_maps_parsing(httpserver: HTTPServer) -> None:
     response: List[Dict[str, str]] = [
         {
@@ -131,6 +257,89 @@ def test_fetch_live_maps_parsing(httpserver: HTTPServer) -> None:
     assert live_maps == excepted_live_maps
 
 
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_iter_live_maps(chunk_size: int) -> None:
+    data = [
+        {
+            "springName": f"Mapa ąę {i}",
+            "fileName": f"mapa{i}.sd7",
+            "downloadURL": f"http://example.com/mapa{i}.sd7",
+            "md5": "1234567890abcdef1234567890abcdef",
+        }
+        for i in range(5)
+    ]
+    body = json.dumps(data, indent=2, ensure_ascii=False).encode()
+    live_maps = map_syncer.iter_live_maps(io.BytesIO(body), chunk_size)
+    assert list(live_maps) == map_syncer.parse_live_maps(data)
+    assert list(map_syncer.iter_live_maps(io.BytesIO(b" [ ] "), chunk_size)) == []
+    assert not hasattr(map_syncer.parse_live_maps(data)[0], "__dict__")
+
+
+@pytest.mark.parametrize("chunk_size", range(1, 12))
+def test_iter_json_array_scalars_split_across_chunks(chunk_size: int) -> None:
+    data = [1, 23, 456, -7.5e10, "ab", "ąę", True, None, [89], {"x": 10}]
+    body = json.dumps(data, ensure_ascii=False).encode()
+    items = map_syncer.iter_json_array(io.BytesIO(body), chunk_size)
+    assert list(items) == data
+    assert list(map_syncer.iter_json_array(io.BytesIO(b"[1, 23, 456]"), 5)) == [
+        1,
+        23,
+        456,
+    ]
+
+
+@pytest.mark.parametrize("body", [b"", b"[", b'[{"a": 1}', b'[{"a": 1} {}]', b"{}"])
+def test_iter_json_array_malformed(body: bytes) -> None:
+    with pytest.raises(ValueError):
+        list(map_syncer.iter_json_array(io.BytesIO(body), 2))
+
+
+def test_fetch_live_maps_conditional(httpserver: HTTPServer) -> None:
+    response = [
+        {
+            "springName": "Map 1",
+            "fileName": "map1.sd7",
+            "downloadURL": "http://example.com/map1.sd7",
+            "md5": "1234567890abcdef1234567890abcdef",
+        },
+    ]
+    httpserver.expect_ordered_request(
+        "/live_maps.json", headers={"Accept-Encoding": "gzip"}
+    ).respond_with_data(
+        gzip.compress(json.dumps(response).encode()),
+        headers={
+            "Content-Encoding": "gzip",
+            "ETag": '"v1"',
+            "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+        },
+    )
+    httpserver.expect_ordered_request(
+        "/live_maps.json",
+        headers={
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+        },
+    ).respond_with_data(b"", status=304)
+    url = httpserver.url_for("/live_maps.json")
+    cache = map_syncer.LiveMapsCache()
+
+    live_maps = map_syncer.fetch_live_maps(url, cache)
+    assert live_maps == [
+        map_syncer.LiveMapEntry(
+            "Map 1",
+            "map1.sd7",
+            "http://example.com/map1.sd7",
+            "1234567890abcdef1234567890abcdef",
+        )
+    ]
+    assert cache.live_maps == live_maps
+    assert cache.etag == '"v1"'
+
+    assert map_syncer.fetch_live_maps(url, cache) is None
+    assert cache.live_maps == live_maps
+    httpserver.check_assertions()
+
+
 def test_download_file(httpserver: HTTPServer, fs: FakeFilesystem) -> None:
     httpserver.expect_request("/map1.sd7").respond_with_data(b"map1contents")
     map1md5 = "462e462688fddf33e4bf4b756015f9a1"
@@ -142,6 +351,146 @@ def test_download_file(httpserver: HTTPServer, fs: FakeFilesystem) -> None:
     assert fs.get_object("map1.sd7").contents == "map1contents"
 
 
+def test_download_file_resumes_partial_tmp(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        assert request.headers.get("Range") == "bytes=4-"
+        return HTTPResponse(
+            b"contents", status=206, headers={"Content-Range": "bytes 4-11/12"}
+        )
+
+    httpserver.expect_request("/map1.sd7").respond_with_handler(handler)
+    fs.create_file("map1.sd7.tmp", contents="map1")
+    map_syncer.download_file(
+        httpserver.url_for("/map1.sd7"),
+        pathlib.Path("map1.sd7"),
+        "462e462688fddf33e4bf4b756015f9a1",
+    )
+    assert fs.get_object("map1.sd7").contents == "map1contents"
+    assert not fs.exists("map1.sd7.tmp")
+
+
+def test_download_file_range_not_supported(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    httpserver.expect_request("/map1.sd7").respond_with_data(b"map1contents")
+    fs.create_file("map1.sd7.tmp", contents="garbage")
+    map_syncer.download_file(
+        httpserver.url_for("/map1.sd7"),
+        pathlib.Path("map1.sd7"),
+        "462e462688fddf33e4bf4b756015f9a1",
+    )
+    assert fs.get_object("map1.sd7").contents == "map1contents"
+
+
+def test_download_file_range_not_satisfiable(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        if "Range" in request.headers:
+            return HTTPResponse(b"", status=416)
+        return HTTPResponse(b"map1contents")
+
+    httpserver.expect_request("/map1.sd7").respond_with_handler(handler)
+    fs.create_file("map1.sd7.tmp", contents="map1contents and more")
+    map_syncer.download_file(
+        httpserver.url_for("/map1.sd7"),
+        pathlib.Path("map1.sd7"),
+        "462e462688fddf33e4bf4b756015f9a1",
+    )
+    assert fs.get_object("map1.sd7").contents == "map1contents"
+
+
+def test_download_file_resumes_after_connection_cut(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    contents = b"map1contents" * 1000
+    requests: List[Optional[str]] = []
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        requests.append(request.headers.get("Range"))
+        if len(requests) == 1:
+
+            def cut_stream() -> Iterator[bytes]:
+                yield contents[:5000]
+                msg = "cut"
+                raise ConnectionResetError(msg)
+
+            return HTTPResponse(
+                cut_stream(), headers={"Content-Length": str(len(contents))}
+            )
+        return HTTPResponse(
+            contents[5000:],
+            status=206,
+            headers={"Content-Range": f"bytes 5000-11999/{len(contents)}"},
+        )
+
+    httpserver.expect_request("/map1.sd7").respond_with_handler(handler)
+    url = httpserver.url_for("/map1.sd7")
+    md5 = hashlib.md5(contents).hexdigest()
+    with pytest.raises(RuntimeError) as excinfo:
+        map_syncer.download_file(url, pathlib.Path("map1.sd7"), md5)
+    assert "Incomplete download" in str(excinfo.value)
+    assert fs.get_object("map1.sd7.tmp").contents == contents[:5000].decode()
+
+    map_syncer.download_file(url, pathlib.Path("map1.sd7"), md5)
+    assert requests == [None, "bytes=5000-"]
+    assert fs.get_object("map1.sd7").contents == contents.decode()
+    assert not fs.exists("map1.sd7.tmp")
+
+
+def test_download_file_md5_mismatch_removes_tmp(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    httpserver.expect_request("/map1.sd7").respond_with_data(b"map1contents")
+    with pytest.raises(RuntimeError):
+        map_syncer.download_file(
+            httpserver.url_for("/map1.sd7"), pathlib.Path("map1.sd7"), "bad"
+        )
+    assert not fs.exists("map1.sd7.tmp")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_md5_match(fs: FakeFilesystem, chunk_size: int) -> None:
+    fs.create_file("map1.sd7", contents="map1contents")
+    path = pathlib.Path("map1.sd7")
+    assert map_syncer.md5_match(path, "462e462688fddf33e4bf4b756015f9a1", chunk_size)
+    assert not map_syncer.md5_match(path, "a4b06ce39970cb157729504ac1d740a3")
+
+
+def test_download_file_hashes_while_downloading(
+    httpserver: HTTPServer, fs: FakeFilesystem, mocker: MockerFixture
+) -> None:
+    contents = secrets.token_bytes(3 * 1024 * 1024 + 17)
+    httpserver.expect_request("/map1.sd7").respond_with_data(contents)
+    md5_match = mocker.patch("map_syncer.md5_match")
+    map_syncer.download_file(
+        httpserver.url_for("/map1.sd7"),
+        pathlib.Path("map1.sd7"),
+        hashlib.md5(contents).hexdigest(),
+    )
+    md5_match.assert_not_called()
+    with pathlib.Path("map1.sd7").open("rb") as f:
+        assert f.read() == contents
+
+
+def test_download_file_throttled(httpserver: HTTPServer, fs: FakeFilesystem) -> None:
+    contents = secrets.token_bytes(60000)
+    httpserver.expect_request("/map1.sd7").respond_with_data(contents)
+    throttle = map_syncer.TokenBucket(40000, capacity=20000)
+    start = time.time()
+    map_syncer.download_file(
+        httpserver.url_for("/map1.sd7"),
+        pathlib.Path("map1.sd7"),
+        hashlib.md5(contents).hexdigest(),
+        throttle=throttle,
+    )
+    # 20000 bytes of burst, the remaining 40000 bytes take a second.
+    assert 0.9 < time.time() - start < 2
+    assert fs.get_object("map1.sd7").byte_contents == contents
+
+
 def test_send_healthcheck_basic(httpserver: HTTPServer) -> None:
     called = False
 
@@ -177,6 +526,124 @@ def test_send_healthcheck_dns_error() -> None:
     )
 
 
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the same body for every path over persistent connections."""
+
+    protocol_version = "HTTP/1.1"
+    body = b"map1contents"
+    client_ports: ClassVar[Set[int]] = set()
+
+    def do_GET(self) -> None:  # noqa: N802
+        self.client_ports.add(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+
+class OneRequestHandler(KeepAliveHandler):
+    """Drops the connection after a single request without announcing it."""
+
+    def handle(self) -> None:
+        self.handle_one_request()
+
+
+class TunnelRejectingHandler(KeepAliveHandler):
+    """Records CONNECT requests of proxy clients, and rejects them."""
+
+    tunnels: ClassVar[List[Tuple[str, Optional[str]]]] = []
+
+    def do_CONNECT(self) -> None:  # noqa: N802
+        self.tunnels.append((self.path, self.headers.get("Proxy-Authorization")))
+        self.send_error(403)
+
+
+@contextmanager
+def serve_http(handler: Type[KeepAliveHandler]) -> Iterator[str]:
+    handler.client_ports = set()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_requests_reuse_connection(fs: FakeFilesystem) -> None:
+    md5 = hashlib.md5(KeepAliveHandler.body).hexdigest()
+    with serve_http(KeepAliveHandler) as url:
+        for i in range(3):
+            map_syncer.download_file(
+                f"{url}/map1.sd7", pathlib.Path(f"map{i}.sd7"), md5
+            )
+            map_syncer.send_healthcheck(f"{url}/health")
+    assert len(KeepAliveHandler.client_ports) == 1
+
+
+def test_pool_retries_closed_idle_connection() -> None:
+    pool = map_syncer.HTTPConnectionPool()
+    with serve_http(OneRequestHandler) as url:
+        for _ in range(3):
+            with pool.get(url, {}) as res:
+                assert res.read() == KeepAliveHandler.body
+            time.sleep(0.05)
+    assert len(OneRequestHandler.client_ports) == 3
+
+
+def test_pool_uses_http_proxy(httpserver: HTTPServer, mocker: MockerFixture) -> None:
+    proxy = urllib.parse.urlsplit(httpserver.url_for("/"))
+    mocker.patch.dict(
+        os.environ,
+        {"http_proxy": f"http://user:pa%20ss@{proxy.netloc}", "no_proxy": ""},
+    )
+    token = base64.b64encode(b"user:pa ss").decode()
+    httpserver.expect_request(
+        "/live_maps.json",
+        headers={"Host": "maps.example.com", "Proxy-Authorization": f"Basic {token}"},
+    ).respond_with_data(b"[]")
+    pool = map_syncer.HTTPConnectionPool()
+    with pool.get("http://maps.example.com/live_maps.json", {}) as res:
+        assert res.read() == b"[]"
+    httpserver.check_assertions()
+
+
+def test_pool_bypasses_proxy(httpserver: HTTPServer, mocker: MockerFixture) -> None:
+    mocker.patch.dict(
+        os.environ, {"http_proxy": "http://127.0.0.1:9", "no_proxy": "localhost"}
+    )
+    httpserver.expect_request("/live_maps.json").respond_with_data(b"[]")
+    url = httpserver.url_for("/live_maps.json").replace("127.0.0.1", "localhost")
+    pool = map_syncer.HTTPConnectionPool()
+    with pool.get(url, {}) as res:
+        assert res.read() == b"[]"
+
+
+def test_pool_tunnels_https_through_proxy(mocker: MockerFixture) -> None:
+    with serve_http(TunnelRejectingHandler) as url:
+        proxy = url.replace("http://", "http://user:pass@")
+        mocker.patch.dict(os.environ, {"https_proxy": proxy, "no_proxy": ""})
+        pool = map_syncer.HTTPConnectionPool()
+        with pytest.raises(OSError, match="Tunnel connection failed: 403"):
+            pool.get("https://maps.example.com/live_maps.json", {}).__enter__()
+    token = base64.b64encode(b"user:pass").decode()
+    assert TunnelRejectingHandler.tunnels == [
+        ("maps.example.com:443", f"Basic {token}")
+    ]
+
+
+def test_pool_rejects_unsupported_proxy(mocker: MockerFixture) -> None:
+    mocker.patch.dict(os.environ, {"https_proxy": "socks5://127.0.0.1:1080"})
+    pool = map_syncer.HTTPConnectionPool()
+    with pytest.raises(urllib.error.URLError, match="unsupported https proxy"):
+        pool.get("https://maps.example.com/live_maps.json", {}).__enter__()
+
+
 def test_download_file_md5_mismatch(httpserver: HTTPServer, fs: FakeFilesystem) -> None:
     httpserver.expect_request("/map1.sd7").respond_with_data(b"map1contents")
     with pytest.raises(RuntimeError) as excinfo:
@@ -220,13 +687,69 @@ def test_timer_triggers_on_interval(mocker: MockerFixture) -> None:
         assert duration > min_duration and duration < max_duration
 
 
+@pytest.mark.parametrize("inotify", [True, False])
+def test_fs_watch_triggers_on_changed_maps(
+    tmp_path: pathlib.Path, mocker: MockerFixture, inotify: bool
+) -> None:
+    if not inotify:
+        mocker.patch("map_syncer.inotify_watch", return_value=None)
+    (tmp_path / "map1.sd7").write_bytes(b"map1")
+    (tmp_path / "map2.sd7").write_bytes(b"map2")
+    sync_trigger: map_syncer.SyncQueue = queue.Queue()
+    dirty_files = map_syncer.DirtyFiles()
+    watch = map_syncer.fs_watch_sync_trigger(
+        [tmp_path], sync_trigger, dirty_files, poll_interval=0.05
+    )
+    with watch:
+        # Files written by the syncer itself are ignored.
+        (tmp_path / "map3.sd7.tmp").write_bytes(b"map3")
+        (tmp_path / "synced_maps.json").write_text("[]")
+        with pytest.raises(queue.Empty):
+            sync_trigger.get(timeout=0.2)
+
+        (tmp_path / "map1.sd7").write_bytes(b"mapX")
+        (tmp_path / "map2.sd7").unlink()
+        expected = {"map1.sd7", "map2.sd7"}
+        deadline = time.time() + 2
+        while dirty_files.get(tmp_path) != expected and time.time() < deadline:
+            trigger = sync_trigger.get(timeout=2)
+            assert trigger == (map_syncer.SyncOp.SYNC, "filesystem")
+        assert dirty_files.get(tmp_path) == expected
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_fs_watch_ignores_deleted_maps_not_on_live_list(
+    tmp_path: pathlib.Path, mocker: MockerFixture, inotify: bool
+) -> None:
+    if not inotify:
+        mocker.patch("map_syncer.inotify_watch", return_value=None)
+    (tmp_path / "map1.sd7").write_bytes(b"map1")
+    (tmp_path / "old.sd7").write_bytes(b"old")
+    sync_trigger: map_syncer.SyncQueue = queue.Queue()
+    dirty_files = map_syncer.DirtyFiles()
+    dirty_files.set_live(tmp_path, {"map1.sd7"})
+    watch = map_syncer.fs_watch_sync_trigger(
+        [tmp_path], sync_trigger, dirty_files, poll_interval=0.05
+    )
+    with watch:
+        # Like tombstoned maps deleted by the syncer itself.
+        (tmp_path / "old.sd7").unlink()
+        with pytest.raises(queue.Empty):
+            sync_trigger.get(timeout=0.3)
+
+        (tmp_path / "map1.sd7").unlink()
+        trigger = sync_trigger.get(timeout=2)
+        assert trigger == (map_syncer.SyncOp.SYNC, "filesystem")
+        assert dirty_files.get(tmp_path) == {"map1.sd7"}
+
+
 def test_poller_starts_sync_correctly(mocker: MockerFixture) -> None:
     sync_files = mocker.patch("map_syncer.sync_files")
     send_healthcheck = mocker.patch("map_syncer.send_healthcheck")
     sync_trigger: map_syncer.SyncQueue = queue.Queue()
     t = threading.Thread(
         target=lambda: map_syncer.polling_sync(
-            pathlib.Path(), "", 0, sync_trigger, "http://x.com/health"
+            [pathlib.Path()], "", 0, sync_trigger, "http://x.com/health"
         )
     )
     t.start()
@@ -245,7 +768,7 @@ def test_poller_catches_exceptions(mocker: MockerFixture) -> None:
     sync_files.side_effect = RuntimeError("test")
     sync_trigger: map_syncer.SyncQueue = queue.Queue()
     t = threading.Thread(
-        target=lambda: map_syncer.polling_sync(pathlib.Path(), "", 0, sync_trigger)
+        target=lambda: map_syncer.polling_sync([pathlib.Path()], "", 0, sync_trigger)
     )
     t.start()
     sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
@@ -260,7 +783,7 @@ def test_poller_ignores_duplicate_requests(mocker: MockerFixture) -> None:
     sync_files = mocker.patch("map_syncer.sync_files")
     sync_trigger: map_syncer.SyncQueue = queue.Queue()
     t = threading.Thread(
-        target=lambda: map_syncer.polling_sync(pathlib.Path(), "", 0, sync_trigger)
+        target=lambda: map_syncer.polling_sync([pathlib.Path()], "", 0, sync_trigger)
     )
     t.start()
     for _ in range(10):
@@ -270,6 +793,171 @@ def test_poller_ignores_duplicate_requests(mocker: MockerFixture) -> None:
     assert sync_files.call_count < 2
 
 
+def test_sync_schedule(mocker: MockerFixture) -> None:
+    mocker.patch("random.uniform", return_value=3)
+    options = map_syncer.SyncOptions(debounce=5, min_sync_interval=60, start_jitter=10)
+    schedule = map_syncer.SyncSchedule(options)
+    assert schedule.delay(100) is None
+    schedule.trigger("A", 100)
+    schedule.trigger("B", 104)
+    assert schedule.delay(104) == 4
+    assert schedule.delay(104, running=True) is None
+    assert schedule.delay(110) == 0
+    assert schedule.take(110) == "B"
+    assert schedule.delay(110) is None
+
+    # Next sync waits for the minimum interval since the last start.
+    schedule.trigger("C", 120)
+    assert schedule.delay(120) == 50
+
+
+def test_poller_debounces_triggers(mocker: MockerFixture) -> None:
+    sync_files = mocker.patch("map_syncer.sync_files")
+    sync_trigger: map_syncer.SyncQueue = queue.Queue()
+    options = map_syncer.SyncOptions(debounce=0.3)
+    t = threading.Thread(
+        target=lambda: map_syncer.polling_sync(
+            [pathlib.Path()], "", 0, sync_trigger, None, options
+        )
+    )
+    t.start()
+    for _ in range(3):
+        sync_trigger.put((map_syncer.SyncOp.SYNC, "MQTT"))
+        time.sleep(0.05)
+    time.sleep(0.5)
+    assert sync_files.call_count == 1
+    sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+    t.join()
+    assert sync_files.call_count == 1
+
+
+def run_async_poller(
+    mocker: MockerFixture,
+    feed: Callable[[map_syncer.AsyncSyncQueue], Awaitable[None]],
+    options: Optional[map_syncer.SyncOptions] = None,
+) -> None:
+    async def run() -> None:
+        sync_trigger = map_syncer.AsyncSyncQueue(asyncio.get_running_loop())
+        poller = asyncio.ensure_future(
+            map_syncer.async_polling_sync(
+                [pathlib.Path()], "", 0, sync_trigger, None, options
+            )
+        )
+        await feed(sync_trigger)
+        await asyncio.wait_for(poller, timeout=5)
+
+    asyncio.run(run())
+
+
+def test_async_poller_starts_sync_correctly(mocker: MockerFixture) -> None:
+    sync_files = mocker.patch("map_syncer.sync_files")
+
+    async def feed(sync_trigger: map_syncer.AsyncSyncQueue) -> None:
+        for _ in range(3):
+            sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
+            await asyncio.sleep(0.1)
+        sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+
+    run_async_poller(mocker, feed)
+    assert sync_files.call_count == 3
+
+
+def test_async_poller_ignores_duplicate_requests(mocker: MockerFixture) -> None:
+    sync_files = mocker.patch("map_syncer.sync_files")
+
+    async def feed(sync_trigger: map_syncer.AsyncSyncQueue) -> None:
+        for _ in range(10):
+            sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
+        sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+
+    run_async_poller(mocker, feed)
+    assert sync_files.call_count < 2
+
+
+def test_async_poller_coalesces_triggers_during_sync(mocker: MockerFixture) -> None:
+    sync_files = mocker.patch("map_syncer.sync_files")
+    sync_files.side_effect = lambda *args: time.sleep(0.2)  # type: ignore
+
+    async def feed(sync_trigger: map_syncer.AsyncSyncQueue) -> None:
+        sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
+        await asyncio.sleep(0.05)
+        for _ in range(5):
+            sync_trigger.put((map_syncer.SyncOp.SYNC, "B"))
+        await asyncio.sleep(0.6)
+        sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+
+    run_async_poller(mocker, feed)
+    assert sync_files.call_count == 2
+
+
+def test_async_poller_waits_min_sync_interval(mocker: MockerFixture) -> None:
+    sync_files = mocker.patch("map_syncer.sync_files")
+    options = map_syncer.SyncOptions(min_sync_interval=0.5)
+
+    async def feed(sync_trigger: map_syncer.AsyncSyncQueue) -> None:
+        sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
+        await asyncio.sleep(0.1)
+        for _ in range(3):
+            sync_trigger.put((map_syncer.SyncOp.SYNC, "B"))
+            await asyncio.sleep(0.1)
+        assert sync_files.call_count == 1
+        await asyncio.sleep(0.4)
+        sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+
+    run_async_poller(mocker, feed, options)
+    assert sync_files.call_count == 2
+
+
+def test_async_poller_cancels_downloads_on_stop(
+    threaded_httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    contents = b"x" * 1000
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        def slow_stream() -> Iterator[bytes]:
+            for i in range(0, len(contents), 100):
+                yield contents[i : i + 100]
+                time.sleep(0.2)
+
+        return HTTPResponse(
+            slow_stream(), headers={"Content-Length": str(len(contents))}
+        )
+
+    response: List[Dict[str, str]] = [
+        {
+            "springName": "Map 1",
+            "fileName": "map1.sd7",
+            "downloadURL": threaded_httpserver.url_for("/map/map1.sd7"),
+            "md5": hashlib.md5(contents).hexdigest(),
+        }
+    ]
+    threaded_httpserver.expect_request("/live_maps.json").respond_with_json(response)
+    threaded_httpserver.expect_request("/map/map1.sd7").respond_with_handler(handler)
+
+    async def run() -> None:
+        sync_trigger = map_syncer.AsyncSyncQueue(asyncio.get_running_loop())
+        poller = asyncio.ensure_future(
+            map_syncer.async_polling_sync(
+                [tmp_path],
+                threaded_httpserver.url_for("/live_maps.json"),
+                -1,
+                sync_trigger,
+            )
+        )
+        sync_trigger.put((map_syncer.SyncOp.SYNC, "A"))
+        while not (tmp_path / "map1.sd7.tmp").exists():
+            await asyncio.sleep(0.01)
+        start = time.time()
+        sync_trigger.put((map_syncer.SyncOp.STOP, "stop"))
+        await asyncio.wait_for(poller, timeout=5)
+        assert time.time() - start < 0.5
+
+    asyncio.run(run())
+    assert not (tmp_path / "map1.sd7").exists()
+    # Partial download is kept to be resumed.
+    assert 0 < (tmp_path / "map1.sd7.tmp").stat().st_size < len(contents)
+
+
 @pytest.fixture(scope="function")
 def live_maps_url(httpserver: HTTPServer) -> str:
     maps = [
@@ -292,6 +980,46 @@ def live_maps_url(httpserver: HTTPServer) -> str:
     return cast(str, httpserver.url_for("/live_maps.json"))
 
 
+def metric_value(metrics: str, sample: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.split(" ")[1])
+    return 0.0
+
+
+def test_metrics_endpoint(live_maps_url: str, tmp_path: pathlib.Path) -> None:
+    (tmp_path / "map_old.sd7").write_bytes(b"mapoldcontents")
+    samples = [
+        "map_syncer_downloaded_bytes_total",
+        "map_syncer_deleted_files_total",
+        'map_syncer_syncs_total{result="success"}',
+        "map_syncer_sync_duration_seconds_count",
+        "map_syncer_download_duration_seconds_count",
+        'map_syncer_triggers_total{source="test"}',
+    ]
+    with map_syncer.metrics_server("127.0.0.1", 0) as (host, port):
+
+        def scrape() -> str:
+            with map_syncer.HTTP_POOL.get(f"http://{host}:{port}/metrics", {}) as res:
+                return res.read().decode()
+
+        before = scrape()
+        sync_trigger: map_syncer.SyncQueue = queue.Queue()
+        map_syncer.CountingSyncTriggerSink(sync_trigger).put(
+            (map_syncer.SyncOp.SYNC, "test")
+        )
+        states = map_syncer.new_sync_states([tmp_path])
+        map_syncer.run_sync(states, live_maps_url, 0, None, None, "test")
+        after = scrape()
+
+    deltas = [metric_value(after, s) - metric_value(before, s) for s in samples]
+    assert deltas == [36, 1, 1, 1, 3, 1]
+    assert metric_value(after, "map_syncer_tombstones") == 0
+    assert 0 <= metric_value(after, "map_syncer_seconds_since_last_success") < 5
+    assert "# TYPE map_syncer_sync_duration_seconds histogram" in after
+    assert 'map_syncer_sync_duration_seconds_bucket{le="+Inf"}' in after
+
+
 def test_sync_files_simple(live_maps_url: str, fs: FakeFilesystem) -> None:
     d = pathlib.Path("maps")
     fs.create_dir(d)
@@ -327,3 +1055,890 @@ def test_sync_files_deletes_only_old(live_maps_url: str, fs: FakeFilesystem) ->
     ) == {
         "map_old_1.sd7": initial_tombstones["map_old_1.sd7"],
     }
+
+
+def test_sync_files_recovers_corrupted_tombstones(
+    live_maps_url: str, fs: FakeFilesystem, caplog: pytest.LogCaptureFixture
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    fs.create_file(d / "map_old.sd7")
+    fs.create_file(d / "tombstones.json", contents='{"map_old.sd7": 12')
+    map_syncer.sync_files(d, live_maps_url, delete_after=200)
+    assert "Ignoring corrupted tombstones" in caplog.text
+    # The tombstone starts over instead of deleting the file right away.
+    assert fs.exists(d / "map_old.sd7")
+    tombstones = cast(
+        Dict[str, int],
+        json.loads(fs.get_object(d / "tombstones.json").contents or "{}"),
+    )
+    assert list(tombstones) == ["map_old.sd7"]
+    assert not fs.exists(d / "tombstones.json.tmp")
+
+
+def test_sync_files_keeps_tombstones_in_memory(
+    live_maps_url: str, fs: FakeFilesystem
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    fs.create_file(d / "map_old.sd7")
+    state = map_syncer.SyncState()
+    options = map_syncer.SyncOptions(full_sync_every=1)
+    map_syncer.sync_files(d, live_maps_url, 200, options, state)
+    tombstones_path = d / "tombstones.json"
+    assert tombstones_path.exists()
+
+    # Later syncs neither read the file, nor write unchanged tombstones.
+    tombstones_path.unlink()
+    map_syncer.sync_files(d, live_maps_url, 200, options, state)
+    assert not tombstones_path.exists()
+    assert state.tombstones is not None
+    assert list(state.tombstones.not_seen_since) == ["map_old.sd7"]
+
+
+def test_sync_files_deletes_stale_tmp_files(
+    live_maps_url: str, fs: FakeFilesystem
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    old = time.time() - map_syncer.STALE_TMP_AGE - 1
+    for name in ["map_old.sd7.tmp", "manifest.json.tmp"]:
+        fs.create_file(d / name)
+        os.utime(d / name, (old, old))
+    # Recently modified file might be written by another process.
+    fs.create_file(d / "map_new.sd7.tmp")
+    map_syncer.sync_files(d, live_maps_url, delete_after=1000)
+    assert not fs.exists(d / "map_old.sd7.tmp")
+    assert not fs.exists(d / "manifest.json.tmp")
+    assert fs.exists(d / "map_new.sd7.tmp")
+    # Deleted without waiting for a tombstone.
+    assert not fs.exists(d / "tombstones.json")
+
+    # Nothing is deleted when deletion is disabled.
+    os.utime(d / "map_new.sd7.tmp", (old, old))
+    map_syncer.sync_files(d, live_maps_url, delete_after=-1)
+    assert fs.exists(d / "map_new.sd7.tmp")
+
+
+def test_delete_stale_files_keeps_resumable_tmp(fs: FakeFilesystem) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    old = time.time() - map_syncer.STALE_TMP_AGE - 1
+    for name in ["map1.sd7.tmp", "map2.sd7.tmp", "map2.sd7", "map3.sd7.tmp"]:
+        fs.create_file(d / name)
+        os.utime(d / name, (old, old))
+    live_maps = [
+        map_syncer.LiveMapEntry(name, name, "", "") for name in ["map1.sd7", "map2.sd7"]
+    ]
+    map_syncer.delete_stale_files(d, live_maps, 1000)
+    assert sorted(p.name for p in d.iterdir()) == ["map1.sd7.tmp", "map2.sd7"]
+
+
+def test_sync_files_evicts_tombstoned_maps_for_space(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    serve_live_maps(httpserver, {"map1.sd7": b"x" * 100})
+    (tmp_path / "old1.sd7").write_bytes(b"o" * 100)
+    (tmp_path / "old2.sd7").write_bytes(b"o" * 100)
+    tombstones = {"old1.sd7": int(time.time()) - 20, "old2.sd7": int(time.time())}
+    (tmp_path / "tombstones.json").write_text(json.dumps(tombstones))
+    options = map_syncer.SyncOptions(max_disk_usage=250)
+    map_syncer.sync_files(
+        tmp_path, httpserver.url_for("/live_maps.json"), 1000, options
+    )
+    assert (tmp_path / "map1.sd7").exists()
+    assert not (tmp_path / "old1.sd7").exists()
+    assert (tmp_path / "old2.sd7").exists()
+    tombstones = json.loads((tmp_path / "tombstones.json").read_text())
+    assert list(tombstones) == ["old2.sd7"]
+
+
+def test_sync_files_releases_space_of_failed_download(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    contents = b"x" * 100
+    responses = [b"y" * 100, contents]
+    response = [
+        {
+            "springName": "map1.sd7",
+            "fileName": "map1.sd7",
+            "downloadURL": httpserver.url_for("/map/map1.sd7"),
+            "md5": hashlib.md5(contents).hexdigest(),
+        }
+    ]
+    httpserver.expect_request("/live_maps.json").respond_with_json(response)
+    httpserver.expect_request("/map/map1.sd7").respond_with_handler(
+        lambda request: HTTPResponse(responses.pop(0))
+    )
+    (tmp_path / "old1.sd7").write_bytes(b"o" * 100)
+    tombstones = {"old1.sd7": int(time.time())}
+    (tmp_path / "tombstones.json").write_text(json.dumps(tombstones))
+    options = map_syncer.SyncOptions(max_disk_usage=250)
+    map_syncer.sync_files(
+        tmp_path, httpserver.url_for("/live_maps.json"), 1000, options
+    )
+    assert (tmp_path / "map1.sd7").read_bytes() == contents
+    assert (tmp_path / "old1.sd7").exists()
+
+
+def test_disk_space_evicts_maps_with_store_blobs(tmp_path: pathlib.Path) -> None:
+    d, other, store = tmp_path / "d", tmp_path / "other", tmp_path / "store"
+    for directory in [d, other, store]:
+        directory.mkdir()
+    (store / "blob1.sd7").write_bytes(b"1" * 100)
+    (store / "blob2.sd7").write_bytes(b"2" * 100)
+    os.link(store / "blob1.sd7", d / "old1.sd7")
+    os.link(store / "blob1.sd7", other / "old1.sd7")
+    os.link(store / "blob2.sd7", d / "old2.sd7")
+    tombstones = map_syncer.Tombstones(d / "tombstones.json")
+    tombstones.bury("old1.sd7", time.time() - 20)
+    tombstones.bury("old2.sd7", time.time())
+    space = map_syncer.DiskSpace(d, tombstones, max_disk_usage=250, store=store)
+    with space.reserve(100, store / "blob3.sd7.tmp"):
+        pass
+    # Blob of old1 is still used by the other directory, removing it frees nothing.
+    assert (d / "old1.sd7").exists()
+    assert not (d / "old2.sd7").exists()
+    assert sorted(p.name for p in store.iterdir()) == ["blob1.sd7"]
+
+
+def test_sync_files_store_evicts_tombstoned_maps_for_space(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    update = serve_live_maps(httpserver, {"map1.sd7": b"1" * 1000})
+    url = httpserver.url_for("/live_maps.json")
+    d, store = tmp_path / "d", tmp_path / "store"
+    d.mkdir()
+    options = map_syncer.SyncOptions(store=store, max_disk_usage=1500)
+    map_syncer.sync_files(d, url, 1000, options)
+    update({"map2.sd7": b"2" * 1000})
+    map_syncer.sync_files(d, url, 1000, options)
+    assert sorted(p.name for p in d.glob("*.sd7")) == ["map2.sd7"]
+    assert len(list(store.iterdir())) == 1
+
+
+def test_sync_files_rejects_download_without_space(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    serve_live_maps(httpserver, {"map1.sd7": b"x" * 100, "map2.sd7": b"y" * 10})
+    options = map_syncer.SyncOptions(max_disk_usage=50)
+    with pytest.raises(map_syncer.SyncError, match="1 maps: map1.sd7"):
+        map_syncer.sync_files(
+            tmp_path, httpserver.url_for("/live_maps.json"), 1000, options
+        )
+    assert not (tmp_path / "map1.sd7").exists()
+    assert not (tmp_path / "map1.sd7.tmp").exists()
+    assert (tmp_path / "map2.sd7").exists()
+
+
+@pytest.fixture(scope="function")
+def threaded_httpserver() -> Iterator[HTTPServer]:
+    server = HTTPServer(threaded=True)
+    server.start()
+    yield server
+    server.clear()
+    if server.is_running():
+        server.stop()
+
+
+def serve_slow_maps(server: HTTPServer, count: int, latency: float) -> str:
+    def slow_handler(contents: bytes) -> Callable[[HTTPRequest], HTTPResponse]:
+        def handler(request: HTTPRequest) -> HTTPResponse:
+            time.sleep(latency)
+            return HTTPResponse(contents)
+
+        return handler
+
+    response: List[Dict[str, str]] = []
+    for i in range(count):
+        contents = f"map{i}contents".encode()
+        response.append(
+            {
+                "springName": f"Map {i}",
+                "fileName": f"map{i}.sd7",
+                "downloadURL": server.url_for(f"/map/map{i}.sd7"),
+                "md5": hashlib.md5(contents).hexdigest(),
+            }
+        )
+        server.expect_request(f"/map/map{i}.sd7").respond_with_handler(
+            slow_handler(contents)
+        )
+    server.expect_request("/live_maps.json").respond_with_json(response)
+    return server.url_for("/live_maps.json")
+
+
+def test_sync_files_concurrent_downloads_are_faster(
+    threaded_httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    maps, latency = 6, 0.1
+    url = serve_slow_maps(threaded_httpserver, maps, latency)
+
+    durations: List[float] = []
+    for concurrency in [1, maps]:
+        d = tmp_path / f"maps{concurrency}"
+        d.mkdir()
+        start = time.time()
+        map_syncer.sync_files(
+            d, url, -1, map_syncer.SyncOptions(download_concurrency=concurrency)
+        )
+        durations.append(time.time() - start)
+        for i in range(maps):
+            assert (d / f"map{i}.sd7").read_text() == f"map{i}contents"
+        assert not list(d.glob("*.tmp"))
+
+    sequential, concurrent = durations
+    assert sequential >= maps * latency
+    assert concurrent < sequential / 2
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_sync_files_reports_each_failed_download(
+    httpserver: HTTPServer, fs: FakeFilesystem, concurrency: int
+) -> None:
+    maps = [
+        ("map1.sd7", b"map1contents", "462e462688fddf33e4bf4b756015f9a1"),
+        ("map2.sd7", b"map2contents", "bad"),
+        ("map3.sd7", b"map3contents", "d8720a22142996af63b6b962e4d338c7"),
+        ("map4.sd7", b"", "bad"),
+    ]
+    response: List[Dict[str, str]] = [
+        {
+            "springName": file,
+            "fileName": file,
+            "downloadURL": httpserver.url_for("/map/" + file),
+            "md5": md5,
+        }
+        for (file, _, md5) in maps
+    ]
+    httpserver.expect_request("/live_maps.json").respond_with_json(response)
+    for file, contents, _ in maps[:3]:
+        httpserver.expect_request("/map/" + file).respond_with_data(contents)
+    httpserver.expect_request("/map/map4.sd7").respond_with_data(b"", status=404)
+
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    with pytest.raises(map_syncer.SyncError) as excinfo:
+        map_syncer.sync_files(
+            d,
+            httpserver.url_for("/live_maps.json"),
+            0,
+            map_syncer.SyncOptions(download_concurrency=concurrency),
+        )
+    assert "map2.sd7, map4.sd7" in str(excinfo.value)
+    assert fs.get_object(d / "map1.sd7").contents == "map1contents"
+    assert fs.get_object(d / "map3.sd7").contents == "map3contents"
+    assert not fs.exists(d / "map2.sd7")
+    assert not fs.exists(d / "map4.sd7")
+
+
+def test_download_maps_retries_transient_errors(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    responses = [HTTPResponse(b"", status=503), HTTPResponse(b"", status=500)]
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        return responses.pop(0) if responses else HTTPResponse(b"map1")
+
+    httpserver.expect_request("/map/map1.sd7").respond_with_handler(handler)
+    httpserver.expect_request("/map/map2.sd7").respond_with_data(b"", status=404)
+    maps = [
+        map_syncer.LiveMapEntry(
+            "Map 1",
+            "map1.sd7",
+            httpserver.url_for("/map/map1.sd7"),
+            hashlib.md5(b"map1").hexdigest(),
+        ),
+        map_syncer.LiveMapEntry(
+            "Map 2", "map2.sd7", httpserver.url_for("/map/map2.sd7"), "x"
+        ),
+    ]
+    failures = map_syncer.download_maps(tmp_path, maps, 1, retries=3)
+    assert list(failures) == ["map2.sd7"]
+    assert (tmp_path / "map1.sd7").read_bytes() == b"map1"
+    # Not found is not retried.
+    paths = [r.path for r, _ in httpserver.log]
+    assert paths.count("/map/map1.sd7") == 3
+    assert paths.count("/map/map2.sd7") == 1
+
+
+def test_download_maps_circuit_breaker(
+    httpserver: HTTPServer, tmp_path: pathlib.Path, mocker: MockerFixture
+) -> None:
+    httpserver.expect_request(re.compile("/map/.*")).respond_with_data(b"", status=503)
+    maps = [
+        map_syncer.LiveMapEntry(
+            f"Map {i}", f"map{i}.sd7", httpserver.url_for(f"/map/map{i}.sd7"), "x"
+        )
+        for i in range(4)
+    ]
+    breaker = map_syncer.CircuitBreaker(threshold=2, reset_after=60)
+    failures = map_syncer.download_maps(
+        tmp_path, maps, 1, retries=0, circuit_breaker=breaker
+    )
+    assert len(failures) == 4
+    assert len(httpserver.log) == 2
+    assert isinstance(failures["map3.sd7"], map_syncer.CircuitOpenError)
+
+    # After a while a single trial request is let through.
+    now = time.monotonic()
+    mocker.patch("time.monotonic", return_value=now + 61)
+    map_syncer.download_maps(tmp_path, maps, 1, retries=0, circuit_breaker=breaker)
+    assert len(httpserver.log) == 3
+
+
+def test_download_maps_retries_of_one_map_keep_circuit_closed(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    httpserver.expect_request("/map/map0.sd7").respond_with_data(b"", status=500)
+    httpserver.expect_request("/map/map1.sd7").respond_with_data(b"map1")
+    maps = [
+        map_syncer.LiveMapEntry(
+            f"Map {i}",
+            f"map{i}.sd7",
+            httpserver.url_for(f"/map/map{i}.sd7"),
+            hashlib.md5(f"map{i}".encode()).hexdigest(),
+        )
+        for i in range(2)
+    ]
+    breaker = map_syncer.CircuitBreaker(threshold=2, reset_after=60)
+    failures = map_syncer.download_maps(
+        tmp_path, maps, 1, retries=5, circuit_breaker=breaker
+    )
+    assert list(failures) == ["map0.sd7"]
+    assert (tmp_path / "map1.sd7").read_bytes() == b"map1"
+
+
+def test_download_maps_does_not_retry_local_file_errors(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    httpserver.expect_request("/map/map1.sd7").respond_with_data(b"map1")
+    maps = [
+        map_syncer.LiveMapEntry(
+            "Map 1",
+            "map1.sd7",
+            httpserver.url_for("/map/map1.sd7"),
+            hashlib.md5(b"map1").hexdigest(),
+        )
+    ]
+    d = pathlib.Path("maps")
+    fs.create_dir(d, perm_bits=0o555)
+    set_uid(1000)
+    breaker = map_syncer.CircuitBreaker(threshold=1, reset_after=60)
+    failures = map_syncer.download_maps(d, maps, 1, retries=3, circuit_breaker=breaker)
+    assert isinstance(failures["map1.sd7"], PermissionError)
+    assert len(httpserver.log) == 1
+    assert not breaker.is_open(urllib.parse.urlsplit(maps[0].download_url).netloc)
+
+
+@pytest.mark.parametrize(
+    ("error", "expected"),
+    [
+        (PermissionError(errno.EACCES, "Permission denied", "map1.sd7.tmp"), False),
+        (OSError(errno.EROFS, "Read-only file system"), False),
+        (ConnectionResetError(errno.ECONNRESET, "Connection reset by peer"), True),
+        (urllib.error.URLError("timed out"), True),
+    ],
+)
+def test_is_host_failure(error: BaseException, expected: bool) -> None:
+    assert map_syncer.is_host_failure(error) == expected
+
+
+def test_run_sync_reports_failure_to_healthcheck(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    responses = [HTTPResponse(b"", status=502)] * 2
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        return responses.pop(0) if responses else HTTPResponse(b"[]")
+
+    httpserver.expect_request("/live_maps.json").respond_with_handler(handler)
+    httpserver.expect_request("/health/fail").respond_with_data(b"OK")
+    url = httpserver.url_for("/live_maps.json")
+    health_url = httpserver.url_for("/health")
+    states = map_syncer.new_sync_states([tmp_path])
+
+    options = map_syncer.SyncOptions(retries=0)
+    map_syncer.run_sync(states, url, 0, health_url, options, "test")
+    assert [r.path for r, _ in httpserver.log] == ["/live_maps.json", "/health/fail"]
+
+    # The fetch succeeds on retry.
+    httpserver.expect_request("/health").respond_with_data(b"OK")
+    map_syncer.run_sync(states, url, 0, health_url, None, "test")
+    assert [r.path for r, _ in httpserver.log][2:] == [
+        "/live_maps.json",
+        "/live_maps.json",
+        "/health",
+    ]
+
+
+def test_sync_files_downloads_smallest_first(
+    httpserver: HTTPServer, fs: FakeFilesystem
+) -> None:
+    maps = {
+        f"map{i}.sd7": secrets.token_bytes(size) for i, size in enumerate([30, 10, 20])
+    }
+    downloaded = []
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        name = request.path.split("/")[-1]
+        contents = maps[name]
+        if request.headers.get("Range") == "bytes=0-0":
+            return HTTPResponse(
+                contents[:1],
+                status=206,
+                headers={"Content-Range": f"bytes 0-0/{len(contents)}"},
+            )
+        downloaded.append(name)
+        return HTTPResponse(contents)
+
+    response = [
+        {
+            "springName": name,
+            "fileName": name,
+            "downloadURL": httpserver.url_for(f"/map/{name}"),
+            "md5": hashlib.md5(contents).hexdigest(),
+        }
+        for name, contents in maps.items()
+    ]
+    httpserver.expect_request("/live_maps.json").respond_with_json(response)
+    httpserver.expect_request(re.compile("^/map/")).respond_with_handler(handler)
+    map_syncer.sync_files(
+        pathlib.Path(),
+        httpserver.url_for("/live_maps.json"),
+        -1,
+        map_syncer.SyncOptions(download_order="smallest"),
+    )
+    assert downloaded == ["map1.sd7", "map2.sd7", "map0.sd7"]
+
+
+def test_order_downloads_many_maps_uses_list_order(mocker: MockerFixture) -> None:
+    mocker.patch("map_syncer.MAX_SIZE_PROBES", 2)
+    remote_size = mocker.patch("map_syncer.remote_size", return_value=1)
+    maps = [map_syncer.LiveMapEntry(f"m{i}", f"m{i}", "", "") for i in range(3)]
+    assert map_syncer.order_downloads(maps[::-1], maps, "smallest") == maps
+    remote_size.assert_not_called()
+
+
+def test_order_downloads_probes_respect_cancel_and_circuit(
+    mocker: MockerFixture,
+) -> None:
+    remote_size = mocker.patch("map_syncer.remote_size", return_value=1)
+    maps = [
+        map_syncer.LiveMapEntry("m1", "m1", "http://broken/m1", ""),
+        map_syncer.LiveMapEntry("m2", "m2", "http://healthy/m2", ""),
+    ]
+    breaker = map_syncer.CircuitBreaker(threshold=1, reset_after=60)
+    breaker.record("broken", success=False)
+    ordered = map_syncer.order_downloads(maps, maps, "smallest", None, breaker)
+    assert ordered == maps[::-1]
+    remote_size.assert_called_once_with("http://healthy/m2")
+
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(map_syncer.SyncCancelledError):
+        map_syncer.order_downloads(maps, maps, "smallest", cancel)
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"), [("123", 123), ("2K", 2048), ("1.5m", 1572864)]
+)
+def test_parse_size(value: str, expected: int) -> None:
+    assert map_syncer.parse_size(value) == expected
+
+
+def test_sync_files_verify_redownloads_corrupted(
+    live_maps_url: str, fs: FakeFilesystem
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    fs.create_file(d / "map1.sd7", contents="corrupted")
+    map_syncer.sync_files(d, live_maps_url, delete_after=-1)
+    assert fs.get_object(d / "map1.sd7").contents == "corrupted"
+    map_syncer.sync_files(
+        d, live_maps_url, delete_after=-1, options=map_syncer.SyncOptions(verify=True)
+    )
+    assert fs.get_object(d / "map1.sd7").contents == "map1contents"
+
+
+def test_sync_files_verify_rehashes_only_changed(
+    live_maps_url: str, fs: FakeFilesystem, mocker: MockerFixture
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    options = map_syncer.SyncOptions(verify=True)
+    map_syncer.sync_files(d, live_maps_url, delete_after=-1, options=options)
+    manifest = cast(
+        Dict[str, Dict[str, Union[int, str]]],
+        json.loads(fs.get_object(d / "manifest.json").contents or "{}"),
+    )
+    assert sorted(manifest) == ["map1.sd7", "map2.sd7", "map3.sd7"]
+    assert manifest["map2.sd7"]["md5"] == "a4b06ce39970cb157729504ac1d740a3"
+
+    md5_file = mocker.spy(map_syncer, "md5_file")
+    map_syncer.sync_files(d, live_maps_url, delete_after=-1, options=options)
+    md5_file.assert_not_called()
+
+    (d / "map2.sd7").write_text("truncated")
+    map_syncer.sync_files(d, live_maps_url, delete_after=-1, options=options)
+    md5_file.assert_called_once_with(d / "map2.sd7")
+    assert fs.get_object(d / "map2.sd7").contents == "map2contents"
+
+
+def test_sync_files_recovers_corrupted_manifest(
+    live_maps_url: str, fs: FakeFilesystem
+) -> None:
+    d = pathlib.Path("maps")
+    fs.create_dir(d)
+    fs.create_file(d / "manifest.json", contents='{"map1.sd7": {"si')
+    fs.create_file(d / "map1.sd7", contents="map1contents")
+    map_syncer.sync_files(
+        d, live_maps_url, delete_after=-1, options=map_syncer.SyncOptions(verify=True)
+    )
+    manifest = cast(
+        Dict[str, Dict[str, Union[int, str]]],
+        json.loads(fs.get_object(d / "manifest.json").contents or "{}"),
+    )
+    assert sorted(manifest) == ["map1.sd7", "map2.sd7", "map3.sd7"]
+
+
+def test_sync_files_skips_not_modified(
+    httpserver: HTTPServer, tmp_path: pathlib.Path, mocker: MockerFixture
+) -> None:
+    contents = b"map1contents"
+    response = [
+        {
+            "springName": "Map 1",
+            "fileName": "map1.sd7",
+            "downloadURL": httpserver.url_for("/map/map1.sd7"),
+            "md5": hashlib.md5(contents).hexdigest(),
+        }
+    ]
+
+    def handler(request: HTTPRequest) -> HTTPResponse:
+        if request.headers.get("If-None-Match") == '"v1"':
+            return HTTPResponse(b"", status=304)
+        return HTTPResponse(json.dumps(response), headers={"ETag": '"v1"'})
+
+    httpserver.expect_request("/live_maps.json").respond_with_handler(handler)
+    httpserver.expect_request("/map/map1.sd7").respond_with_data(contents)
+    url = httpserver.url_for("/live_maps.json")
+    d = tmp_path
+    (d / "map_old.sd7").touch()
+    state = map_syncer.SyncState()
+    find_missing_maps = mocker.spy(map_syncer, "find_missing_maps")
+
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert (d / "map1.sd7").read_bytes() == contents
+    assert find_missing_maps.call_count == 1
+
+    # Nothing changed, directory is not touched.
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert find_missing_maps.call_count == 1
+
+    # Local change is detected and restored even if the list didn't change.
+    (d / "map1.sd7").unlink()
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert find_missing_maps.call_count == 2
+    assert (d / "map1.sd7").read_bytes() == contents
+
+    # Expired tombstone is deleted without full scan.
+    assert state.next_deletion_at is not None
+    mocker.patch("time.time", return_value=state.next_deletion_at + 1)
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert find_missing_maps.call_count == 2
+    assert not (d / "map_old.sd7").exists()
+
+
+def serve_live_maps(
+    server: HTTPServer, maps: Dict[str, bytes]
+) -> Callable[[Dict[str, bytes]], None]:
+    """Serves maps from the dict, returns function to replace served maps."""
+
+    served: Dict[str, bytes] = {}
+
+    def live_maps_handler(request: HTTPRequest) -> HTTPResponse:
+        response: List[Dict[str, str]] = [
+            {
+                "springName": file,
+                "fileName": file,
+                "downloadURL": server.url_for("/map/" + file),
+                "md5": hashlib.md5(contents).hexdigest(),
+            }
+            for file, contents in served.items()
+        ]
+        return HTTPResponse(json.dumps(response))
+
+    def map_handler(request: HTTPRequest) -> HTTPResponse:
+        return HTTPResponse(served[request.path.split("/")[-1]])
+
+    def update(maps: Dict[str, bytes]) -> None:
+        served.clear()
+        served.update(maps)
+
+    update(maps)
+    server.expect_request("/live_maps.json").respond_with_handler(live_maps_handler)
+    server.expect_request(re.compile("/map/.*")).respond_with_handler(map_handler)
+    return update
+
+
+def test_sync_files_incremental(
+    httpserver: HTTPServer,
+    tmp_path: pathlib.Path,
+    mocker: MockerFixture,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    update = serve_live_maps(
+        httpserver, {"map1.sd7": b"map1", "map2.sd7": b"map2", "map3.sd7": b"map3"}
+    )
+    url = httpserver.url_for("/live_maps.json")
+    d = tmp_path
+    state = map_syncer.SyncState()
+    delete_stale_files = mocker.spy(map_syncer, "delete_stale_files")
+
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert delete_stale_files.call_count == 1
+
+    caplog.set_level(logging.INFO)
+    update({"map1.sd7": b"map1", "map3.sd7": b"map3 v2", "map4.sd7": b"map4"})
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert delete_stale_files.call_count == 1
+    assert "Live maps diff: 1 added, 1 removed, 1 changed" in caplog.messages
+    assert (d / "map3.sd7").read_bytes() == b"map3 v2"
+    assert (d / "map4.sd7").read_bytes() == b"map4"
+    assert (d / "map2.sd7").exists()
+    tombstones = cast(Dict[str, int], json.loads((d / "tombstones.json").read_text()))
+    assert list(tombstones) == ["map2.sd7"]
+
+    # Map coming back to the live list loses its tombstone.
+    update(
+        {
+            "map1.sd7": b"map1",
+            "map2.sd7": b"map2",
+            "map3.sd7": b"map3 v2",
+            "map4.sd7": b"map4",
+        }
+    )
+    map_syncer.sync_files(d, url, 1000, state=state)
+    assert delete_stale_files.call_count == 1
+    tombstones = cast(Dict[str, int], json.loads((d / "tombstones.json").read_text()))
+    assert tombstones == {}
+
+
+def test_sync_files_full_sync_every(
+    httpserver: HTTPServer, tmp_path: pathlib.Path, mocker: MockerFixture
+) -> None:
+    serve_live_maps(httpserver, {"map1.sd7": b"map1"})
+    url = httpserver.url_for("/live_maps.json")
+    state = map_syncer.SyncState()
+    options = map_syncer.SyncOptions(full_sync_every=3)
+    full_sync_files = mocker.spy(map_syncer, "full_sync_files")
+    for _ in range(7):
+        map_syncer.sync_files(tmp_path, url, 1000, options, state)
+    assert full_sync_files.call_count == 3
+
+
+def test_sync_files_changed_map_after_restart(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    update = serve_live_maps(httpserver, {"map1.sd7": b"map1"})
+    url = httpserver.url_for("/live_maps.json")
+    map_syncer.sync_files(tmp_path, url, 1000, state=map_syncer.SyncState())
+    synced = cast(
+        List[Dict[str, str]],
+        json.loads((tmp_path / "synced_maps.json").read_text()),
+    )
+    assert [m["fileName"] for m in synced] == ["map1.sd7"]
+
+    update({"map1.sd7": b"map1 v2"})
+    map_syncer.sync_files(tmp_path, url, 1000, state=map_syncer.SyncState())
+    assert (tmp_path / "map1.sd7").read_bytes() == b"map1 v2"
+
+
+def test_sync_files_checks_dirty_maps(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    serve_live_maps(httpserver, {"map1.sd7": b"map1", "map2.sd7": b"map2"})
+    url = httpserver.url_for("/live_maps.json")
+    dirty_files = map_syncer.DirtyFiles()
+    state = map_syncer.SyncState(dirty_files=dirty_files)
+    map_syncer.sync_files(tmp_path, url, 1000, state=state)
+
+    # Damaged in place, which doesn't change the directory modification time.
+    (tmp_path / "map1.sd7").write_bytes(b"mapX")
+    dirty_files.add(tmp_path, "map1.sd7")
+    map_syncer.sync_files(tmp_path, url, 1000, state=state)
+    assert (tmp_path / "map1.sd7").read_bytes() == b"map1"
+    assert dirty_files.get(tmp_path) == set()
+
+
+@pytest.mark.parametrize(
+    ("payload", "expected"),
+    [
+        (b"", None),
+        (b"not a commit", None),
+        (b"abc123\n", "abc123"),
+        (b'{"commit": "c2", "base": "c1", "removed": ["map1.sd7"]}', None),
+    ],
+)
+def test_parse_announced_commit(payload: bytes, expected: Optional[str]) -> None:
+    assert map_syncer.parse_announced_commit(payload) == expected
+
+
+@pytest.mark.parametrize(
+    ("name", "expected"),
+    [
+        ("map1.sd7", True),
+        ("Map 1.sdz", True),
+        ("../pwned.sd7", False),
+        ("maps/map1.sd7", False),
+        ("/tmp/map1.sd7", False),
+        ("..\\pwned.sd7", False),
+        ("map1.txt", False),
+        ("..", False),
+        ("", False),
+    ],
+)
+def test_is_map_file_name(name: str, expected: bool) -> None:
+    assert map_syncer.is_map_file_name(name) == expected
+
+
+def test_iter_live_maps_skips_invalid_file_names() -> None:
+    data = [
+        {"springName": "Map 1", "fileName": "map1.sd7", "downloadURL": "", "md5": ""},
+        {"springName": "Bad", "fileName": "../pwned.sd7", "downloadURL": "", "md5": ""},
+    ]
+    live_maps = map_syncer.iter_live_maps(io.BytesIO(json.dumps(data).encode()))
+    assert [m.file_name for m in live_maps] == ["map1.sd7"]
+    assert map_syncer.parse_live_maps(data) == map_syncer.parse_live_maps(data[:1])
+
+
+def test_sync_skips_fetch_of_announced_commit(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    response: List[Dict[str, str]] = [
+        {
+            "springName": "Map 1",
+            "fileName": "map1.sd7",
+            "downloadURL": httpserver.url_for("/map/map1.sd7"),
+            "md5": hashlib.md5(b"map1").hexdigest(),
+        }
+    ]
+    httpserver.expect_request("/live_maps.json").respond_with_json(
+        response, headers={map_syncer.COMMIT_HEADER: "c1"}
+    )
+    httpserver.expect_request("/map/map1.sd7").respond_with_data(b"map1")
+    url = httpserver.url_for("/live_maps.json")
+    announcements = map_syncer.LiveMapsAnnouncements()
+    states = map_syncer.new_sync_states([tmp_path], announcements=announcements)
+
+    def list_fetches() -> int:
+        return sum(r.path == "/live_maps.json" for r, _ in httpserver.log)
+
+    map_syncer.run_sync(states, url, 1000, None, None, "test")
+    assert list_fetches() == 1
+    assert states[tmp_path].live_maps_cache.commit == "c1"
+
+    # Already synced commit, the list is not fetched.
+    announcements.announce("c1")
+    map_syncer.run_sync(states, url, 1000, None, None, "MQTT")
+    assert list_fetches() == 1
+
+    # Other commit and messages without commit fall back to the fetch.
+    announcements.announce("c1")
+    announcements.announce("c2")
+    map_syncer.run_sync(states, url, 1000, None, None, "MQTT")
+    assert list_fetches() == 2
+    announcements.announce(None)
+    map_syncer.run_sync(states, url, 1000, None, None, "MQTT")
+    assert list_fetches() == 3
+
+    # Without announcements the list is always fetched.
+    map_syncer.run_sync(states, url, 1000, None, None, "timer")
+    assert list_fetches() == 4
+
+
+def test_sync_shared_store(httpserver: HTTPServer, tmp_path: pathlib.Path) -> None:
+    update = serve_live_maps(httpserver, {"map1.sd7": b"map1", "map2.sd7": b"map2"})
+    url = httpserver.url_for("/live_maps.json")
+    d1, d2, store = tmp_path / "d1", tmp_path / "d2", tmp_path / "store"
+    d1.mkdir()
+    d2.mkdir()
+    options = map_syncer.SyncOptions(store=store)
+    states = map_syncer.new_sync_states([d1, d2])
+
+    map_syncer.run_sync(states, url, 0, None, options, "test")
+    blob = store / (hashlib.md5(b"map1").hexdigest() + ".sd7")
+    assert (d1 / "map1.sd7").samefile(blob)
+    assert (d2 / "map1.sd7").samefile(blob)
+    assert blob.stat().st_nlink == 3
+    downloads = [r for r, _ in httpserver.log if r.path.startswith("/map/")]
+    assert len(downloads) == 2
+
+    # Removed map is unlinked from the directories, and its blob deleted from
+    # the store only once it's not referenced.
+    update({"map1.sd7": b"map1"})
+    map_syncer.run_sync(states, url, 0, None, options, "test")
+    assert not (d1 / "map2.sd7").exists()
+    assert not (d2 / "map2.sd7").exists()
+    map_syncer.collect_store_garbage(store, grace=0)
+    assert sorted(p.name for p in store.iterdir()) == [blob.name]
+
+
+def test_download_map_store_tmp_is_per_process(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    httpserver.expect_request("/map/map1.sd7").respond_with_data(b"map1")
+    md5 = hashlib.md5(b"map1").hexdigest()
+    map_info = map_syncer.LiveMapEntry(
+        "Map 1", "map1.sd7", httpserver.url_for("/map/map1.sd7"), md5
+    )
+    store = tmp_path / "store"
+    store.mkdir()
+    # Partial download of the same blob by another syncer process.
+    other_tmp = store / f"{md5}.1.sd7.tmp"
+    other_tmp.write_bytes(b"ma")
+    tmp = map_syncer.store_tmp_path(store / f"{md5}.sd7")
+    assert tmp.name == f"{md5}.{os.getpid()}.sd7.tmp"
+    map_syncer.download_map(tmp_path, map_info, store=store)
+    assert (tmp_path / "map1.sd7").read_bytes() == b"map1"
+    assert other_tmp.read_bytes() == b"ma"
+    assert not tmp.exists()
+    assert map_syncer.maps_disk_usage(store) == 6
+
+
+def test_sync_shared_store_verify_replaces_corrupted_blob(
+    httpserver: HTTPServer, tmp_path: pathlib.Path
+) -> None:
+    serve_live_maps(httpserver, {"map1.sd7": b"map1"})
+    url = httpserver.url_for("/live_maps.json")
+    d1, d2, store = tmp_path / "d1", tmp_path / "d2", tmp_path / "store"
+    d1.mkdir()
+    d2.mkdir()
+    options = map_syncer.SyncOptions(store=store)
+    states = map_syncer.new_sync_states([d1, d2])
+    map_syncer.run_sync(states, url, -1, None, options, "test")
+
+    # Both directories share the corrupted file.
+    (d1 / "map1.sd7").write_bytes(b"mapX")
+    options = map_syncer.SyncOptions(store=store, verify=True)
+    map_syncer.run_sync(states, url, -1, None, options, "test")
+    assert (d1 / "map1.sd7").read_bytes() == b"map1"
+    assert (d2 / "map1.sd7").read_bytes() == b"map1"
+    assert (d1 / "map1.sd7").samefile(d2 / "map1.sd7")
+
+
+def test_benchmarks_run(capsys: pytest.CaptureFixture[str]) -> None:
+    map_syncer_bench.main(
+        [
+            "map_syncer_bench.py",
+            "--repeat=1",
+            "--maps=3",
+            "--map-size=1K",
+            "--warm-maps=10",
+            "--file-size=1K",
+            "--list-entries=10",
+        ]
+    )
+    lines = capsys.readouterr().out.splitlines()
+    results = [cast(Dict[str, object], json.loads(line)) for line in lines]
+    assert [r["benchmark"] for r in results] == list(map_syncer_bench.BENCHMARKS)